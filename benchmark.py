@@ -0,0 +1,153 @@
+import os
+import time
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from sentence_transformers import SentenceTransformer
+from utils.utils import read_txt, upload_embeddings
+from utils.embeddings import EMBEDDINGS_FILE, EMBEDDING_DIM, exact_ground_truth
+from utils.index import BACKENDS, QUANTIZATIONS, get_index
+from utils.manifest import point_id
+
+
+def get_cli_arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("labels_file", help="Path to the file with the benchmark queries", type=str)
+    parser.add_argument("--backend", help="Vector index backend", choices=BACKENDS, default='qdrant')
+    parser.add_argument("--m", help="Values of m to build", type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument("--ef-construct", help="Values of ef_construct to build", type=int, nargs='+',
+                        default=[64, 100, 200])
+    parser.add_argument("--hnsw-ef", help="Values of hnsw_ef to search with", type=int, nargs='+',
+                        default=[16, 32, 64, 128, 256])
+    parser.add_argument("--quantization", help="Quantization settings to build", nargs='+',
+                        choices=QUANTIZATIONS, default=['none'])
+    parser.add_argument("--on-disk", help="Original vectors placements to build (0 = RAM, 1 = disk)", type=int,
+                        nargs='+', choices=[0, 1], default=[0])
+    parser.add_argument("--oversampling", help="Oversampling factors to search quantized collections with",
+                        type=float, nargs='+', default=[1.0, 2.0])
+    parser.add_argument("--k", help="Number of results of each query", type=int, default=5)
+    parser.add_argument("--repeats", help="Number of times each query is run", type=int, default=3)
+    parser.add_argument("--docs-path", help="Dir path to the resources", type=str, default='resources')
+    parser.add_argument("--keep", help="Keep the benchmark collections", action="store_true")
+
+    return parser.parse_args()
+
+
+def pareto_front(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keeps the settings for which no other setting has both a higher recall and a lower p95 latency
+    Args:
+        df: benchmark results
+
+    Returns: the Pareto-optimal rows, sorted by latency
+    """
+    df = df.sort_values(['latency_p95_ms', 'recall'], ascending=[True, False])
+    best_recall = -1.0
+    keep = []
+    for idx, recall in df['recall'].items():
+        if recall > best_recall:
+            keep.append(idx)
+            best_recall = recall
+    return df.loc[keep]
+
+
+def run_queries(index, vectors: np.ndarray, ground_truth, k: int, repeats: int, **search_params):
+    """
+    Runs the queries one by one and measures recall@k and latency
+    Returns: recall@k and the latencies in milliseconds
+    """
+    # Warm-up
+    index.search_batch(vectors[:1], [k], **search_params)
+
+    latencies = []
+    recalls = []
+    for _ in range(repeats):
+        for vector, truth in zip(vectors, ground_truth):
+            start = time.perf_counter()
+            hits = index.search_batch(vector[None], [k], **search_params)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            recalls.append(len(truth.intersection(hit.id for hit in hits)) / k)
+
+    return float(np.mean(recalls)), np.array(latencies)
+
+
+if __name__ == '__main__':
+
+    # Get CLI arguments and parse them
+    args = get_cli_arg()
+    embeddings_path = os.path.join(args.docs_path, EMBEDDINGS_FILE)
+    output_dir = os.path.join(args.docs_path, 'benchmark')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Encode queries and compute the exact ground truth
+    queries = read_txt(path=args.labels_file)
+    encoder = SentenceTransformer("clip-ViT-B-32", device="cpu")
+    vectors = encoder.encode(queries, convert_to_numpy=True)
+    ground_truth = [set(point_id(p) for p in paths) for paths in exact_ground_truth(embeddings_path, vectors, args.k)]
+
+    rows = []
+    grid = itertools.product(args.m, args.ef_construct, args.quantization, args.on_disk)
+    for m, ef_construct, quantization, on_disk in grid:
+        collection_name = f"benchmark_m{m}_ef{ef_construct}_{quantization}{'_disk' if on_disk else ''}"
+        print(f"Building collection '{collection_name}'...")
+
+        # Build the collection
+        index = get_index(args.backend, collection_name, args.docs_path)
+        start = time.perf_counter()
+        index.recreate(EMBEDDING_DIM, m=m, ef_construct=ef_construct, quantization=quantization,
+                       on_disk=bool(on_disk))
+        upload_embeddings(index, embeddings_path)
+        build_time = time.perf_counter() - start
+        memory_mb = index.memory_usage() / 2 ** 20
+
+        # Sweep the search settings, rescoring only applies to quantized collections
+        if quantization == 'none':
+            search_options = [(None, None)]
+        else:
+            search_options = [(False, None)] + [(True, oversampling) for oversampling in args.oversampling]
+        for hnsw_ef, (rescore, oversampling) in itertools.product(args.hnsw_ef, search_options):
+            recall, latencies = run_queries(index, vectors, ground_truth, args.k, args.repeats,
+                                            hnsw_ef=hnsw_ef, rescore=rescore, oversampling=oversampling)
+            rows.append({
+                'm': m,
+                'ef_construct': ef_construct,
+                'quantization': quantization,
+                'on_disk': bool(on_disk),
+                'rescore': rescore,
+                'oversampling': oversampling,
+                'hnsw_ef': hnsw_ef,
+                'recall': recall,
+                'latency_p50_ms': np.percentile(latencies, 50),
+                'latency_p95_ms': np.percentile(latencies, 95),
+                'latency_p99_ms': np.percentile(latencies, 99),
+                'qps': 1000 * len(latencies) / latencies.sum(),
+                'build_time_s': build_time,
+                'memory_mb': memory_mb,
+            })
+            print(rows[-1])
+
+        if not args.keep:
+            index.drop()
+
+    # Store all results and the Pareto front
+    results_df = pd.DataFrame(rows)
+    front_df = pareto_front(results_df)
+    results_df.to_csv(os.path.join(output_dir, 'results.csv'), index=False)
+    front_df.to_csv(os.path.join(output_dir, 'pareto.csv'), index=False)
+
+    # Plot recall against latency, with the Pareto front
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for quantization, group in results_df.groupby('quantization'):
+        ax.scatter(group['latency_p95_ms'], group['recall'], label=f"quantization={quantization}", alpha=0.6)
+    ax.plot(front_df['latency_p95_ms'], front_df['recall'], 'k--', label='Pareto front')
+    ax.set_xlabel('p95 latency (ms)')
+    ax.set_ylabel(f'recall@{args.k}')
+    ax.set_title('Recall / latency trade-off')
+    ax.legend()
+    fig.savefig(os.path.join(output_dir, 'pareto.png'))
+    plt.close(fig)
+
+    print("Pareto-optimal settings:")
+    print(front_df.to_string(index=False))
@@ -1,11 +1,13 @@
 import argparse
 from utils.search import Text2Img
 from utils.utils import read_txt
+from utils.index import BACKENDS
 
 
 def get_cli_arg():
     parser = argparse.ArgumentParser()
     parser.add_argument("labels_file", help="Path to labels file", type=str)
+    parser.add_argument("--backend", help="Vector index backend", choices=BACKENDS, default='qdrant')
 
     return parser.parse_args()
 
@@ -17,7 +19,7 @@ if __name__ == '__main__':
     labels_filepath = args.labels_file
 
     # Instantiate text 2 image system
-    text2img = Text2Img()
+    text2img = Text2Img(backend=args.backend)
 
     # Read test dataset
     test_dataset = read_txt(path=labels_filepath)
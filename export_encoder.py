@@ -0,0 +1,22 @@
+import argparse
+from utils.encoder import export_text_encoder
+
+
+def get_cli_arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", help="Format of the exported text encoder", choices=['onnx', 'torchscript'],
+                        default='onnx')
+    parser.add_argument("--output-dir", help="Dir path where the text encoder and tokenizer are written", type=str,
+                        default='resources/encoder')
+    parser.add_argument("--quantize", help="Also export an int8-quantized text encoder", action="store_true")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Get CLI arguments and parse them
+    args = get_cli_arg()
+
+    # Export the text tower of the CLIP model
+    export_text_encoder(export_dir=args.output_dir, encoder_format=args.format, quantize=args.quantize)
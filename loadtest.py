@@ -0,0 +1,402 @@
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import itertools
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import httpx
+import numpy as np
+import pandas as pd
+from src.schemas import check_search_text
+
+
+# Endpoints replayed by the load generator
+ENDPOINTS = ('search', 'json', 'batch', 'similar')
+
+# Latency percentiles reported for each endpoint
+PERCENTILES = (50, 90, 95, 99)
+
+
+def get_cli_arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queries_file", help="Query log to replay: a text file with one query per row, or a JSONL file "
+                                             "with a 'text' field per row", type=str)
+    parser.add_argument("--url", help="Base URL of a running service, the app is run in-process with an in-memory "
+                                      "Qdrant and a stub encoder if not given", type=str, default=None)
+    parser.add_argument("--endpoints", help="Endpoints replayed in turn", nargs='+', choices=ENDPOINTS,
+                        default=['search'])
+    parser.add_argument("--qps", help="Target rate of an open-loop run, requests are sent on schedule whatever the "
+                                      "response times", type=float, default=None)
+    parser.add_argument("--concurrency", help="Number of clients of a closed-loop run, each one sends its next request "
+                                              "when the previous one completed", type=int, default=8)
+    parser.add_argument("--duration", help="Measured duration in seconds", type=float, default=10.0)
+    parser.add_argument("--warmup", help="Unmeasured duration in seconds before the run", type=float, default=2.0)
+    parser.add_argument("--num-points", help="Number of random points of the in-process collection", type=int,
+                        default=10000)
+    parser.add_argument("--encoder-ms", help="Time spent by the stub encoder on each call, to mimic the model",
+                        type=float, default=0.0)
+    parser.add_argument("--no-cache", help="Disable the embedding and result caches of the in-process app, so that "
+                                           "every request is encoded and searched", action="store_true")
+    parser.add_argument("--baselines-file", help="JSON file storing the baselines", type=str,
+                        default=os.path.join('resources', 'loadtest_baselines.json'))
+    parser.add_argument("--save-baseline", help="Store the results as the baseline with this name", type=str,
+                        default=None)
+    parser.add_argument("--check-baseline", help="Compare the results with the baseline with this name and exit with "
+                                                 "an error if they regressed", type=str, default=None)
+    parser.add_argument("--max-p95-regression", help="Maximum relative increase of the p95 latency", type=float,
+                        default=0.2)
+    parser.add_argument("--max-qps-regression", help="Maximum relative decrease of the throughput", type=float,
+                        default=0.1)
+
+    return parser.parse_args()
+
+
+class StubEncoder:
+    """
+    Text encoder returning a fixed random unit vector per text, so that the service is measured without the model
+    """
+    def __init__(self, dim: int = 512, delay_ms: float = 0.0):
+        """
+        Args:
+            dim: dimension of the vectors
+            delay_ms: time spent by each call, to mimic the cost of the model
+        """
+        self.dim = dim
+        self.delay = delay_ms / 1000
+
+    @property
+    def loaded(self) -> bool:
+        return True
+
+    def load(self):
+        pass
+
+    def encode(self, texts: List[str], batch_size: int = 256) -> np.ndarray:
+        if self.delay:
+            time.sleep(self.delay)
+        seeds = [int(hashlib.sha1(text.encode()).hexdigest()[:8], 16) for text in texts]
+        vectors = np.stack([np.random.default_rng(seed).normal(size=self.dim) for seed in seeds])
+        return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def read_queries(path: str) -> List[str]:
+    """
+    Read the queries of a log, leaving out the ones rejected by the search validation
+    Args:
+        path: text file with one query per row, or JSONL file with a 'text' field per row
+
+    Returns: list of queries, in the order of the log
+    """
+    with open(path, 'r') as file:
+        rows = [row.strip() for row in file if row.strip()]
+    if path.endswith('.jsonl'):
+        rows = [json.loads(row).get('text') or '' for row in rows]
+
+    queries = []
+    for row in rows:
+        try:
+            queries.append(check_search_text(row))
+        except ValueError:
+            pass
+    if len(queries) < len(rows):
+        print(f"Left out {len(rows) - len(queries)} invalid queries of the log.")
+    if not queries:
+        raise ValueError(f"There is no valid query in {path}")
+    return queries
+
+
+def start_in_process_service(num_points: int, encoder_ms: float, cache: bool = True):
+    """
+    Import the app with an in-memory Qdrant collection of random points and a stub encoder.
+    The app runs in a temporary directory, so that the resources of the repository are left untouched.
+    Args:
+        num_points: number of points of the collection
+        encoder_ms: time spent by the stub encoder on each call
+        cache: keep the embedding and result caches of the app
+
+    Returns: the service module
+    """
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='loadtest_')
+    atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+    os.makedirs(os.path.join(work_dir, 'images'))
+    os.symlink(os.path.join(repo_path, 'templates'), os.path.join(work_dir, 'templates'))
+    os.chdir(work_dir)
+    sys.path.insert(0, repo_path)
+    os.environ.update({'QDRANT_URL': ':memory:', 'SEARCH_BACKEND': 'qdrant'})
+
+    from utils.index import get_index
+    from utils.manifest import point_id
+    from utils.embeddings import EMBEDDING_DIM
+
+    # Random collection with the metadata of the real one, searched through the shared in-memory client
+    print(f"Creating an in-memory collection of {num_points} points...")
+    index = get_index('qdrant', 'images')
+    index.recreate(EMBEDDING_DIM)
+    rng = np.random.default_rng(0)
+    for start in range(0, num_points, 1024):
+        paths = [f'images/{i}.jpg' for i in range(start, min(start + 1024, num_points))]
+        sizes = rng.integers(64, 1024, size=(len(paths), 2))
+        payloads = [{'path': path, 'width': int(w), 'height': int(h), 'area': int(w * h), 'aspect_ratio': float(w / h),
+                     'format': 'JPEG'} for path, (w, h) in zip(paths, sizes)]
+        index.upsert([point_id(path) for path in paths], rng.normal(size=(len(paths), EMBEDDING_DIM)), payloads)
+    index.wait_ready()
+
+    import service
+    service.text2img.text_encoder = StubEncoder(EMBEDDING_DIM, encoder_ms)
+    if not cache:
+        service.text2img.embedding_cache.maxsize = 0
+        service.text2img.result_cache.maxsize = 0
+        service.responses.cache.maxsize = 0
+        service.fragment_cache.maxsize = 0
+    return service
+
+
+def request_factory(endpoints: List[str],
+                    queries: List[str],
+                    image_ids: List[str]) -> Iterator[Tuple[str, str, str, Dict[str, Any]]]:
+    """
+    Replay the queries in the order of the log, sending them to the endpoints in turn
+    Returns: iterator over (endpoint, method, url, keyword arguments of the request)
+    """
+    ids = itertools.cycle(image_ids or [''])
+    for query, endpoint in zip(itertools.cycle(queries), itertools.cycle(endpoints)):
+        if endpoint == 'search':
+            yield endpoint, 'POST', '/api/search', {'data': {'text': query}}
+        elif endpoint == 'json':
+            yield endpoint, 'GET', '/api/search', {'params': {'text': query, 'limit': 5}}
+        elif endpoint == 'batch':
+            yield endpoint, 'POST', '/api/search/batch', {'json': {'texts': [query], 'limit': 5}}
+        else:
+            yield endpoint, 'GET', f'/api/search/similar/{next(ids)}', {'params': {'limit': 5}}
+
+
+async def send(client: httpx.AsyncClient,
+               request: Tuple[str, str, str, Dict[str, Any]],
+               start: float,
+               records: Optional[List[Tuple[str, int, float]]]):
+    """
+    Send a request and record its endpoint, status and latency since `start`, a failed connection has status 0
+    """
+    endpoint, method, url, kwargs = request
+    try:
+        status = (await client.request(method, url, **kwargs)).status_code
+    except httpx.HTTPError:
+        status = 0
+    if records is not None:
+        records.append((endpoint, status, time.perf_counter() - start))
+
+
+async def open_loop(client: httpx.AsyncClient,
+                    requests: Iterator,
+                    qps: float,
+                    duration: float,
+                    records: Optional[List] = None):
+    """
+    Send requests at a fixed rate. Latencies are measured from the scheduled send time, so that a slow service
+    is not hidden by requests sent late
+    """
+    tasks = []
+    start = time.perf_counter()
+    for i in itertools.count():
+        scheduled = start + i / qps
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, next(requests), scheduled, records)))
+    await asyncio.gather(*tasks)
+
+
+async def closed_loop(client: httpx.AsyncClient,
+                      requests: Iterator,
+                      concurrency: int,
+                      duration: float,
+                      records: Optional[List] = None):
+    """
+    Send requests from `concurrency` clients, each one waiting for its response before sending the next request
+    """
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            await send(client, next(requests), time.perf_counter(), records)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+def summarize(records: List[Tuple[str, int, float]], elapsed: float) -> Dict[str, Dict[str, float]]:
+    """
+    Throughput and latency percentiles of the successful requests, per endpoint and for all of them
+    Args:
+        records: endpoint, status and latency in seconds of each request
+        elapsed: duration of the run in seconds
+
+    Returns: mapping between endpoint ('all' for all of them) and its statistics
+    """
+    df = pd.DataFrame(records, columns=['endpoint', 'status', 'latency'])
+    results = {}
+    for endpoint, group in [*df.groupby('endpoint'), ('all', df)]:
+        ok = group[(group['status'] >= 200) & (group['status'] < 400)]
+        latencies = ok['latency'].to_numpy() * 1000 if len(ok) else np.full(1, np.nan)
+        results[endpoint] = {
+            'requests': len(group),
+            'errors': len(group) - len(ok),
+            'qps': len(ok) / elapsed,
+            'mean_ms': float(np.mean(latencies)),
+            **{f'p{p}_ms': float(np.percentile(latencies, p)) for p in PERCENTILES},
+        }
+    return results
+
+
+def check_regressions(results: Dict[str, Dict[str, float]],
+                      baseline: Dict[str, Dict[str, float]],
+                      max_p95_regression: float = 0.2,
+                      max_qps_regression: float = 0.1) -> List[str]:
+    """
+    Compare the results of a run with a baseline
+    Args:
+        results: statistics of the run, per endpoint
+        baseline: statistics of the baseline, per endpoint
+        max_p95_regression: maximum relative increase of the p95 latency
+        max_qps_regression: maximum relative decrease of the throughput
+
+    Returns: description of each regression, empty if there is none
+    """
+    regressions = []
+    for endpoint, expected in baseline.items():
+        actual = results.get(endpoint)
+        if actual is None:
+            regressions.append(f"{endpoint}: not measured")
+            continue
+        if actual['p95_ms'] > expected['p95_ms'] * (1 + max_p95_regression):
+            regressions.append(f"{endpoint}: p95 {actual['p95_ms']:.1f}ms > {expected['p95_ms']:.1f}ms "
+                               f"+{max_p95_regression:.0%}")
+        if actual['qps'] < expected['qps'] * (1 - max_qps_regression):
+            regressions.append(f"{endpoint}: {actual['qps']:.1f} QPS < {expected['qps']:.1f} QPS "
+                               f"-{max_qps_regression:.0%}")
+    return regressions
+
+
+def load_baselines(path: str) -> Dict[str, Dict]:
+    """
+    Read the stored baselines, by name
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+async def run(args, queries: List[str], app: Optional[Callable] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Warm the service up, then replay the query log for the measured duration
+    Args:
+        args: CLI arguments
+        queries: queries of the log
+        app: ASGI app run in-process, the service at `args.url` is used if None
+
+    Returns: statistics of the run, per endpoint
+    """
+    transport = httpx.ASGITransport(app=app) if app is not None else None
+    limits = httpx.Limits(max_connections=args.concurrency if args.qps is None else None)
+    async with httpx.AsyncClient(transport=transport, base_url=args.url or 'http://loadtest', timeout=30.0,
+                                 limits=limits) as client:
+        # Wait for the warm-up of the service
+        while (await client.get('/health/ready')).status_code != 200:
+            await asyncio.sleep(0.1)
+
+        # Images of the similarity searches, taken from the results of the first queries
+        image_ids = []
+        if 'similar' in args.endpoints:
+            response = await client.post('/api/search/batch', json={'texts': queries[:32], 'limit': 5,
+                                                                    'with_payload': False})
+            image_ids = list(dict.fromkeys(hit['id'] for hits in response.json()['results'] for hit in hits))
+
+        requests = request_factory(args.endpoints, queries, image_ids)
+        if args.qps is not None:
+            print(f"Replaying {len(queries)} queries at {args.qps} QPS for {args.duration}s...")
+            await open_loop(client, requests, args.qps, args.warmup)
+            records = []
+            start = time.perf_counter()
+            await open_loop(client, requests, args.qps, args.duration, records)
+        else:
+            print(f"Replaying {len(queries)} queries with {args.concurrency} clients for {args.duration}s...")
+            await closed_loop(client, requests, args.concurrency, args.warmup)
+            records = []
+            start = time.perf_counter()
+            await closed_loop(client, requests, args.concurrency, args.duration, records)
+
+        return summarize(records, time.perf_counter() - start)
+
+
+async def run_in_process(args, queries: List[str], service) -> Dict[str, Dict[str, float]]:
+    """
+    Run the load test against the in-process app, with its lifespan (micro-batcher and warm-up) started
+    """
+    async with service.lifespan(service.app):
+        return await run(args, queries, service.app)
+
+
+if __name__ == '__main__':
+
+    # Get CLI arguments and parse them
+    args = get_cli_arg()
+    baselines_file = os.path.abspath(args.baselines_file)
+    queries = read_queries(args.queries_file)
+
+    # Run the load test
+    if args.url is None:
+        service = start_in_process_service(args.num_points, args.encoder_ms, cache=not args.no_cache)
+        results = asyncio.run(run_in_process(args, queries, service))
+    else:
+        results = asyncio.run(run(args, queries))
+
+    print(pd.DataFrame(results).T.round(2).to_string())
+
+    config = {
+        'url': args.url,
+        'endpoints': args.endpoints,
+        'qps': args.qps,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'num_points': args.num_points if args.url is None else None,
+        'encoder_ms': args.encoder_ms if args.url is None else None,
+        'cache': not args.no_cache if args.url is None else None,
+    }
+
+    # Compare with the baseline before it is possibly replaced
+    regressions = []
+    baselines = load_baselines(baselines_file)
+    if args.check_baseline is not None:
+        if args.check_baseline not in baselines:
+            sys.exit(f"There is no baseline named '{args.check_baseline}' in {baselines_file}")
+        baseline = baselines[args.check_baseline]
+        if baseline['config'] != config:
+            print(f"Warning: the baseline was measured with other settings: {baseline['config']}")
+        regressions = check_regressions(results, baseline['results'], args.max_p95_regression,
+                                        args.max_qps_regression)
+
+    if args.save_baseline is not None:
+        baselines[args.save_baseline] = {'created': datetime.now(timezone.utc).isoformat(), 'config': config,
+                                         'results': results}
+        os.makedirs(os.path.dirname(baselines_file) or '.', exist_ok=True)
+        with open(baselines_file, 'w') as file:
+            json.dump(baselines, file, indent=2)
+        print(f"Stored the baseline '{args.save_baseline}' in {baselines_file}")
+
+    if regressions:
+        print("Regressions against the baseline:")
+        for regression in regressions:
+            print(f"- {regression}")
+        sys.exit(1)
+    if args.check_baseline is not None:
+        print(f"No regression against the baseline '{args.check_baseline}'.")
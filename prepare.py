@@ -1,9 +1,40 @@
-from utils.data import Preparator
+import argparse
+from utils.data import STAGES, Preparator
+from utils.profiling import PROFILERS
+from utils.index import BACKENDS, QUANTIZATIONS
+
+
+def get_cli_arg():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full-rebuild", help="Re-embed all images and re-create the collection",
+                        action="store_true")
+    parser.add_argument("--backend", help="Vector index backend", choices=BACKENDS, default='qdrant')
+    parser.add_argument("--quantization", help="Quantization of the vectors, applied when the collection is created",
+                        choices=QUANTIZATIONS, default='none')
+    parser.add_argument("--on-disk", help="Keep the original vectors on disk, applied when the collection is created",
+                        action="store_true")
+    parser.add_argument("--keep-versions", help="Number of versions of the collection kept after a rebuild, "
+                                                "including the served one", type=int, default=2)
+    parser.add_argument("--no-dedup", help="Keep near-duplicate images as separate points of the collection",
+                        action="store_true")
+    parser.add_argument("--profile", help="Record the wall time, CPU time, peak memory and throughput of each stage "
+                                          "in resources/profile and in the data report", action="store_true")
+    parser.add_argument("--profile-stage", help="Stage profiled with --profiler, implies --profile", choices=STAGES,
+                        default=None)
+    parser.add_argument("--profiler", help="Profiler of --profile-stage", choices=PROFILERS, default='cprofile')
+
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+
+    # Get CLI arguments and parse them
+    args = get_cli_arg()
+
     # Instantiate preparator
-    data_preparator = Preparator()
+    data_preparator = Preparator(backend=args.backend, quantization=args.quantization, on_disk=args.on_disk,
+                                 keep_versions=args.keep_versions, dedup=not args.no_dedup, profile=args.profile,
+                                 profile_stage=args.profile_stage, profiler=args.profiler)
 
     # Run data preparation pipeline
-    data_preparator.run()
+    data_preparator.run(full_rebuild=args.full_rebuild)
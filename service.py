@@ -1,23 +1,318 @@
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
-from utils.search import Text2Img
-from fastapi.staticfiles import StaticFiles
+import os
+import time
+import asyncio
+from functools import lru_cache, partial
+from typing import Any, Dict, Optional, Tuple
+from uuid import UUID
+from urllib.parse import quote
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Request, Form, HTTPException, UploadFile
+from fastapi.responses import (HTMLResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse,
+                               PlainTextResponse)
+import orjson
+from markupsafe import Markup
+from utils.search import PROMPT_TEMPLATES, Query, Text2Img
+from utils.index import PointNotFoundError, SearchFilter
+from utils.batching import MicroBatcher, QueueFullError
+from utils.thumbnails import thumbnail_name
+from utils.export import stream_zip
+from utils.metrics import REGISTRY, REQUESTS, REQUEST_LATENCY, STAGE_LATENCY, StageTimer
+from utils.cache import TTLCache, read_index_version
+from src.static import CachedStaticFiles
+from src.responses import CachedResponses, encoded_response, make_etag
 from fastapi.templating import Jinja2Templates
-from src.schemas import SearchText
+from src.schemas import (SearchText, SearchBatch, SearchBatchResult, SearchExport, SearchFilters, SearchQuery,
+                         SearchSimilar, SearchResult, Recommend)
 # from pydantic import ValidationError
 
 
-# Instantiate app and template
-app = FastAPI()
+# Worker pool settings, to be sized against the latency target
+SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS', 2))
+SEARCH_QUEUE_SIZE = int(os.environ.get('SEARCH_QUEUE_SIZE', 256))
+SEARCH_RETRY_AFTER = int(os.environ.get('SEARCH_RETRY_AFTER', 1))
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'qdrant')
+SEARCH_RESCORE = os.environ.get('SEARCH_RESCORE', '1') == '1'
+SEARCH_OVERSAMPLING = float(os.environ['SEARCH_OVERSAMPLING']) if 'SEARCH_OVERSAMPLING' in os.environ else None
 
-# Mount static directory
-app.mount("/images", StaticFiles(directory="images"), name="images")
+# Text encoder settings, an exported text tower starts faster than the full CLIP model
+SEARCH_ENCODER = os.environ.get('SEARCH_ENCODER', 'sentence-transformers')
+SEARCH_ENCODER_PATH = os.environ.get('SEARCH_ENCODER_PATH', os.path.join('resources', 'encoder'))
+SEARCH_ENCODER_QUANTIZED = os.environ.get('SEARCH_ENCODER_QUANTIZED', '0') == '1'
+WARM_UP_RETRY_DELAY = 5
 
-# Define Jinja template
+# Prompt ensemble of the text queries: 'none', 'average' or 'rrf', with ';'-separated templates
+SEARCH_ENSEMBLE = os.environ.get('SEARCH_ENSEMBLE', 'none')
+SEARCH_PROMPT_TEMPLATES = os.environ['SEARCH_PROMPT_TEMPLATES'].split(';') if 'SEARCH_PROMPT_TEMPLATES' in os.environ \
+    else PROMPT_TEMPLATES
+SEARCH_ENSEMBLE_SIZE = int(os.environ['SEARCH_ENSEMBLE_SIZE']) if 'SEARCH_ENSEMBLE_SIZE' in os.environ else None
+
+# Default diversity re-rank of the results, between 0 (index ranking) and 1
+SEARCH_DIVERSITY = float(os.environ['SEARCH_DIVERSITY']) if 'SEARCH_DIVERSITY' in os.environ else None
+
+# Largest image accepted by the image search
+SEARCH_MAX_IMAGE_BYTES = int(os.environ.get('SEARCH_MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+
+# Thumbnails written by prepare.py, shown instead of the full-size images when they exist
+THUMBNAILS_DIR = os.environ.get('THUMBNAILS_DIR', 'thumbnails')
+THUMBNAIL_FORMAT = os.environ.get('THUMBNAIL_FORMAT', 'webp')
+STATIC_CACHE_CONTROL = os.environ.get('STATIC_CACHE_CONTROL', 'public, max-age=86400')
+
+# Number of rendered pages, JSON bodies and result fragments kept, answered again without searching or rendering
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 600))
+HTML_MEDIA_TYPE = 'text/html; charset=utf-8'
+
+# Send the duration of each stage of the request in a Server-Timing header
+SEARCH_TIMING_HEADER = os.environ.get('SEARCH_TIMING_HEADER', '0') == '1'
+
+
+async def search_queries(queries):
+    """
+    Runs a batch of queries with one call per encoder (and one lookup of the images searched by id) on the worker
+    pool and one async Qdrant round trip, each result comes with the durations of the batch stages
+    """
+    timer = StageTimer()
+    results = await text2img.search_queries_async(queries, timer, search_executor)
+    return [(result, timer.durations) for result in results]
+
+
+async def run_search(request: Request, query: Query):
+    """
+    Submits a query to the micro-batcher and adds the durations of its stages to the request timer
+    """
+    start = time.perf_counter()
+    result, durations = await batcher.submit(query)
+    elapsed = time.perf_counter() - start
+
+    # Time spent waiting for the batch and for a worker
+    timer = request.state.timer
+    timer.merge(durations)
+    queue_wait = max(elapsed - sum(durations.values()), 0.0)
+    timer.merge({'queue': queue_wait})
+    STAGE_LATENCY.observe(queue_wait, stage='queue')
+    return result
+
+
+def collect_service_metrics():
+    """
+    Metrics read at scrape time from the caches, the micro-batcher and the warm-up
+    """
+    cache_stats = all_cache_stats()
+    queue_stats = batcher.stats()
+    return [
+        ('search_cache_hits_total', 'counter', 'Cache hits',
+         [('', {'cache': name}, stats['hits']) for name, stats in cache_stats.items()]),
+        ('search_cache_misses_total', 'counter', 'Cache misses',
+         [('', {'cache': name}, stats['misses']) for name, stats in cache_stats.items()]),
+        ('search_cache_hit_ratio', 'gauge', 'Ratio of cache lookups which were hits',
+         [('', {'cache': name}, stats['hit_rate']) for name, stats in cache_stats.items()]),
+        ('search_cache_entries', 'gauge', 'Number of entries in the cache',
+         [('', {'cache': name}, stats['size']) for name, stats in cache_stats.items()]),
+        ('search_queue_depth', 'gauge', 'Queries waiting for a worker', [('', {}, queue_stats['queue_depth'])]),
+        ('search_in_flight_batches', 'gauge', 'Batches being processed', [('', {}, queue_stats['in_flight_batches'])]),
+        ('search_rejected_total', 'counter', 'Queries rejected because the queue was full',
+         [('', {}, queue_stats['rejected'])]),
+        ('search_ready', 'gauge', 'Whether the warm-up is done', [('', {}, int(text2img.ready))]),
+    ]
+
+
+def all_cache_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Statistics of the search caches and of the response caches
+    """
+    return {**text2img.cache_stats(), 'responses': responses.stats(), 'fragments': fragment_cache.stats()}
+
+
+def search_similar_params(**params) -> SearchSimilar:
+    """
+    Validates the parameters of an image search, which are not sent as a JSON body
+    """
+    try:
+        return SearchSimilar(**params)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def search_query_params(**params) -> SearchQuery:
+    """
+    Validates the parameters of a text search sent in the query string
+    """
+    try:
+        return SearchQuery(**params)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def search_etag(*parts) -> str:
+    """
+    ETag of a search response: the query, the version of the index and the settings changing the results.
+    Only the version file is read, the index is reloaded by the search itself, on the worker pool.
+    """
+    return make_etag(*parts, read_index_version(text2img.docs_path), SEARCH_SETTINGS)
+
+
+@lru_cache(maxsize=65536)
+def image_urls(path: str) -> Tuple[str, str]:
+    """
+    URLs of an image and of the picture shown for it, its thumbnail when thumbnails exist
+    """
+    image_url = '/images/' + quote(os.path.basename(path))
+    if not use_thumbnails:
+        return image_url, image_url
+    return image_url, '/thumbnails/' + quote(thumbnail_name(path, THUMBNAIL_FORMAT))
+
+
+def to_api_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Result of the JSON search API: id, score, URLs, and the rest of the payload as metadata
+    """
+    image_url, thumbnail_url = image_urls(result['path'])
+    return {'id': result['id'],
+            'score': result['score'],
+            'image_url': image_url,
+            'thumbnail_url': thumbnail_url,
+            'metadata': {key: value for key, value in result.items() if key not in ('id', 'score', 'path')}}
+
+
+def render_page(results) -> bytes:
+    """
+    Renders the images of the search results, with their thumbnails and a link to similar images.
+    The results fragment only depends on the images, it is rendered once per result set.
+    """
+    key = tuple(res['id'] for res in results)
+    fragment = fragment_cache.get(key)
+    if fragment is None:
+        rows = []
+        for res in results:
+            image_url, thumbnail_url = image_urls(res['path'])
+            rows.append({'image_url': image_url, 'thumbnail_url': thumbnail_url,
+                         'similar_url': '/similar/' + quote(res['id'])})
+        fragment = Markup(results_template.render(results=rows))
+        fragment_cache.set(key, fragment)
+    return page_template.render(results_html=fragment).encode()
+
+
+def render_results(request: Request, results) -> Response:
+    """
+    Renders the results page, compressed when the client accepts it
+    """
+    with request.state.timer.stage('render'):
+        return encoded_response(request, render_page(results), HTML_MEDIA_TYPE)
+
+
+def to_search_filter(filters: Optional[SearchFilters]) -> Optional[SearchFilter]:
+    """
+    Converts the filters of a request to the filter applied by the index
+    """
+    if filters is None:
+        return None
+    return SearchFilter(min_width=filters.min_width, min_height=filters.min_height,
+                        min_aspect_ratio=filters.min_aspect_ratio, max_aspect_ratio=filters.max_aspect_ratio,
+                        formats=tuple(filters.formats) if filters.formats else None)
+
+
+async def warm_up():
+    """
+    Loads the text encoder and runs a first query in the background, until it succeeds
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(search_executor, text2img.warm_up)
+            print("Search is ready")
+            return
+        except Exception as e:
+            print(f"Warm-up failed ({e!r}), retrying in {WARM_UP_RETRY_DELAY}s...")
+            await asyncio.sleep(WARM_UP_RETRY_DELAY)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start collecting concurrent queries into micro-batches
+    batcher.start()
+    # The server accepts connections right away, readiness is reported once the warm-up is done
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+    await batcher.stop()
+    search_executor.shutdown(wait=False)
+
+
+# Instantiate app and template, JSON responses are serialized with orjson
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Mount static directories, browsers cache the images and revalidate them with their ETag
+app.mount("/images", CachedStaticFiles(directory="images", cache_control=STATIC_CACHE_CONTROL), name="images")
+use_thumbnails = os.path.isdir(THUMBNAILS_DIR)
+if use_thumbnails:
+    app.mount("/thumbnails", CachedStaticFiles(directory=THUMBNAILS_DIR, cache_control=STATIC_CACHE_CONTROL),
+              name="thumbnails")
+
+# Define Jinja template, the templates of the results page are compiled once
 templates = Jinja2Templates(directory='templates')
+page_template = templates.get_template('images_template.html')
+results_template = templates.get_template('results_template.html')
 
-# Instantiate text 2 image
-text2img = Text2Img()
+# Rendered result fragments by result set, and responses by ETag
+fragment_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+responses = CachedResponses(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+# Settings changing the results, part of the ETags so that clients do not keep results of another configuration
+SEARCH_SETTINGS = (SEARCH_BACKEND, SEARCH_RESCORE, SEARCH_OVERSAMPLING, SEARCH_ENCODER, SEARCH_ENCODER_QUANTIZED,
+                   SEARCH_ENSEMBLE, tuple(SEARCH_PROMPT_TEMPLATES), SEARCH_ENSEMBLE_SIZE, SEARCH_DIVERSITY,
+                   use_thumbnails, THUMBNAIL_FORMAT)
+
+# Instantiate text 2 image, the text encoder is loaded by the warm-up
+text2img = Text2Img(backend=SEARCH_BACKEND, rescore=SEARCH_RESCORE, oversampling=SEARCH_OVERSAMPLING,
+                    encoder_format=SEARCH_ENCODER, encoder_path=SEARCH_ENCODER_PATH,
+                    encoder_quantized=SEARCH_ENCODER_QUANTIZED, ensemble=SEARCH_ENSEMBLE,
+                    prompt_templates=SEARCH_PROMPT_TEMPLATES, ensemble_size=SEARCH_ENSEMBLE_SIZE,
+                    diversity=SEARCH_DIVERSITY)
+
+# Micro-batcher grouping queries received within a few milliseconds, encoding runs on a bounded pool
+# and Qdrant is called with the shared async client
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='search')
+# An invalid image or an unknown image id only fails its own query
+batcher = MicroBatcher(search_queries, max_batch_size=32, max_wait_ms=5, num_workers=SEARCH_WORKERS,
+                       max_queue_size=SEARCH_QUEUE_SIZE, retry_after=SEARCH_RETRY_AFTER,
+                       item_errors=(ValueError, PointNotFoundError))
+
+# Expose the caches and queue statistics on /metrics
+REGISTRY.add_collector(collect_service_metrics)
+
+
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    # Count requests and measure their latency, the handlers add their stages to the timer
+    request.state.timer = StageTimer()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        route = getattr(request.scope.get('route'), 'path', None)
+        if route is None:
+            route = 'static' if request.url.path.startswith(('/images/', '/thumbnails/')) else 'other'
+        REQUESTS.inc(route=route, method=request.method, status=status)
+        REQUEST_LATENCY.observe(elapsed, route=route, method=request.method)
+
+    if SEARCH_TIMING_HEADER:
+        response.headers['Server-Timing'] = request.state.timer.server_timing(elapsed)
+    return response
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(status_code=503, content={'detail': str(exc)},
+                        headers={'Retry-After': str(exc.retry_after)})
+
+
+@app.exception_handler(PointNotFoundError)
+async def point_not_found_handler(request: Request, exc: PointNotFoundError):
+    return JSONResponse(status_code=404, content={'detail': str(exc)})
 
 
 # Define the root path to show the search form
@@ -28,22 +323,18 @@ async def show_search_form(request: Request):
 
 @app.post("/api/search", response_class=HTMLResponse)
 async def create_item(request: Request):
-    form_data = await request.form()
+    timer = request.state.timer
+    with timer.stage('parse_form'):
+        form_data = await request.form()
     try:
         # Transform data to Pydantic model
-        form_data_dict = dict(form_data)
-        search_text = SearchText(**form_data_dict)
+        with timer.stage('validate'):
+            form_data_dict = dict(form_data)
+            search_text = SearchText(**form_data_dict)
 
-        # Grab response from Qdrant
-        results = text2img.search(text=search_text.text)
-
-        # Form the data with images names, needed for the Jinja template and return template response
-        context = {'names': ['/' + res['path'].split('/')[-1] for res in results],
-                   'request': request
-                   }
-
-        # return zip_files(results)
-        return templates.TemplateResponse(request=request, name='images_template.html', context=context)
+        # Grab response from Qdrant and return template response
+        results = await run_search(request, Query(search_text.text, limit=5))
+        return render_results(request, results)
 
     except ValueError as e:
         context = {
@@ -53,6 +344,156 @@ async def create_item(request: Request):
         return templates.TemplateResponse("form_template.html", context)
 
 
+@app.get("/similar/{image_id}", response_class=HTMLResponse)
+async def show_similar(request: Request, image_id: UUID):
+    # Point ids are UUIDs, stored in their canonical lowercase form
+    image_id = str(image_id)
+
+    async def render():
+        # The stored vector of the image is looked up, the image itself is not shown again
+        results = await run_search(request, Query(limit=5, image_id=image_id))
+        with request.state.timer.stage('render'):
+            return render_page(results)
+
+    # Browsers revalidate the page with its ETag, it is searched again only when the index changed
+    return await responses.respond(request, search_etag('similar', image_id), render, HTML_MEDIA_TYPE)
+
+
+@app.get("/api/search")
+async def search_json(request: Request,
+                      text: str,
+                      limit: int = 5,
+                      offset: int = 0,
+                      diversity: Optional[float] = None):
+    params = search_query_params(text=text, limit=limit, offset=offset, diversity=diversity)
+    # Queries differing only by case or spacing have the same results, hence the same ETag and body
+    normalized = text2img.normalize(params.text)
+
+    async def render():
+        results = await run_search(request, Query(params.text, limit=params.limit, offset=params.offset,
+                                                  diversity=params.diversity))
+        with request.state.timer.stage('render'):
+            return orjson.dumps({'query': normalized, 'results': [to_api_result(res) for res in results]},
+                                option=orjson.OPT_SERIALIZE_NUMPY)
+
+    etag = search_etag('search', normalized, params.limit, params.offset, params.diversity)
+    return await responses.respond(request, etag, render, 'application/json')
+
+
+@app.post("/api/search/batch", response_model=SearchBatchResult)
+async def search_batch(request: Request, search_batch: SearchBatch):
+    # Filters, offset and payload selection are applied by the index during the search
+    query_filter = to_search_filter(search_batch.filters)
+    with_payload = search_batch.with_payload if isinstance(search_batch.with_payload, bool) \
+        else tuple(search_batch.with_payload)
+
+    # Queries are submitted together, so they end up in the same micro-batch
+    results = await asyncio.gather(*[run_search(request, Query(text, limit=search_batch.limit,
+                                                               offset=search_batch.offset, query_filter=query_filter,
+                                                               with_payload=with_payload,
+                                                               diversity=search_batch.diversity))
+                                     for text in search_batch.texts])
+
+    return SearchBatchResult(results=results)
+
+
+@app.get("/api/search/similar/{image_id}", response_model=SearchResult)
+async def search_similar(request: Request,
+                         image_id: UUID,
+                         text: Optional[str] = None,
+                         text_weight: float = 0.5,
+                         limit: int = 5,
+                         offset: int = 0):
+    params = search_similar_params(text=text, text_weight=text_weight, limit=limit, offset=offset)
+
+    # "More like this": the stored vector of the image is looked up, optionally mixed with the text
+    results = await run_search(request, Query(params.text, limit=params.limit, offset=params.offset,
+                                              image_id=str(image_id), text_weight=params.text_weight))
+    return SearchResult(results=results)
+
+
+@app.post("/api/search/image", response_model=SearchResult)
+async def search_image(request: Request,
+                       image: UploadFile,
+                       text: Optional[str] = Form(None),
+                       text_weight: float = Form(0.5),
+                       limit: int = Form(5),
+                       offset: int = Form(0)):
+    params = search_similar_params(text=text, text_weight=text_weight, limit=limit, offset=offset)
+    data = await image.read(SEARCH_MAX_IMAGE_BYTES + 1)
+    if len(data) > SEARCH_MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"The image must not exceed {SEARCH_MAX_IMAGE_BYTES} bytes")
+
+    # The uploaded image is decoded and encoded on the worker pool, with the other queries of its batch
+    try:
+        results = await run_search(request, Query(params.text, limit=params.limit, offset=params.offset, image=data,
+                                                  text_weight=params.text_weight))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return SearchResult(results=results)
+
+
+@app.post("/api/recommend", response_model=SearchResult)
+async def recommend(request: Request, recommend: Recommend):
+    with_payload = recommend.with_payload if isinstance(recommend.with_payload, bool) \
+        else tuple(recommend.with_payload)
+    positive, negative = [str(i) for i in recommend.positive], [str(i) for i in recommend.negative]
+
+    # The examples are looked up by the index, a single call
+    with request.state.timer.stage('recommend'):
+        results = await asyncio.get_running_loop().run_in_executor(
+            search_executor, partial(text2img.recommend, positive, negative, limit=recommend.limit,
+                                     offset=recommend.offset, query_filter=to_search_filter(recommend.filters),
+                                     with_payload=with_payload))
+    return SearchResult(results=results)
+
+
+@app.get("/api/search/export")
+async def export_search(request: Request, text: str, limit: int = 100):
+    try:
+        search_export = SearchExport(text=text, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    # Search goes through the worker pool, the archive is then streamed while the images are read
+    results = await run_search(request, Query(search_export.text, limit=search_export.limit, with_payload=('path',)))
+
+    return StreamingResponse(stream_zip([res['path'] for res in results]), media_type='application/zip',
+                             headers={'Content-Disposition': 'attachment; filename="images.zip"'})
+
+
+@app.get("/health/live")
+async def liveness():
+    # The process is up and serving requests
+    return {'status': 'alive'}
+
+
+@app.get("/health/ready")
+async def readiness():
+    # The text encoder is loaded and the index answered a first query
+    if not text2img.ready:
+        return JSONResponse(status_code=503, content={'status': 'warming up'})
+    return {'status': 'ready'}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get("/api/queue")
+async def queue_stats():
+    # Queue depth and wait times of the search worker pool
+    return batcher.stats()
+
+
+@app.get("/api/cache")
+async def cache_stats():
+    # Hit/miss counters of the query embedding, search result and response caches
+    return all_cache_stats()
+
+
 if __name__ == "__main__":
     import uvicorn
 
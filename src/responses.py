@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import Request
+from fastapi.responses import Response
+from utils.cache import TTLCache
+
+try:
+    import brotli
+except ImportError:
+    # Optional dependency, responses are only gzip-compressed without it
+    brotli = None
+
+
+# Bodies smaller than this are sent as is, compressing them does not pay off
+MIN_COMPRESS_SIZE = 500
+
+
+def make_etag(*parts) -> str:
+    """
+    Strong ETag of a response, derived from everything the response depends on
+    """
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest()[:32] + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Whether the client already has the response with this ETag, from its If-None-Match header
+    """
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+    return '*' in tags or etag in tags
+
+
+def accepted_encoding(request: Request) -> Optional[str]:
+    """
+    Content coding of the response from the Accept-Encoding header: 'br' if brotli is installed, else 'gzip'
+    Returns: None if the client accepts neither of them
+    """
+    weights = {}
+    for item in request.headers.get('accept-encoding', '').split(','):
+        coding, _, params = item.partition(';')
+        params = params.strip()
+        try:
+            weights[coding.strip().lower()] = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            weights[coding.strip().lower()] = 0.0
+
+    for coding in ('br', 'gzip') if brotli is not None else ('gzip',):
+        if weights.get(coding, weights.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    """
+    Compress a body with a content coding, None leaves it as is
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def encoded_response(request: Request,
+                     body: bytes,
+                     media_type: str,
+                     headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Response compressed with the best content coding accepted by the client
+    Args:
+        request: request answered
+        body: uncompressed body
+        media_type: media type of the body
+        headers: other response headers
+
+    Returns: the response
+    """
+    headers = {**(headers or {}), 'Vary': 'Accept-Encoding'}
+    encoding = accepted_encoding(request) if len(body) >= MIN_COMPRESS_SIZE else None
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(compress(body, encoding), media_type=media_type, headers=headers)
+
+
+class CachedResponses:
+    """
+    Responses answered by ETag: a client sending back the ETag of its copy gets a 304 without any work, and the
+    encoded bodies are cached, so that a repeated request is neither searched, rendered nor compressed again.
+    The ETag has to be derived from everything the response depends on, e.g. the query and the index version.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0, cache_control: str = 'no-cache'):
+        """
+        Args:
+            maxsize: maximum number of cached bodies
+            ttl: lifetime in seconds of a cached body
+            cache_control: Cache-Control header, 'no-cache' lets clients keep the response but revalidate it
+        """
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.cache_control = cache_control
+
+    async def respond(self,
+                      request: Request,
+                      etag: str,
+                      render: Callable[[], Awaitable[bytes]],
+                      media_type: str) -> Response:
+        """
+        Answer a request with a cached body, or with the body rendered by `render`
+        Args:
+            request: request answered
+            etag: ETag of the response
+            render: coroutine function computing the uncompressed body
+            media_type: media type of the body
+
+        Returns: the response, 304 if the client has it already
+        """
+        headers = {'ETag': etag, 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        # Bodies are cached uncompressed, to answer other content codings without rendering again, and encoded
+        encoding = accepted_encoding(request)
+        cached = self.cache.get((etag, encoding))
+        if cached is None:
+            raw = self.cache.get((etag,))
+            if raw is None:
+                raw = await render()
+                self.cache.set((etag,), raw)
+            body_encoding = encoding if len(raw) >= MIN_COMPRESS_SIZE else None
+            cached = (compress(raw, body_encoding), body_encoding)
+            self.cache.set((etag, encoding), cached)
+
+        body, body_encoding = cached
+        if body_encoding is not None:
+            headers['Content-Encoding'] = body_encoding
+        return Response(body, media_type=media_type, headers=headers)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns: statistics of the cached bodies
+        """
+        return self.cache.stats()
@@ -1,4 +1,16 @@
-from pydantic import BaseModel, field_validator
+from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
+from pydantic import BaseModel, Field, field_validator
+
+
+def check_search_text(v: str) -> str:
+    """
+    Validates that a search text is not empty and contains only letters and spaces
+    """
+    res = v.strip() and all(c.isalpha() or c.isspace() for c in v)
+    if not res:
+        raise ValueError('The search text must not be empty and contain only letters and spaces')
+    return v
 
 
 class SearchText(BaseModel):
@@ -7,7 +19,83 @@ class SearchText(BaseModel):
     @field_validator('text')
     @classmethod
     def check_text(cls, v: str) -> str:
-        res = v.strip() and all(c.isalpha() or c.isspace() for c in v)
-        if not res:
-            raise ValueError('The search text must not be empty and contain only letters and spaces')
-        return v
+        return check_search_text(v)
+
+
+class SearchFilters(BaseModel):
+    min_width: Optional[int] = Field(default=None, ge=1)
+    min_height: Optional[int] = Field(default=None, ge=1)
+    min_aspect_ratio: Optional[float] = Field(default=None, gt=0)
+    max_aspect_ratio: Optional[float] = Field(default=None, gt=0)
+    formats: Optional[List[str]] = Field(default=None, min_length=1)
+
+    @field_validator('formats')
+    @classmethod
+    def check_formats(cls, v: Optional[List[str]]) -> Optional[List[str]]:
+        # Formats are stored as PIL names, e.g. 'JPEG' or 'PNG'
+        return [f.upper() for f in v] if v is not None else v
+
+
+class SearchBatch(BaseModel):
+    texts: List[str] = Field(min_length=1, max_length=256)
+    limit: int = Field(default=5, ge=1, le=100)
+    offset: int = Field(default=0, ge=0, le=10000)
+    filters: Optional[SearchFilters] = None
+    with_payload: Union[bool, List[str]] = True
+    diversity: Optional[float] = Field(default=None, ge=0, le=1)
+
+    @field_validator('texts')
+    @classmethod
+    def check_texts(cls, v: List[str]) -> List[str]:
+        return [check_search_text(text) for text in v]
+
+
+class SearchQuery(BaseModel):
+    text: str
+    limit: int = Field(default=5, ge=1, le=100)
+    offset: int = Field(default=0, ge=0, le=10000)
+    diversity: Optional[float] = Field(default=None, ge=0, le=1)
+
+    @field_validator('text')
+    @classmethod
+    def check_text(cls, v: str) -> str:
+        return check_search_text(v)
+
+
+class SearchExport(BaseModel):
+    text: str
+    limit: int = Field(default=100, ge=1, le=1000)
+
+    @field_validator('text')
+    @classmethod
+    def check_text(cls, v: str) -> str:
+        return check_search_text(v)
+
+
+class SearchSimilar(BaseModel):
+    text: Optional[str] = None
+    text_weight: float = Field(default=0.5, ge=0, le=1)
+    limit: int = Field(default=5, ge=1, le=100)
+    offset: int = Field(default=0, ge=0, le=10000)
+
+    @field_validator('text')
+    @classmethod
+    def check_text(cls, v: Optional[str]) -> Optional[str]:
+        return check_search_text(v) if v is not None else v
+
+
+class Recommend(BaseModel):
+    positive: List[UUID] = Field(min_length=1, max_length=64)
+    negative: List[UUID] = Field(default_factory=list, max_length=64)
+    limit: int = Field(default=5, ge=1, le=100)
+    offset: int = Field(default=0, ge=0, le=10000)
+    filters: Optional[SearchFilters] = None
+    with_payload: Union[bool, List[str]] = True
+
+
+class SearchResult(BaseModel):
+    results: List[Dict[str, Any]]
+
+
+class SearchBatchResult(BaseModel):
+    results: List[List[Dict[str, Any]]]
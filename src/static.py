@@ -0,0 +1,20 @@
+from fastapi.staticfiles import StaticFiles
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    Static files sent with a Cache-Control header, on top of the ETag and Last-Modified headers
+    which let browsers revalidate them with a 304 response
+    """
+    def __init__(self, *args, cache_control: str = 'public, max-age=86400', **kwargs):
+        """
+        Args:
+            cache_control: value of the Cache-Control header
+        """
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers['Cache-Control'] = self.cache_control
+        return response
@@ -0,0 +1,191 @@
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import Executor
+import numpy as np
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a request is submitted while the queue of pending requests is full
+    """
+    def __init__(self, retry_after: int = 1):
+        super().__init__("The search queue is full, retry later")
+        self.retry_after = retry_after
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for a few milliseconds and processes them with a single call.
+    Batches run on a bounded worker pool, so the event loop is never blocked by them, and requests
+    are rejected with `QueueFullError` once too many of them wait for a worker.
+    """
+    def __init__(self,
+                 batch_fn: Callable[[List[Any]], Union[List[Any], Awaitable[List[Any]]]],
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0,
+                 executor: Optional[Executor] = None,
+                 num_workers: int = 1,
+                 max_queue_size: int = 256,
+                 retry_after: int = 1,
+                 item_errors: Tuple[type, ...] = ()):
+        """
+        Args:
+            batch_fn: function mapping a list of items to the list of their results, in the same order.
+                A coroutine function is awaited on the loop, a regular function runs on `executor`
+            max_batch_size: maximum number of items processed in one call
+            max_wait_ms: maximum time to wait for more items after the first one arrived
+            executor: executor running `batch_fn`, the loop default executor if None
+            num_workers: maximum number of batches processed at the same time
+            max_queue_size: maximum number of items waiting for a worker
+            retry_after: seconds suggested to rejected clients before retrying
+            item_errors: errors caused by a single item, e.g. an invalid input. A batch failing with one of them
+                is run again item by item, so that only the faulty items fail
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self.item_errors = item_errors
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.tasks = set()
+
+        # Queue statistics
+        self.pending = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=1024)
+
+    def start(self):
+        """
+        Start the background task collecting the batches, must be called from the running loop
+        """
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.num_workers)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queue one item and wait for its result
+        Args:
+            item: input of `batch_fn`
+
+        Returns: result of `batch_fn` for this item
+
+        """
+        if self.pending >= self.max_queue_size:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        self.queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Queue depth and wait time statistics, wait times are measured over the last 1024 requests
+        Returns: mapping between statistic name and value
+        """
+        waits = np.array(self.wait_times) * 1000 if self.wait_times else np.zeros(1)
+        return {
+            'queue_depth': self.pending,
+            'max_queue_size': self.max_queue_size,
+            'in_flight_batches': self.in_flight,
+            'num_workers': self.num_workers,
+            'rejected': self.rejected,
+            'wait_ms_mean': float(waits.mean()),
+            'wait_ms_p50': float(np.percentile(waits, 50)),
+            'wait_ms_p99': float(np.percentile(waits, 99)),
+        }
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future, float]]:
+        """
+        Wait for a first item, then gather more until the batch is full or the wait time expired
+        """
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+
+            # Wait for a free worker, requests keep queueing meanwhile
+            await self.slots.acquire()
+            task = asyncio.create_task(self._process(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _process(self, batch: List[Tuple[Any, asyncio.Future, float]]):
+        start = time.perf_counter()
+        self.pending -= len(batch)
+        self.wait_times.extend(start - submitted for _, _, submitted in batch)
+
+        # Skip requests whose client already went away
+        batch = [(item, future) for item, future, _ in batch if not future.done()]
+        if not batch:
+            self.slots.release()
+            return
+
+        self.in_flight += 1
+        try:
+            outcomes = await self._run_batch([item for item, _ in batch])
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+        for (_, future), (error, result) in zip(batch, outcomes):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _run_batch(self, items: List[Any]) -> List[Tuple[Optional[Exception], Any]]:
+        """
+        Returns: error and result of each item
+        """
+        try:
+            if asyncio.iscoroutinefunction(self.batch_fn):
+                results = await self.batch_fn(items)
+            else:
+                results = await asyncio.get_running_loop().run_in_executor(self.executor, self.batch_fn, items)
+            return [(None, result) for result in results]
+        except Exception as e:
+            if len(items) == 1 or not isinstance(e, self.item_errors):
+                return [(e, None)] * len(items)
+
+        # Find the faulty items, the others still get their results
+        return [(await self._run_batch([item]))[0] for item in items]
@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+# File written by the preparation pipeline every time the collection changes
+INDEX_VERSION_FILE = 'index_version'
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire `ttl` seconds after being stored
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0):
+        """
+        Args:
+            maxsize: maximum number of entries, the least recently used one is evicted first
+            ttl: lifetime of an entry in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get an entry and mark it as recently used
+        Args:
+            key: key of the entry
+
+        Returns: the stored value, None if it is missing or expired
+
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store an entry, evicting the least recently used one if the cache is full
+        Args:
+            key: key of the entry
+            value: value of the entry
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns: size of the cache and hit/miss counters
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+def write_index_version(dir_path: str):
+    """
+    Mark the collection as changed, so that the services drop their cached search results
+    Args:
+        dir_path: directory of the resources
+    """
+    version_path = os.path.join(dir_path, INDEX_VERSION_FILE)
+    tmp_path = version_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(str(time.time_ns()))
+    os.replace(tmp_path, version_path)
+
+
+def read_index_version(dir_path: str) -> Optional[str]:
+    """
+    Read the version of the collection
+    Args:
+        dir_path: directory of the resources
+
+    Returns: the version, None if the collection was never built
+
+    """
+    version_path = os.path.join(dir_path, INDEX_VERSION_FILE)
+    try:
+        with open(version_path, 'r') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
@@ -1,13 +1,56 @@
-import shutil
 import os
+import json
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 from PIL import Image
+from typing import Dict, List, Optional, Tuple
 from jinja2 import Environment, FileSystemLoader
-from .utils import build_image_embeddings, update_db_collection, download_and_extract, specs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .utils import build_image_embeddings, update_db_collection, specs
+from .dedup import DUPLICATES_FILE, find_duplicates, load_duplicates, read_perceptual_hash, save_duplicates
+from .embeddings import EMBEDDINGS_FILE
+from .profiling import PipelineProfiler, compare_profiles
+from .download import download_and_extract
+from .thumbnails import build_thumbnails
+from .manifest import (load_manifest, save_manifest, scan_manifest, file_digest, load_pending_delta,
+                       save_pending_delta)
+
+
+# URLs of the zip files to download
+DATA_URLS = ['https://storage.googleapis.com/ads-dataset/subfolder-0.zip',
+             'https://storage.googleapis.com/ads-dataset/subfolder-1.zip']
+
+
+# Stages of the preparation pipeline, in their running order
+STAGES = ['get_data', 'scan_changes', 'store_image_info', 'create_report', 'create_thumbnails', 'build_embeddings',
+          'find_duplicates', 'update_collection', 'save_state']
+
+# Columns of the image information file, the perceptual hash is only computed by the deduplication
+HEADER_COLUMNS = ['path', 'width', 'height', 'file_size', 'format', 'mode', 'hash']
+IMAGE_INFO_COLUMNS = HEADER_COLUMNS + ['phash', 'area', 'aspect_ratio']
+
+
+def read_image_info(im_path: str, file_hash: Optional[str] = None) -> Optional[Tuple]:
+    """
+    Reads the information of an image from its header, the pixels are not decoded
+    Args:
+        im_path: path of the image
+        file_hash: content hash of the file, computed if not given
+
+    Returns:
+        None for unreadable images, otherwise tuple of path, width, height, file size, format, mode and hash
+    """
+    try:
+        with Image.open(im_path) as im:
+            w, h = im.size
+            im_format, mode = im.format, im.mode
+    except Exception:
+        return None
+
+    return im_path, w, h, os.path.getsize(im_path), im_format, mode, file_hash or file_digest(im_path)
 
 
 class Preparator:
@@ -16,7 +59,24 @@ class Preparator:
                  docs_path: str = 'resources',
                  collection_name: str = 'images',
                  m: int = 16,
-                 ef_construct: int = 100
+                 ef_construct: int = 100,
+                 batch_size: int = 32,
+                 num_workers: Optional[int] = None,
+                 backend: str = 'qdrant',
+                 quantization: Optional[str] = None,
+                 on_disk: bool = False,
+                 data_urls: Optional[List[str]] = None,
+                 checksums: Optional[Dict[str, str]] = None,
+                 thumbnails_path: str = 'thumbnails',
+                 thumbnail_size: int = 384,
+                 thumbnail_format: str = 'webp',
+                 keep_versions: int = 2,
+                 dedup: bool = True,
+                 dedup_max_distance: int = 6,
+                 dedup_min_similarity: float = 0.95,
+                 profile: bool = False,
+                 profile_stage: Optional[str] = None,
+                 profiler: str = 'cprofile'
                  ):
         """
         Args:
@@ -25,6 +85,23 @@ class Preparator:
             collection_name: name of the collection for image embeddings
             m: number of edges per node during the index building
             ef_construct: number of neighbours to consider during the index building
+            batch_size: number of images encoded at once when building the embeddings
+            num_workers: number of workers decoding images, defaults to the number of CPUs
+            backend: vector index backend, one of 'qdrant', 'numpy' (in-process exact) or 'hnsw' (in-process ANN)
+            quantization: None, 'scalar' (int8) or 'product' quantization of the vectors in the collection
+            on_disk: keep the original vectors of the collection on disk instead of RAM
+            data_urls: URLs of the zip archives with the images
+            checksums: mapping between archive URL and its expected SHA-256
+            thumbnails_path: Path to the directory of the thumbnails shown in the search results
+            thumbnail_size: maximum width and height of the thumbnails
+            thumbnail_format: 'webp' or 'jpeg'
+            keep_versions: number of versions of the collection kept after a rebuild, including the served one
+            dedup: collapse near-duplicate images into a single point of the collection
+            dedup_max_distance: maximum number of differing bits between the perceptual hashes of duplicates
+            dedup_min_similarity: minimum cosine similarity between the embeddings of duplicates
+            profile: record the wall time, CPU time, peak memory and throughput of each stage
+            profile_stage: stage profiled with `profiler`, enables `profile`
+            profiler: 'cprofile' or 'pyinstrument'
 
         """
         self.imgs_path = imgs_path
@@ -32,54 +109,140 @@ class Preparator:
         self.collection_name = collection_name
         self.m = m
         self.ef_construct = ef_construct
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.backend = backend
+        self.quantization = quantization
+        self.on_disk = on_disk
+        self.data_urls = data_urls or DATA_URLS
+        self.checksums = checksums or {}
+        self.thumbnails_path = thumbnails_path
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_format = thumbnail_format
+        self.keep_versions = keep_versions
+        self.dedup = dedup
+        self.dedup_max_distance = dedup_max_distance
+        self.dedup_min_similarity = dedup_min_similarity
         self.im_df = None
-
-    def run(self):
-        self.get_data()
-        self.im_df = self.store_image_info()
-        self.create_report()
-        self.build_embeddings()
-        self.update_collection()
+        self.manifest_path = os.path.join(self.docs_path, 'manifest.json')
+        self.manifest = {}
+        self.changes = {'added': [], 'changed': [], 'removed': []}
+        self.rebuild = False
+        self.upserted_paths = None
+        self.deleted_paths = []
+        self.pending_path = os.path.join(self.docs_path, 'pending_delta.json')
+        self.duplicates_path = os.path.join(self.docs_path, DUPLICATES_FILE)
+        self.duplicates = {}
+        if profile_stage is not None and profile_stage not in STAGES:
+            raise ValueError(f"Unknown stage '{profile_stage}', expected one of {STAGES}")
+        self.profiler = PipelineProfiler(profile, os.path.join(self.docs_path, 'profile'), profile_stage, profiler)
+
+    def run(self, full_rebuild: bool = False):
+        """
+        Runs the data preparation pipeline, only new or changed images are embedded and uploaded.
+        Args:
+            full_rebuild: re-embed all images and re-create the collection
+        """
+        with self.profiler.stage('get_data'):
+            self.get_data()
+        with self.profiler.stage('scan_changes') as stage:
+            self.scan_changes(full_rebuild)
+            stage.items = len(self.manifest)
+        with self.profiler.stage('store_image_info') as stage:
+            self.im_df = self.store_image_info()
+            stage.items = len(self.im_df)
+        with self.profiler.stage('create_report'):
+            self.create_report()
+        with self.profiler.stage('create_thumbnails') as stage:
+            self.create_thumbnails()
+            stage.items = len(self.im_df)
+        with self.profiler.stage('build_embeddings') as stage:
+            self.build_embeddings()
+            stage.items = len(self.upserted_paths)
+        with self.profiler.stage('find_duplicates') as stage:
+            self.find_duplicates()
+            stage.items = len(self.im_df)
+        with self.profiler.stage('update_collection') as stage:
+            stage.items = self.update_collection()
+        with self.profiler.stage('save_state'):
+            self.save_duplicates()
+            self.save_manifest()
+
+        if self.profiler.enabled:
+            self.save_profile()
 
     def get_data(self):
         """
         Store images locally.
+        Archives are downloaded concurrently and extracted while they download, an interrupted
+        download is resumed on the next run.
         """
 
-        if os.path.isdir(self.imgs_path):
+        download_dir = os.path.join(self.docs_path, 'downloads')
+        if os.path.isdir(self.imgs_path) and not os.path.isdir(download_dir):
             images = os.listdir(self.imgs_path)
             if len(images) > 0:
                 print("Data was already obtained.")
                 return
 
-        # URLs of the zip files to download
-        urls = ['https://storage.googleapis.com/ads-dataset/subfolder-0.zip',
-                'https://storage.googleapis.com/ads-dataset/subfolder-1.zip']
-
-        # Create the target directory if it doesn't exist
-        if not os.path.exists(self.imgs_path):
-            os.makedirs(self.imgs_path)
+        # Create the target directories if they don't exist
+        os.makedirs(self.imgs_path, exist_ok=True)
+        os.makedirs(download_dir, exist_ok=True)
 
         # Download and extract each zip file
         print("Downloading data...")
-        for url in tqdm(urls):
-            download_and_extract(url, extract_to=self.imgs_path)
+        with ThreadPoolExecutor(max_workers=len(self.data_urls)) as executor:
+            futures = [executor.submit(download_and_extract, url, self.imgs_path, download_dir,
+                                       self.checksums.get(url), position=i)
+                       for i, url in enumerate(self.data_urls)]
+            for future in futures:
+                future.result()
         print("Finished")
 
-        # Copy extracted files to the target directory
-        print("Organising data...")
-        for folder in ['0', '1']:
-            src_path = os.path.join(self.imgs_path, folder)
-            for filename in os.listdir(src_path):
-                shutil.move(os.path.join(src_path, filename), self.imgs_path)
+    def scan_changes(self, full_rebuild: bool = False):
+        """
+        Compares the images directory with the manifest of the last run to find added, changed and removed images.
+        Args:
+            full_rebuild: consider all images as changed
+        """
 
-            # Remove the old directory
-            shutil.rmtree(src_path)
-        print("Finished")
+        if not os.path.exists(self.docs_path):
+            os.makedirs(self.docs_path)
+
+        old_manifest = {} if full_rebuild else load_manifest(self.manifest_path)
+
+        print("Scanning images for changes...")
+        all_paths = self.list_images()
+        self.manifest, self.changes = scan_manifest(all_paths, old_manifest, self.num_workers)
+
+        # Without a manifest we cannot trust the existing points, so everything is rebuilt
+        self.rebuild = not old_manifest
+        if full_rebuild:
+            self.changes['changed'] = all_paths
+
+        print(f"Found {len(self.changes['added'])} new, {len(self.changes['changed'])} changed "
+              f"and {len(self.changes['removed'])} removed images.")
+
+    def save_manifest(self):
+        """
+        Stores the manifest of the indexed images.
+        """
+        save_manifest(self.manifest, self.manifest_path)
+
+    def list_images(self) -> List[str]:
+        """
+        Lists the paths of the images, leaving out files of an extraction in progress
+        Returns:
+            Sorted list of paths
+        """
+        return [os.path.join(self.imgs_path, im_name) for im_name in sorted(os.listdir(self.imgs_path))
+                if not im_name.endswith('.tmp')]
 
     def store_image_info(self) -> pd.DataFrame:
         """
-        Creates a dataframe with info about images
+        Creates a dataframe with info about images, reusing the stored info of unchanged images.
+        New images are scanned on a process pool, reading only their headers. Unreadable images are recorded
+        with their content hash, and not scanned again until they change.
         Returns:
             DataFrame with all information
         """
@@ -87,42 +250,68 @@ class Preparator:
         if not os.path.exists(self.docs_path):
             os.makedirs(self.docs_path)
 
-        # Check if data already exists and return it if so
+        # Get images paths
+        all_paths = self.list_images()
+
+        # Initialize dataframe
+        imgs_df = pd.DataFrame(columns=IMAGE_INFO_COLUMNS)
+        stored_rows = 0
+
+        # Check if data already exists and reuse the rows of unchanged images
         data_info_path = os.path.join(self.docs_path, 'data_info.csv')
         if os.path.isfile(data_info_path):
             print("Image data already exists. Reading it...")
-            results_df = pd.read_csv(data_info_path)
+            # Perceptual hashes are 64 bits integers, missing for images never deduplicated
+            stored_df = pd.read_csv(data_info_path, dtype={'phash': 'Int64'})
+            stored_rows = len(stored_df)
+            if 'phash' not in stored_df.columns:
+                stored_df['phash'] = pd.array([None] * len(stored_df), dtype='Int64')
+
+            # Files written by older versions miss some columns and are scanned again
+            if set(IMAGE_INFO_COLUMNS).issubset(stored_df.columns):
+                imgs_df = stored_df[stored_df['path'].isin(all_paths) &
+                                    ~stored_df['path'].isin(self.changes['changed'])]
+
+        # Skip the images found unreadable by a previous run, unless their content changed since
+        unreadable_path = os.path.join(self.docs_path, 'unreadable_images.json')
+        unreadable = {}
+        if os.path.isfile(unreadable_path):
+            with open(unreadable_path, 'r') as file:
+                unreadable = {p: h for p, h in json.load(file).items()
+                              if h is not None and self.manifest.get(p, {}).get('hash') == h}
+
+        known_paths = set(imgs_df['path']) | set(unreadable)
+        new_paths = [p for p in all_paths if p not in known_paths]
+        if not new_paths and len(imgs_df) == stored_rows:
             print("Finished.")
-
-            return results_df
-
-        # Get images names
-        all_imgs = os.listdir(self.imgs_path)
-
-        # Initialize dataframe
-        columns_df = ['path', 'width', 'height', 'area', 'aspect_ratio']
-        imgs_df = pd.DataFrame(columns=columns_df)
-
-        print("Storing image information...")
-        for im_name in tqdm(all_imgs):
-            im_path = os.path.join(self.imgs_path, im_name)
-
-            # Read image
-            im = Image.open(im_path)
-            w, h = im.size
-
-            # Add row to dataframe
-            new_df = pd.DataFrame([[im_path, w, h, w * h, w / h]], columns=columns_df)
-            imgs_df = new_df.copy() if imgs_df.empty else pd.concat([imgs_df, new_df])
-
-        result_df = imgs_df.reset_index(drop=True)
+            return imgs_df.reset_index(drop=True)
+
+        print(f"Storing image information for {len(new_paths)} images...")
+        hashes = [self.manifest.get(p, {}).get('hash') for p in new_paths]
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            records = list(tqdm(executor.map(read_image_info, new_paths, hashes, chunksize=256),
+                                total=len(new_paths)))
+
+        # Build the frame in one step, leaving out unreadable images
+        new_df = pd.DataFrame.from_records([r for r in records if r is not None], columns=HEADER_COLUMNS)
+        if len(new_df) < len(new_paths):
+            print(f"Could not read {len(new_paths) - len(new_df)} images.")
+        unreadable.update((p, h) for p, h, r in zip(new_paths, hashes, records) if r is None)
+        with open(unreadable_path, 'w') as file:
+            json.dump(unreadable, file, indent=1, sort_keys=True)
+        new_df['phash'] = pd.array([None] * len(new_df), dtype='Int64')
+        new_df['area'] = new_df['width'] * new_df['height']
+        new_df['aspect_ratio'] = new_df['width'] / new_df['height']
+
+        result_df = pd.concat([imgs_df, new_df], ignore_index=True) if not imgs_df.empty else new_df
+        result_df = result_df[IMAGE_INFO_COLUMNS]
 
         # Save the data to file
         result_df.to_csv(data_info_path, index=False)
 
         print("Finished.")
 
-        return imgs_df.reset_index(drop=True)
+        return result_df
 
     def create_report(self):
         """
@@ -132,9 +321,10 @@ class Preparator:
         if not os.path.exists(self.docs_path):
             os.makedirs(self.docs_path)
 
-        # Check for report existence
+        # Check for report existence, the data of the report is kept to add the profile of the runs to it
         data_report_path = os.path.join(self.docs_path, 'data_report.html')
-        if os.path.isfile(data_report_path):
+        report_data_path = os.path.join(self.docs_path, 'data_report.json')
+        if os.path.isfile(data_report_path) and os.path.isfile(report_data_path):
             print("Report already created.")
             return
 
@@ -180,28 +370,153 @@ class Preparator:
             'plot_paths': [os.path.join('..', plot_path1), os.path.join('..', plot_path2)],
             'images': os.path.join('..', plot_path3)
         }
+        with open(report_data_path, 'w') as file:
+            json.dump(data, file)
+
+        self.render_report(data)
+
+        print("Finished.")
+
+    def render_report(self, data: Dict, profile: Optional[Dict] = None):
+        """
+        Writes the data report.
+        Args:
+            data: dataset statistics and plot paths
+            profile: profile of the last run, with the rows of its stages
+        """
 
         # Load Jinja2 template
         env = Environment(loader=FileSystemLoader('templates'))
         template = env.get_template('data_report_template.html')
 
         # Render the template with data
-        html_output = template.render(**data)
+        html_output = template.render(**data, profile=profile)
 
         # Write the HTML content to a file
-        with open(data_report_path, 'w') as file:
+        with open(os.path.join(self.docs_path, 'data_report.html'), 'w') as file:
             file.write(html_output)
 
+    def save_profile(self):
+        """
+        Stores the profile of the run and adds it to the data report, next to the previous profiled run.
+        """
+        report, previous = self.profiler.save()
+
+        report_data_path = os.path.join(self.docs_path, 'data_report.json')
+        if not os.path.isfile(report_data_path):
+            return
+        with open(report_data_path, 'r') as file:
+            data = json.load(file)
+        profile = {**report, 'rows': compare_profiles(report, previous),
+                   'previous_started_at': previous['started_at'] if previous else None}
+        self.render_report(data, profile)
+
+    def create_thumbnails(self):
+        """
+        Creates the thumbnails shown in the search results, only for new and changed images
+        """
+        print("Creating thumbnails...")
+        failed = build_thumbnails(list(self.im_df['path']), self.thumbnails_path, size=self.thumbnail_size,
+                                  thumbnail_format=self.thumbnail_format, stale_paths=self.changes['changed'],
+                                  num_workers=self.num_workers)
+        if failed:
+            print(f"Could not create {failed} thumbnails.")
         print("Finished.")
 
     def build_embeddings(self):
         """
-        Builds image embeddings
+        Builds image embeddings for new and changed images
+        """
+        self.upserted_paths, self.deleted_paths = build_image_embeddings(self.im_df, self.docs_path,
+                                                                         batch_size=self.batch_size,
+                                                                         num_workers=self.num_workers,
+                                                                         stale_paths=self.changes['changed'])
+
+    def find_duplicates(self):
+        """
+        Groups near-duplicate images, each group is served as one point holding the list of its duplicates.
+        Images whose group changed since the last run are added to the delta of the collection.
+        """
+        old_duplicates = load_duplicates(self.duplicates_path)
+        if self.dedup:
+            self.store_perceptual_hashes()
+            print("Finding near-duplicate images...")
+            hashed_df = self.im_df[self.im_df['phash'].notna()]
+            self.duplicates = find_duplicates(hashed_df['path'].tolist(), hashed_df['phash'].to_numpy(dtype=np.int64),
+                                              hashed_df['area'].to_numpy(),
+                                              os.path.join(self.docs_path, EMBEDDINGS_FILE),
+                                              max_distance=self.dedup_max_distance,
+                                              min_similarity=self.dedup_min_similarity)
+            num_duplicates = sum(len(paths) for paths in self.duplicates.values())
+            print(f"Found {num_duplicates} duplicates of {len(self.duplicates)} images.")
+        else:
+            self.duplicates = {}
+
+        if self.rebuild:
+            return
+
+        # Points of new duplicates are deleted, former duplicates and representatives of changed groups are upserted
+        hidden = {p for paths in self.duplicates.values() for p in paths}
+        old_hidden = {p for paths in old_duplicates.values() for p in paths}
+        changed = {p for p in set(self.duplicates) | set(old_duplicates)
+                   if self.duplicates.get(p) != old_duplicates.get(p)}
+        upserted = ((old_hidden - hidden) | changed) & set(self.im_df['path'])
+        self.deleted_paths = sorted(set(self.deleted_paths) | (hidden - old_hidden))
+        self.upserted_paths = sorted((set(self.upserted_paths or []) | upserted) - hidden)
+
+    def store_perceptual_hashes(self):
+        """
+        Computes the perceptual hashes of the images which have none yet, new and changed images, on a process pool.
+        They are stored with the image information, so that unchanged images are not decoded again.
+        """
+        missing = self.im_df['phash'].isna()
+        if not missing.any():
+            return
+
+        print(f"Computing perceptual hashes of {missing.sum()} images...")
+        paths = self.im_df.loc[missing, 'path'].tolist()
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            phashes = list(tqdm(executor.map(read_perceptual_hash, paths, chunksize=256), total=len(paths)))
+        self.im_df.loc[missing, 'phash'] = pd.array(phashes, dtype='Int64')
+        self.im_df.to_csv(os.path.join(self.docs_path, 'data_info.csv'), index=False)
+
+    def save_duplicates(self):
+        """
+        Stores the groups of near-duplicates, the next run compares its groups with them.
         """
-        build_image_embeddings(self.im_df, self.docs_path)
+        save_duplicates(self.duplicates, self.duplicates_path)
 
-    def update_collection(self):
+    def update_collection(self) -> int:
         """
-        Updates Qdrant collection with the embeddings
+        Updates the vector collection with the embeddings, only the delta is upserted unless a rebuild is needed.
+        A rebuild is built into a new version of the collection, served once it passes the smoke check.
+        The delta is stored until it is applied: the embeddings file is already up to date, so the delta of a failed
+        update could not be found again by the next run.
+        Returns:
+            Number of uploaded embeddings
         """
-        update_db_collection(self.collection_name, self.docs_path, self.m, self.ef_construct)
+        # Add the delta of a previous run whose update failed, the changes of this run take precedence
+        pending = load_pending_delta(self.pending_path)
+        hidden = {p for paths in self.duplicates.values() for p in paths}
+        upserted, deleted = set(self.upserted_paths or []), set(self.deleted_paths)
+        upserted |= set(pending['upserted']) - deleted
+        deleted |= set(pending['deleted']) - upserted
+        self.upserted_paths = sorted((upserted & set(self.im_df['path'])) - hidden)
+        self.deleted_paths = sorted(deleted)
+        self.rebuild = self.rebuild or pending['rebuild']
+
+        if self.rebuild or self.upserted_paths or self.deleted_paths:
+            save_pending_delta({'rebuild': self.rebuild, 'upserted': self.upserted_paths,
+                                'deleted': self.deleted_paths}, self.pending_path)
+
+        upsert_paths = None if self.rebuild else self.upserted_paths
+        num_uploaded = update_db_collection(self.collection_name, self.docs_path, self.m, self.ef_construct,
+                                            upsert_paths=upsert_paths, delete_paths=self.deleted_paths,
+                                            backend=self.backend, quantization=self.quantization,
+                                            on_disk=self.on_disk, keep_versions=self.keep_versions,
+                                            duplicates=self.duplicates)
+
+        # The collection has the delta now
+        if os.path.isfile(self.pending_path):
+            os.remove(self.pending_path)
+        return num_uploaded
@@ -0,0 +1,180 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from typing import Dict, List, Optional, Tuple
+from .embeddings import iter_embeddings
+from .index import normalize
+
+
+# File of the groups of near-duplicates, in the resources directory
+DUPLICATES_FILE = 'duplicates.json'
+
+# Number of set bits of each byte value, to count differing bits of the hashes
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def perceptual_hash(im: Image.Image, hash_size: int = 8) -> int:
+    """
+    Difference hash of an image: each bit tells whether a pixel is brighter than its right neighbour
+    on a small grayscale grid, so that resized, re-encoded or slightly edited copies get close hashes
+    Args:
+        im: opened image, only a reduced version of it is decoded when the format allows it
+        hash_size: width and height of the grid, the hash has hash_size ** 2 bits
+
+    Returns: 64 bits hash as a signed integer, so that it fits an int64 column
+
+    """
+    im.draft('L', (hash_size * 8, hash_size * 8))
+    pixels = np.asarray(im.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).reshape(-1)
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big', signed=True)
+
+
+def read_perceptual_hash(im_path: str) -> Optional[int]:
+    """
+    Perceptual hash of an image file
+    Args:
+        im_path: path of the image
+
+    Returns: 64 bits hash as a signed integer, None for unreadable images
+
+    """
+    try:
+        with Image.open(im_path) as im:
+            return perceptual_hash(im)
+    except Exception:
+        return None
+
+
+def hamming_pairs(hashes: np.ndarray, max_distance: int, block_size: int = 2048) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the pairs of hashes differing by at most `max_distance` bits.
+    Hashes are compared block against block, each comparison is vectorized and memory is bounded by the block size.
+    Args:
+        hashes: 64 bits hashes
+        max_distance: maximum number of differing bits
+        block_size: number of hashes compared at once with each other block
+
+    Returns: indices of the first and second hash of each pair, the first one being lower
+
+    """
+    codes = np.ascontiguousarray(hashes, dtype=np.int64).view(np.uint8).reshape(-1, 8)
+    firsts, seconds = [], []
+    for start in range(0, len(codes), block_size):
+        block = codes[start:start + block_size]
+        for other_start in range(start, len(codes), block_size):
+            others = codes[other_start:other_start + block_size]
+            distances = POPCOUNT[block[:, None, :] ^ others[None, :, :]].sum(axis=2, dtype=np.uint8)
+            i, j = np.nonzero(distances <= max_distance)
+            i, j = i + start, j + other_start
+            firsts.append(i[i < j])
+            seconds.append(j[i < j])
+
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def group_pairs(num_items: int, firsts: np.ndarray, seconds: np.ndarray) -> List[List[int]]:
+    """
+    Merge pairs into groups of connected items with a union-find
+    Returns: groups of more than one item
+    """
+    parents = np.arange(num_items)
+
+    def root(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in zip(firsts, seconds):
+        ri, rj = root(i), root(j)
+        if ri != rj:
+            parents[max(ri, rj)] = min(ri, rj)
+
+    groups: Dict[int, List[int]] = {}
+    for i in np.unique(np.concatenate([firsts, seconds])):
+        groups.setdefault(root(i), []).append(int(i))
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(paths: List[str],
+                    hashes: np.ndarray,
+                    areas: np.ndarray,
+                    embeddings_path: str,
+                    max_distance: int = 6,
+                    min_similarity: float = 0.95,
+                    block_size: int = 2048) -> Dict[str, List[str]]:
+    """
+    Find near-duplicate images. Candidate pairs have close perceptual hashes, they are confirmed when
+    their embeddings are similar too, which rules out different images with the same layout.
+    Args:
+        paths: paths of the images
+        hashes: perceptual hash of each image
+        areas: number of pixels of each image, the largest image of a group represents it
+        embeddings_path: path of the embeddings parquet file
+        max_distance: maximum number of differing bits between the hashes of duplicates
+        min_similarity: minimum cosine similarity between the embeddings of duplicates
+        block_size: number of hashes compared at once with each other block
+
+    Returns: mapping between the representative of each group and the paths of its duplicates
+
+    """
+    paths = np.asarray(paths, dtype=object)
+    firsts, seconds = hamming_pairs(hashes, max_distance, block_size)
+    if not len(firsts):
+        return {}
+
+    # Read only the embeddings of the candidates, images without an embedding are never duplicates
+    candidates = np.unique(np.concatenate([firsts, seconds]))
+    rows, vectors = {}, []
+    for meta, batch in iter_embeddings(embeddings_path, columns=[], paths=paths[candidates].tolist()):
+        offset = len(rows)
+        rows.update((p, offset + i) for i, p in enumerate(meta.column('path').to_pylist()))
+        vectors.append(normalize(batch))
+    if not rows:
+        return {}
+    vectors = np.concatenate(vectors)
+
+    embedded = np.array([p in rows for p in paths[firsts]]) & np.array([p in rows for p in paths[seconds]])
+    firsts, seconds = firsts[embedded], seconds[embedded]
+    a = np.array([rows[p] for p in paths[firsts]], dtype=np.int64)
+    b = np.array([rows[p] for p in paths[seconds]], dtype=np.int64)
+    similar = np.einsum('ij,ij->i', vectors[a], vectors[b]).reshape(-1) >= min_similarity
+
+    duplicates = {}
+    for group in group_pairs(len(paths), firsts[similar], seconds[similar]):
+        # Keep the largest image, the first path breaks ties so that the choice is stable between runs
+        group = sorted(group, key=lambda i: (-areas[i], paths[i]))
+        duplicates[paths[group[0]]] = sorted(paths[i] for i in group[1:])
+    return duplicates
+
+
+def load_duplicates(path: str) -> Dict[str, List[str]]:
+    """
+    Read the groups of near-duplicates found by the last run
+    Args:
+        path: path of the duplicates json file
+
+    Returns: mapping between representative and duplicates paths, empty if there is no file
+
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_duplicates(duplicates: Dict[str, List[str]], path: str):
+    """
+    Atomically write the groups of near-duplicates
+    Args:
+        duplicates: mapping between representative and duplicates paths
+        path: path of the duplicates json file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(duplicates, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
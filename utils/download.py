@@ -0,0 +1,287 @@
+import os
+import zlib
+import base64
+import struct
+import hashlib
+import requests
+from typing import Optional
+from tqdm import tqdm
+
+
+# Signatures of the zip records
+LOCAL_HEADER = b'PK\x03\x04'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+CENTRAL_DIRECTORY = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06', b'PK\x06\x07')
+
+
+class ZipStreamExtractor:
+    """
+    Extracts a zip archive from a stream of bytes, using only the local file headers, so that
+    files are written while the archive is still being downloaded. Directories are flattened,
+    every file is written directly in `extract_to`.
+    """
+    def __init__(self, extract_to: str):
+        """
+        Args:
+            extract_to: directory where the files are extracted
+        """
+        self.extract_to = extract_to
+        self.buffer = bytearray()
+        self.state = 'header'
+        self.entry = None
+        self.num_files = 0
+
+    def feed(self, data: bytes):
+        """
+        Extract everything that can be extracted with the bytes received so far
+        Args:
+            data: next bytes of the archive
+        """
+        self.buffer += data
+        while self.state != 'done':
+            if self.state == 'header' and not self._read_header():
+                break
+            if self.state == 'data' and not self._read_data():
+                break
+            if self.state == 'descriptor' and not self._read_descriptor():
+                break
+
+    def close(self):
+        """
+        Check that the archive was complete
+        """
+        if self.state != 'done':
+            raise ValueError("The zip archive is truncated")
+
+    def _read_header(self) -> bool:
+        if len(self.buffer) < 4:
+            return False
+        signature = bytes(self.buffer[:4])
+        if signature in CENTRAL_DIRECTORY:
+            # All the files were extracted, the rest is the central directory
+            self.state = 'done'
+            return True
+        if signature != LOCAL_HEADER:
+            raise ValueError("Invalid zip local file header")
+        if len(self.buffer) < 30:
+            return False
+
+        _, _, flags, method, _, _, crc, csize, usize, name_len, extra_len = struct.unpack(
+            '<IHHHHHIIIHH', self.buffer[:30])
+        if len(self.buffer) < 30 + name_len + extra_len:
+            return False
+        name = bytes(self.buffer[30:30 + name_len]).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = bytes(self.buffer[30 + name_len:30 + name_len + extra_len])
+        del self.buffer[:30 + name_len + extra_len]
+
+        # Zip64 sizes are stored in the extra field
+        zip64 = csize == 0xFFFFFFFF or usize == 0xFFFFFFFF
+        pos = 0
+        while pos + 4 <= len(extra):
+            field_id, field_len = struct.unpack('<HH', extra[pos:pos + 4])
+            if field_id == 0x0001 and zip64 and field_len >= 16:
+                usize, csize = struct.unpack('<QQ', extra[pos + 4:pos + 20])
+            pos += 4 + field_len
+
+        if method not in (0, 8):
+            raise ValueError(f"Unsupported zip compression method {method} for '{name}'")
+        has_descriptor = bool(flags & 0x08)
+        if has_descriptor and method == 0:
+            raise ValueError(f"Cannot stream the stored entry '{name}' without its size")
+
+        # Directories and metadata entries are skipped, files are written next to each other
+        basename = os.path.basename(name)
+        skip = name.endswith('/') or not basename or name.startswith('__MACOSX')
+        path = os.path.join(self.extract_to, basename)
+
+        self.entry = {
+            'path': path,
+            'tmp_path': path + '.tmp',
+            'file': None if skip else open(path + '.tmp', 'wb'),
+            'method': method,
+            'crc': crc,
+            'remaining': None if has_descriptor else csize,
+            'has_descriptor': has_descriptor,
+            'zip64': zip64,
+            'decompressor': zlib.decompressobj(-15) if method == 8 else None,
+            'computed_crc': 0,
+        }
+        self.state = 'data'
+        return True
+
+    def _write(self, data: bytes):
+        entry = self.entry
+        if entry['decompressor'] is not None:
+            data = entry['decompressor'].decompress(data)
+        entry['computed_crc'] = zlib.crc32(data, entry['computed_crc'])
+        if entry['file'] is not None:
+            entry['file'].write(data)
+
+    def _read_data(self) -> bool:
+        entry = self.entry
+        if not self.buffer:
+            return False
+
+        if entry['remaining'] is not None:
+            # The compressed size is known from the header
+            chunk = bytes(self.buffer[:entry['remaining']])
+            del self.buffer[:len(chunk)]
+            entry['remaining'] -= len(chunk)
+            self._write(chunk)
+            if entry['remaining'] > 0:
+                return False
+            if entry['decompressor'] is not None:
+                self._write_tail()
+            self.state = 'descriptor' if entry['has_descriptor'] else 'header'
+            if not entry['has_descriptor']:
+                self._finish_entry(entry['crc'])
+            return True
+
+        # Otherwise the end of the deflate stream tells where the entry ends
+        decompressor = entry['decompressor']
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        self._write(chunk)
+        if not decompressor.eof:
+            return False
+        self.buffer[:0] = decompressor.unused_data
+        self._write_tail()
+        self.state = 'descriptor'
+        return True
+
+    def _write_tail(self):
+        data = self.entry['decompressor'].flush()
+        self.entry['computed_crc'] = zlib.crc32(data, self.entry['computed_crc'])
+        if self.entry['file'] is not None:
+            self.entry['file'].write(data)
+
+    def _read_descriptor(self) -> bool:
+        size_len = 8 if self.entry['zip64'] else 4
+        has_signature = bytes(self.buffer[:4]) == DATA_DESCRIPTOR
+        length = (4 if has_signature else 0) + 4 + 2 * size_len
+        if len(self.buffer) < length:
+            return False
+        offset = 4 if has_signature else 0
+        crc = struct.unpack('<I', self.buffer[offset:offset + 4])[0]
+        del self.buffer[:length]
+        self._finish_entry(crc)
+        self.state = 'header'
+        return True
+
+    def _finish_entry(self, crc: int):
+        entry = self.entry
+        if entry['file'] is not None:
+            entry['file'].close()
+            if entry['computed_crc'] != crc:
+                os.remove(entry['tmp_path'])
+                raise ValueError(f"CRC mismatch when extracting '{entry['path']}'")
+            os.replace(entry['tmp_path'], entry['path'])
+            self.num_files += 1
+        self.entry = None
+
+
+def parse_goog_md5(headers) -> Optional[bytes]:
+    """
+    Get the MD5 of a Google Cloud Storage object from the response headers
+    Args:
+        headers: HTTP response headers
+
+    Returns: the MD5 digest, None if the server did not send it
+    """
+    for value in headers.get('x-goog-hash', '').split(','):
+        algorithm, _, digest = value.strip().partition('=')
+        if algorithm == 'md5':
+            return base64.b64decode(digest)
+    return None
+
+
+def download_and_extract(url: str,
+                         extract_to: str = '.',
+                         download_dir: str = '.',
+                         expected_sha256: Optional[str] = None,
+                         chunk_size: int = 1 << 20,
+                         retries: int = 3,
+                         position: int = 0):
+    """
+    Download a zip file from the specified URL and extract it to the given directory while it downloads.
+    The archive is kept as a '.part' file until it is complete, an interrupted download resumes from it
+    with an HTTP Range request. The checksum is verified against `expected_sha256` and, if the server sends it,
+    against the MD5 in the 'x-goog-hash' header.
+    Args:
+        url: url of the data
+        extract_to: path where to extract data
+        download_dir: path where the partial archive and the completion marker are kept
+        expected_sha256: hex SHA-256 of the archive
+        chunk_size: number of bytes read at once
+        retries: number of times the download is resumed after a connection error
+        position: position of the progress bar
+    """
+    name = url.split('/')[-1]
+    part_path = os.path.join(download_dir, name + '.part')
+    done_path = os.path.join(download_dir, name + '.done')
+    if os.path.isfile(done_path):
+        print(f"{name} was already downloaded.")
+        return
+
+    extractor = ZipStreamExtractor(extract_to)
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    offset = 0
+    remote_md5 = None
+
+    def consume(chunk: bytes):
+        extractor.feed(chunk)
+        md5.update(chunk)
+        sha256.update(chunk)
+
+    # Replay the bytes downloaded by a previous run, the extraction restarts from the beginning of the archive
+    if os.path.isfile(part_path):
+        with open(part_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                consume(chunk)
+                offset += len(chunk)
+
+    for attempt in range(retries + 1):
+        try:
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            with requests.get(url, stream=True, headers=headers, timeout=30) as r:
+                if r.status_code == 416:
+                    # Nothing left to download
+                    break
+                r.raise_for_status()
+                remote_md5 = parse_goog_md5(r.headers) or remote_md5
+
+                if offset and r.status_code != 206:
+                    # The server ignored the Range header, start over
+                    extractor = ZipStreamExtractor(extract_to)
+                    md5, sha256 = hashlib.md5(), hashlib.sha256()
+                    offset = 0
+
+                total = offset + int(r.headers.get('Content-Length', 0))
+                with open(part_path, 'ab' if offset else 'wb') as file, \
+                        tqdm(total=total, initial=offset, unit='B', unit_scale=True, desc=name,
+                             position=position) as pbar:
+                    for chunk in r.iter_content(chunk_size):
+                        file.write(chunk)
+                        consume(chunk)
+                        offset += len(chunk)
+                        pbar.update(len(chunk))
+            break
+
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+            print(f"Connection lost while downloading {name}, resuming from byte {offset}...")
+
+    extractor.close()
+
+    # Verify the checksums, a corrupted archive has to be downloaded again
+    if (expected_sha256 is not None and sha256.hexdigest() != expected_sha256.lower()) or \
+            (remote_md5 is not None and md5.digest() != remote_md5):
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch for {url}, the archive was removed, please retry")
+
+    # Mark the archive as done and remove it
+    with open(done_path, 'w') as file:
+        file.write(sha256.hexdigest())
+    os.remove(part_path)
+    print(f"Extracted {extractor.num_files} files from {name}.")
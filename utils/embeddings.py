@@ -0,0 +1,220 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from typing import Iterable, Iterator, List, Optional, Tuple
+from .index import exact_top_k, normalize
+
+
+# Name of the embeddings file and size of the CLIP embeddings
+EMBEDDINGS_FILE = "images_embeddings.parquet"
+EMBEDDING_DIM = 512
+
+
+def embedding_matrix(column: pa.Array) -> np.ndarray:
+    """
+    Convert an embedding column to a float32 matrix
+    Args:
+        column: fixed-size list column, or a variable-size list column written by older versions
+
+    Returns: matrix of shape (number of rows, embedding dimension)
+
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+
+    if pa.types.is_fixed_size_list(column.type):
+        # Zero-copy view over the flat values buffer
+        return column.flatten().to_numpy(zero_copy_only=False).astype(np.float32, copy=False) \
+            .reshape(-1, column.type.list_size)
+
+    return np.asarray(column.to_pylist(), dtype=np.float32).reshape(len(column), -1)
+
+
+def iter_embeddings(path: str,
+                    batch_size: int = 256,
+                    columns: Optional[List[str]] = None,
+                    paths: Optional[Iterable[str]] = None) -> Iterator[Tuple[pa.RecordBatch, np.ndarray]]:
+    """
+    Stream the embeddings file in record batches, so memory is bounded by `batch_size`
+    Args:
+        path: path of the embeddings parquet file
+        batch_size: number of rows read at once
+        columns: metadata columns to read besides 'path' and 'embedding', all columns if None
+        paths: read only the rows of these image paths
+
+    Returns: iterator over (metadata batch, embeddings matrix)
+
+    """
+    parquet_file = pq.ParquetFile(path)
+    if columns is not None:
+        columns = list(dict.fromkeys(['path', *columns, 'embedding']))
+    value_set = pa.array(list(paths), pa.string()) if paths is not None else None
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        if value_set is not None:
+            batch = batch.filter(pc.is_in(batch.column('path'), value_set=value_set))
+            if batch.num_rows == 0:
+                continue
+        vectors = embedding_matrix(batch.column('embedding'))
+        meta = batch.select([name for name in batch.schema.names if name != 'embedding'])
+        yield meta, vectors
+
+
+def count_embeddings(path: str) -> int:
+    """
+    Number of embeddings stored in a file, read from the parquet footer
+    Args:
+        path: path of the embeddings parquet file
+
+    Returns: number of rows
+
+    """
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def stored_columns(path: str) -> List[str]:
+    """
+    Names of the columns of an embeddings file, read from the parquet footer
+    Args:
+        path: path of the embeddings parquet file
+
+    Returns: list of column names
+
+    """
+    return pq.ParquetFile(path).schema_arrow.names
+
+
+class EmbeddingsWriter:
+    """
+    Streams embeddings to a parquet file as they are produced.
+    Rows are buffered up to `row_group_size` and written as one row group, embeddings are stored
+    as fixed-size float32 list columns. The file is written next to `path` and moved in place on close.
+    """
+    def __init__(self, path: str, meta_df: pd.DataFrame, row_group_size: int = 4096):
+        """
+        Args:
+            path: path of the embeddings parquet file
+            meta_df: metadata of the images, one row per path
+            row_group_size: number of rows in a parquet row group
+        """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.meta_df = meta_df.drop_duplicates('path').set_index('path', drop=False)
+        self.row_group_size = row_group_size
+
+        meta_schema = pa.Schema.from_pandas(self.meta_df, preserve_index=False)
+        self.meta_schema = meta_schema
+        self.schema = meta_schema.append(pa.field('embedding', pa.list_(pa.float32(), EMBEDDING_DIM)))
+
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+        self.buffer_paths: List[str] = []
+        self.buffer_vectors: List[np.ndarray] = []
+        self.buffered = 0
+        self.num_rows = 0
+
+    def write(self, paths: List[str], vectors: np.ndarray):
+        """
+        Add embeddings to the file
+        Args:
+            paths: paths of the embedded images
+            vectors: matrix of embeddings, one row per path
+        """
+        if not paths:
+            return
+        self.buffer_paths.extend(paths)
+        self.buffer_vectors.append(np.asarray(vectors, dtype=np.float32).reshape(len(paths), EMBEDDING_DIM))
+        self.buffered += len(paths)
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows as a row group
+        """
+        if not self.buffered:
+            return
+        vectors = np.concatenate(self.buffer_vectors)
+        meta = pa.Table.from_pandas(self.meta_df.loc[self.buffer_paths], schema=self.meta_schema,
+                                    preserve_index=False)
+        values = pa.array(vectors.reshape(-1), type=pa.float32())
+        embedding = pa.FixedSizeListArray.from_arrays(values, EMBEDDING_DIM)
+
+        table = pa.Table.from_arrays([*meta.columns, embedding], schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+        self.num_rows += self.buffered
+        self.buffer_paths, self.buffer_vectors, self.buffered = [], [], 0
+
+    def close(self):
+        """
+        Flush the remaining rows and move the file in place
+        """
+        self.flush()
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discard the file being written
+        """
+        self.writer.close()
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_paths(path: str) -> List[str]:
+    """
+    Read only the image paths stored in an embeddings file
+    Args:
+        path: path of the embeddings parquet file
+
+    Returns: list of image paths
+
+    """
+    return pq.read_table(path, columns=['path']).column('path').to_pylist()
+
+
+def exact_ground_truth(path: str,
+                       vectors: np.ndarray,
+                       k: int,
+                       block_size: int = 65536,
+                       hidden: Iterable[str] = ()) -> List[List[str]]:
+    """
+    Exact kNN computed locally from the embeddings file, streamed block by block
+    Args:
+        path: path of the embeddings parquet file
+        vectors: matrix of query vectors
+        k: number of neighbours
+        block_size: number of stored embeddings multiplied at once
+        hidden: paths of the images left out of the collection, e.g. near-duplicates, which are not neighbours
+
+    Returns: paths of the k nearest images of each query, best first
+
+    """
+    paths = []
+    hidden = set(hidden)
+
+    def blocks():
+        for meta, block in iter_embeddings(path, batch_size=block_size, columns=[]):
+            block_paths = meta.column('path').to_pylist()
+            if hidden:
+                keep = [i for i, p in enumerate(block_paths) if p not in hidden]
+                block_paths, block = [block_paths[i] for i in keep], block[keep]
+            paths.extend(block_paths)
+            yield normalize(block)
+
+    positions, _ = exact_top_k(normalize(vectors), blocks(), k)
+
+    return [[paths[i] for i in row] for row in positions]
@@ -0,0 +1,262 @@
+import io
+import os
+import threading
+import numpy as np
+from typing import List, Optional
+from PIL import Image
+
+
+# Name of the CLIP model and of the exported text tower files
+MODEL_NAME = "clip-ViT-B-32"
+ENCODER_FORMATS = ('sentence-transformers', 'torchscript', 'onnx')
+EXPORT_FILES = {'torchscript': 'text_encoder.pt', 'onnx': 'text_encoder.onnx'}
+MAX_LENGTH = 77
+
+
+class TextEncoder:
+    """
+    CLIP text encoder loaded lazily, on the first call to `load` or `encode`.
+    The 'sentence-transformers' format loads the full CLIP model, the 'torchscript' and 'onnx' formats
+    load only the text tower exported with `export_text_encoder`.
+    """
+    def __init__(self,
+                 encoder_format: str = 'sentence-transformers',
+                 export_dir: str = os.path.join('resources', 'encoder'),
+                 quantized: bool = False):
+        """
+        Args:
+            encoder_format: one of 'sentence-transformers', 'torchscript' or 'onnx'
+            export_dir: directory of the exported text tower and tokenizer
+            quantized: load the int8-quantized export
+        """
+        if encoder_format not in ENCODER_FORMATS:
+            raise ValueError(f"Unknown encoder format '{encoder_format}', expected one of {ENCODER_FORMATS}")
+        self.encoder_format = encoder_format
+        self.export_dir = export_dir
+        self.quantized = quantized
+        self.model = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    def load(self):
+        """
+        Load the model, only once even if called from several threads
+        """
+        with self.lock:
+            if self.model is not None:
+                return
+
+            if self.encoder_format == 'sentence-transformers':
+                from sentence_transformers import SentenceTransformer
+                self.model = SentenceTransformer(MODEL_NAME, device="cpu")
+                return
+
+            from transformers import CLIPTokenizerFast
+            self.tokenizer = CLIPTokenizerFast.from_pretrained(self.export_dir)
+            model_path = export_path(self.export_dir, self.encoder_format, self.quantized)
+
+            if self.encoder_format == 'onnx':
+                try:
+                    import onnxruntime
+                except ModuleNotFoundError:
+                    raise ModuleNotFoundError("onnxruntime is needed to use the 'onnx' text encoder")
+                self.model = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+            else:
+                import torch
+                self.model = torch.jit.load(model_path, map_location='cpu').eval()
+
+    def encode(self, texts: List[str], batch_size: int = 256) -> np.ndarray:
+        """
+        Encode texts
+        Args:
+            texts: texts to encode
+            batch_size: number of texts encoded at once
+
+        Returns: matrix of embeddings, one row per text
+        """
+        self.load()
+        if self.encoder_format == 'sentence-transformers':
+            return self.model.encode(texts, batch_size=min(len(texts), batch_size), convert_to_numpy=True)
+
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=MAX_LENGTH, return_tensors='np')
+            input_ids = tokens['input_ids'].astype(np.int64)
+            attention_mask = tokens['attention_mask'].astype(np.int64)
+
+            if self.encoder_format == 'onnx':
+                output = self.model.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+            else:
+                import torch
+                with torch.inference_mode():
+                    output = self.model(torch.from_numpy(input_ids), torch.from_numpy(attention_mask)).numpy()
+            embeddings.append(output)
+
+        return np.concatenate(embeddings).astype(np.float32, copy=False)
+
+
+class ImageEncoder:
+    """
+    CLIP image encoder loaded lazily, on the first uploaded image. It shares the model of a
+    'sentence-transformers' text encoder instead of loading CLIP a second time.
+    """
+    def __init__(self, text_encoder: Optional[TextEncoder] = None):
+        """
+        Args:
+            text_encoder: text encoder whose model is reused when it is the full CLIP model
+        """
+        self.text_encoder = text_encoder
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the model, only once even if called from several threads
+        """
+        if self.text_encoder is not None and self.text_encoder.encoder_format == 'sentence-transformers':
+            self.text_encoder.load()
+            self.model = self.text_encoder.model
+            return
+
+        with self.lock:
+            if self.model is None:
+                from sentence_transformers import SentenceTransformer
+                self.model = SentenceTransformer(MODEL_NAME, device="cpu")
+
+    def encode(self, images: List[bytes], batch_size: int = 32) -> np.ndarray:
+        """
+        Encode image files
+        Args:
+            images: contents of the image files
+            batch_size: number of images encoded at once
+
+        Returns: matrix of embeddings, one row per image
+        """
+        decoded = [decode_image(data) for data in images]
+        self.load()
+        return self.model.encode(decoded, batch_size=min(len(decoded), batch_size), convert_to_numpy=True)
+
+
+def decode_image(data: bytes, size: int = 224) -> Image.Image:
+    """
+    Decode an image file and downscale it so that its shortest side is `size` pixels
+    Args:
+        data: content of the image file
+        size: target length of the shortest side (CLIP input resolution)
+
+    Returns: the decoded RGB image
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Let the JPEG decoder skip DCT scales we do not need
+            image.draft('RGB', (size, size))
+            image = image.convert('RGB')
+    except Exception:
+        raise ValueError("The uploaded file is not a valid image")
+
+    # Resize only if the image is bigger than needed, the model does the final crop
+    w, h = image.size
+    scale = size / min(w, h)
+    if scale < 1:
+        image = image.resize((max(size, round(w * scale)), max(size, round(h * scale))), Image.BICUBIC)
+    return image
+
+
+def export_path(export_dir: str, encoder_format: str, quantized: bool = False) -> str:
+    """
+    Path of an exported text tower
+    Args:
+        export_dir: directory of the exports
+        encoder_format: 'torchscript' or 'onnx'
+        quantized: path of the int8-quantized export
+
+    Returns: path of the file
+    """
+    name = EXPORT_FILES[encoder_format]
+    if quantized:
+        base, ext = os.path.splitext(name)
+        name = f"{base}.int8{ext}"
+    return os.path.join(export_dir, name)
+
+
+def export_text_encoder(export_dir: str = os.path.join('resources', 'encoder'),
+                        encoder_format: str = 'onnx',
+                        quantize: bool = False):
+    """
+    Export the text tower of the CLIP model, so that the service does not load the image tower
+    Args:
+        export_dir: directory where the text tower and the tokenizer are written
+        encoder_format: 'torchscript' or 'onnx'
+        quantize: also write an int8 dynamically-quantized version
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.text_model = clip.text_model
+            self.text_projection = clip.text_projection
+
+        def forward(self, input_ids, attention_mask):
+            pooled = self.text_model(input_ids=input_ids, attention_mask=attention_mask)[1]
+            return self.text_projection(pooled)
+
+    os.makedirs(export_dir, exist_ok=True)
+
+    # Keep only the text tower of the CLIP model
+    clip_module = SentenceTransformer(MODEL_NAME, device="cpu")[0]
+    tower = TextTower(clip_module.model).eval()
+    tokenizer = clip_module.processor.tokenizer
+    tokenizer.save_pretrained(export_dir)
+
+    example = tokenizer(["an example query"], padding=True, return_tensors='pt')
+    inputs = (example['input_ids'], example['attention_mask'])
+    path = export_path(export_dir, encoder_format)
+
+    print(f"Exporting text encoder to {path}...")
+    if encoder_format == 'torchscript':
+        torch.jit.trace(tower, inputs).save(path)
+        if quantize:
+            quantized = torch.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+            torch.jit.trace(quantized, inputs).save(export_path(export_dir, encoder_format, quantized=True))
+
+    elif encoder_format == 'onnx':
+        torch.onnx.export(
+            tower, inputs, path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['embeddings'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                          'attention_mask': {0: 'batch', 1: 'sequence'},
+                          'embeddings': {0: 'batch'}},
+            opset_version=14,
+        )
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(path, export_path(export_dir, encoder_format, quantized=True),
+                             weight_type=QuantType.QInt8)
+
+    else:
+        raise ValueError(f"Cannot export to '{encoder_format}', expected 'torchscript' or 'onnx'")
+
+    print("Finished")
+
+
+def get_text_encoder(encoder_format: Optional[str] = None, export_dir: Optional[str] = None,
+                     quantized: bool = False) -> TextEncoder:
+    """
+    Instantiate a lazily-loaded text encoder
+    Args:
+        encoder_format: one of 'sentence-transformers' (default), 'torchscript' or 'onnx'
+        export_dir: directory of the exported text tower, 'resources/encoder' by default
+        quantized: use the int8-quantized export
+
+    Returns: the text encoder
+    """
+    return TextEncoder(encoder_format or 'sentence-transformers', export_dir or os.path.join('resources', 'encoder'),
+                       quantized)
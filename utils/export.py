@@ -0,0 +1,86 @@
+import os
+import asyncio
+import zipfile
+from typing import AsyncIterator, List
+
+
+# Formats which are already compressed, deflating them again only costs CPU
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+class ZipStreamBuffer:
+    """
+    Write-only file object collecting the bytes written by `zipfile` until they are sent.
+    It has no `seek`, so `zipfile` writes data descriptors instead of going back to the local headers.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        """
+        Returns: the bytes written since the last call
+        """
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+async def stream_zip(paths: List[str], chunk_size: int = 1 << 18) -> AsyncIterator[bytes]:
+    """
+    Streams a zip archive of files, holding at most one chunk of a file in memory.
+    Files are read on the default thread pool, JPEG/PNG/WebP/GIF files are stored as they are, the others are deflated.
+    Args:
+        paths: paths of the files, stored in the archive under their base name
+        chunk_size: number of bytes read at once
+
+    Returns: async iterator over the bytes of the archive
+    """
+    buffer = ZipStreamBuffer()
+    archive = zipfile.ZipFile(buffer, 'w')
+    names = set()
+
+    for path in paths:
+        try:
+            file = await asyncio.to_thread(open, path, 'rb')
+        except OSError:
+            # The image was removed since it was indexed
+            continue
+
+        try:
+            # Make the names unique, the archive is flat
+            name = os.path.basename(path)
+            base, ext = os.path.splitext(name)
+            i = 1
+            while name in names:
+                name = f"{base}_{i}{ext}"
+                i += 1
+            names.add(name)
+
+            info = zipfile.ZipInfo.from_file(path, arcname=name)
+            info.compress_type = zipfile.ZIP_STORED if ext.lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as entry:
+                while chunk := await asyncio.to_thread(file.read, chunk_size):
+                    entry.write(chunk)
+                    if buffer.chunks:
+                        yield buffer.pop()
+        finally:
+            file.close()
+
+        # Data descriptor of the entry
+        yield buffer.pop()
+
+    # Central directory
+    archive.close()
+    yield buffer.pop()
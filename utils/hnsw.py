@@ -0,0 +1,194 @@
+import math
+import heapq
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from tqdm import tqdm
+
+
+class HNSWGraph:
+    """
+    Hierarchical Navigable Small World graph over L2-normalized vectors, written with NumPy.
+    Similarities are dot products, i.e. cosine similarities for normalized vectors.
+    """
+    def __init__(self, m: int = 16, ef_construct: int = 100, seed: int = 0):
+        """
+        Args:
+            m: number of edges per node, nodes of the bottom layer keep up to 2 * m edges
+            ef_construct: number of neighbours to consider during the index building
+            seed: seed of the random level generator
+        """
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construct = ef_construct
+        self.level_mult = 1 / math.log(max(m, 2))
+        self.rng = np.random.default_rng(seed)
+
+        self.layers: List[Dict[int, List[int]]] = []
+        self.entry_point: Optional[int] = None
+
+    def build(self, vectors: np.ndarray):
+        """
+        Insert all vectors in the graph
+        Args:
+            vectors: matrix of L2-normalized vectors, node ids are the row positions
+        """
+        self.layers, self.entry_point = [], None
+        for i in tqdm(range(len(vectors))):
+            self.insert(vectors, i)
+
+    def search_layer(self,
+                     vectors: np.ndarray,
+                     query: np.ndarray,
+                     entry_points: List[int],
+                     ef: int,
+                     layer: int,
+                     allowed: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+        """
+        Greedy beam search in one layer
+        Args:
+            vectors: matrix of all vectors
+            query: query vector
+            entry_points: nodes where the search starts
+            ef: size of the beam
+            layer: layer of the graph
+            allowed: boolean mask of the nodes which can be returned, the others are only traversed
+
+        Returns: list of (similarity, node) of the `ef` best allowed nodes found, unordered
+
+        """
+        graph = self.layers[layer]
+        visited = set(entry_points)
+        sims = vectors[entry_points] @ query
+
+        candidates = [(-s, e) for s, e in zip(sims.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(s, e) for s, e in zip(sims.tolist(), entry_points) if allowed is None or allowed[e]]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if len(results) >= ef and -neg_sim < results[0][0]:
+                break
+
+            neighbours = [n for n in graph.get(node, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+
+            # One matrix-vector product per expanded node
+            for s, n in zip((vectors[neighbours] @ query).tolist(), neighbours):
+                if len(results) < ef or s > results[0][0]:
+                    heapq.heappush(candidates, (-s, n))
+                    if allowed is None or allowed[n]:
+                        heapq.heappush(results, (s, n))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+
+        return results
+
+    def insert(self, vectors: np.ndarray, node: int):
+        """
+        Insert one vector in the graph
+        Args:
+            vectors: matrix of all vectors
+            node: row position of the inserted vector
+        """
+        query = vectors[node]
+        level = int(-math.log(1 - self.rng.random()) * self.level_mult)
+
+        # Add the missing layers
+        while len(self.layers) <= level:
+            self.layers.append({})
+
+        if self.entry_point is None:
+            for layer in range(level + 1):
+                self.layers[layer][node] = []
+            self.entry_point = node
+            return
+
+        top_level = self.top_level()
+        entry_points = [self.entry_point]
+
+        # Greedy descent through the layers above the node level
+        for layer in range(top_level, level, -1):
+            best = max(self.search_layer(vectors, query, entry_points, 1, layer))
+            entry_points = [best[1]]
+
+        for layer in range(min(level, top_level), -1, -1):
+            found = self.search_layer(vectors, query, entry_points, self.ef_construct, layer)
+            max_edges = self.m0 if layer == 0 else self.m
+            neighbours = [n for _, n in heapq.nlargest(self.m, found)]
+            self.layers[layer][node] = neighbours
+
+            # Add reverse edges and prune the neighbours having too many of them
+            for n in neighbours:
+                edges = self.layers[layer][n]
+                edges.append(node)
+                if len(edges) > max_edges:
+                    sims = vectors[edges] @ vectors[n]
+                    keep = np.argpartition(-sims, max_edges - 1)[:max_edges]
+                    self.layers[layer][n] = [edges[i] for i in keep]
+
+            entry_points = [n for _, n in found]
+
+        for layer in range(top_level + 1, level + 1):
+            self.layers[layer][node] = []
+        if level > top_level:
+            self.entry_point = node
+
+    def retain(self, keep: List[int]):
+        """
+        Remove the nodes missing from `keep` and renumber the others by their position in `keep`, which is how the
+        rows of the vectors matrix move once the removed rows are dropped. Edges to removed nodes are dropped.
+        Args:
+            keep: node ids kept, in their new order
+        """
+        new_ids = {node: i for i, node in enumerate(keep)}
+        self.layers = [{new_ids[node]: [new_ids[n] for n in edges if n in new_ids]
+                        for node, edges in graph.items() if node in new_ids}
+                       for graph in self.layers]
+        while self.layers and not self.layers[-1]:
+            self.layers.pop()
+
+        # A removed entry point is replaced by a node of the top layer
+        if self.entry_point in new_ids:
+            self.entry_point = new_ids[self.entry_point]
+        else:
+            self.entry_point = min(self.layers[-1]) if self.layers else None
+
+    def top_level(self) -> int:
+        """
+        Returns: highest layer containing the entry point
+        """
+        return max(layer for layer, graph in enumerate(self.layers) if self.entry_point in graph)
+
+    def search(self,
+               vectors: np.ndarray,
+               query: np.ndarray,
+               k: int,
+               ef: int,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate k nearest neighbours search
+        Args:
+            vectors: matrix of all vectors
+            query: L2-normalized query vector
+            k: number of neighbours
+            ef: size of the beam in the bottom layer
+            allowed: boolean mask of the nodes which can be returned, the filter is applied in the bottom layer
+
+        Returns: tuple of node ids and similarities, best first
+
+        """
+        if self.entry_point is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        entry_points = [self.entry_point]
+        for layer in range(self.top_level(), 0, -1):
+            best = max(self.search_layer(vectors, query, entry_points, 1, layer))
+            entry_points = [best[1]]
+
+        found = heapq.nlargest(k, self.search_layer(vectors, query, entry_points, max(ef, k), 0, allowed))
+        return np.array([n for _, n in found], dtype=np.int64), np.array([s for s, _ in found], dtype=np.float32)
@@ -0,0 +1,983 @@
+import os
+import re
+import json
+import asyncio
+import pickle
+import shutil
+import numpy as np
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from qdrant_client import models
+from qdrant_client.models import VectorParams, Distance
+from .hnsw import HNSWGraph
+from .qdrant import QdrantSettings, get_async_client, get_client, wait_for_green, with_retry, with_retry_async
+
+
+# Backends available for storing and searching the image embeddings
+BACKENDS = ('qdrant', 'numpy', 'hnsw')
+
+# Quantization settings of the qdrant backend
+QUANTIZATIONS = ('none', 'scalar', 'product')
+
+# Image metadata stored in the payload and indexed for filtering, with its type
+PAYLOAD_FIELDS = {'width': 'integer', 'height': 'integer', 'area': 'integer', 'aspect_ratio': 'float',
+                  'format': 'keyword'}
+
+# Versions of a collection are named '<alias>_v<UTC build time>', so that they sort by age
+VERSION_TIME_FORMAT = '%Y%m%dT%H%M%S%f'
+
+# A filtered HNSW search scans the matching points when there are less than this many times the beam size
+FULL_SCAN_FACTOR = 10
+
+# An HNSW graph losing more than this fraction of its nodes in one update is built again rather than patched
+HNSW_REBUILD_FRACTION = 0.2
+
+
+class PointNotFoundError(KeyError):
+    """
+    Raised when a query refers to point ids which are not in the collection
+    """
+    def __init__(self, ids: Iterable[str]):
+        self.ids = sorted(ids)
+        super().__init__(f"Unknown point ids: {', '.join(self.ids)}")
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
+@dataclass
+class Hit:
+    """
+    One search result, with the same attributes as a Qdrant scored point
+    """
+    id: str
+    score: float
+    payload: Dict[str, Any] = field(default_factory=dict)
+    vector: Optional[np.ndarray] = None
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """
+    Conditions on the image metadata, applied during the search
+    """
+    min_width: Optional[int] = None
+    min_height: Optional[int] = None
+    min_aspect_ratio: Optional[float] = None
+    max_aspect_ratio: Optional[float] = None
+    formats: Optional[Tuple[str, ...]] = None
+    exclude_ids: Optional[Tuple[str, ...]] = None
+
+    def to_qdrant(self) -> Optional[models.Filter]:
+        """
+        Returns: the equivalent Qdrant filter, None if there is no condition
+        """
+        must = []
+        if self.min_width is not None:
+            must.append(models.FieldCondition(key='width', range=models.Range(gte=self.min_width)))
+        if self.min_height is not None:
+            must.append(models.FieldCondition(key='height', range=models.Range(gte=self.min_height)))
+        if self.min_aspect_ratio is not None or self.max_aspect_ratio is not None:
+            must.append(models.FieldCondition(key='aspect_ratio', range=models.Range(gte=self.min_aspect_ratio,
+                                                                                     lte=self.max_aspect_ratio)))
+        if self.formats:
+            must.append(models.FieldCondition(key='format', match=models.MatchAny(any=list(self.formats))))
+        must_not = [models.HasIdCondition(has_id=list(self.exclude_ids))] if self.exclude_ids else []
+        return models.Filter(must=must or None, must_not=must_not or None) if must or must_not else None
+
+    def mask(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Evaluate the filter over columns of metadata
+        Args:
+            columns: mapping between payload field (or 'id') and its values, one per point
+
+        Returns: boolean mask of the matching points
+        """
+        mask = np.ones(len(columns['width']), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            if self.min_width is not None:
+                mask &= columns['width'] >= self.min_width
+            if self.min_height is not None:
+                mask &= columns['height'] >= self.min_height
+            if self.min_aspect_ratio is not None:
+                mask &= columns['aspect_ratio'] >= self.min_aspect_ratio
+            if self.max_aspect_ratio is not None:
+                mask &= columns['aspect_ratio'] <= self.max_aspect_ratio
+        if self.formats:
+            mask &= np.isin(columns['format'], list(self.formats))
+        if self.exclude_ids:
+            mask &= ~np.isin(columns['id'], list(self.exclude_ids))
+        return mask
+
+
+def select_payload(payload: Dict[str, Any], with_payload: Union[bool, List[str]] = True) -> Dict[str, Any]:
+    """
+    Keep the requested payload fields
+    Args:
+        payload: payload of a point
+        with_payload: True for all fields, False for none, or the list of fields
+
+    Returns: the selected fields
+    """
+    if with_payload is True:
+        return payload
+    if not with_payload:
+        return {}
+    return {key: payload[key] for key in with_payload if key in payload}
+
+
+def version_name(alias: str) -> str:
+    """
+    Name of a new version of the collection served under `alias`
+    """
+    return f"{alias}_v{datetime.now(timezone.utc).strftime(VERSION_TIME_FORMAT)}"
+
+
+def is_version(alias: str, name: str) -> bool:
+    """
+    Whether the collection `name` is a version of the collection served under `alias`
+    """
+    return re.fullmatch(re.escape(alias) + r'_v\d{8}T\d{12}', name) is not None
+
+
+def excluding(query_filter: Optional[SearchFilter], ids: Iterable[str]) -> SearchFilter:
+    """
+    Add points to exclude from the results to a filter
+    """
+    query_filter = query_filter or SearchFilter()
+    return replace(query_filter, exclude_ids=tuple(dict.fromkeys([*(query_filter.exclude_ids or ()), *ids])))
+
+
+def recommend_vector(positive: np.ndarray, negative: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Query vector of a recommendation, with the 'average_vector' strategy of Qdrant: the average of the positive
+    examples, moved away from the average of the negative ones
+    Args:
+        positive: matrix of the vectors of the positive examples
+        negative: matrix of the vectors of the negative examples
+
+    Returns: the query vector
+    """
+    avg_positive = normalize(positive).mean(axis=0)
+    if negative is None or len(negative) == 0:
+        return avg_positive
+    return avg_positive + avg_positive - normalize(negative).mean(axis=0)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize the rows of a matrix, so that dot products are cosine similarities
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def exact_top_k(queries: np.ndarray, blocks: Iterable[np.ndarray], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top-k search by matrix product, keeping only the k best candidates between consecutive blocks
+    Args:
+        queries: matrix of L2-normalized query vectors
+        blocks: consecutive blocks of L2-normalized vectors, positions are counted over all blocks
+        k: number of results
+
+    Returns: tuple of positions and scores matrices, best first
+
+    """
+    best_pos = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    offset = 0
+
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        scores = queries @ np.asarray(block).T
+        kb = min(k, scores.shape[1])
+        top = np.argpartition(-scores, kb - 1, axis=1)[:, :kb]
+        best_pos = np.concatenate([best_pos, top + offset], axis=1)
+        best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+        offset += len(block)
+
+        # Keep only the k best candidates of the blocks seen so far
+        if best_pos.shape[1] > k:
+            top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_pos = np.take_along_axis(best_pos, top, axis=1)
+            best_scores = np.take_along_axis(best_scores, top, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_pos, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class VectorIndex:
+    """
+    Interface of the vector index backends used to store and search the image embeddings
+    """
+    def exists(self) -> bool:
+        """
+        Returns: whether the collection was already created
+        """
+        raise NotImplementedError
+
+    def recreate(self,
+                 dim: int,
+                 m: int = 16,
+                 ef_construct: int = 100,
+                 quantization: Optional[str] = None,
+                 on_disk: bool = False):
+        """
+        (Re-)create an empty collection
+        Args:
+            dim: size of the vectors
+            m: number of edges per node during the index building
+            ef_construct: number of neighbours to consider during the index building
+            quantization: None, 'scalar' (int8) or 'product' (x16 compression) quantization kept in RAM
+            on_disk: keep the original vectors on disk instead of RAM
+        """
+        raise NotImplementedError
+
+    def drop(self):
+        """
+        Delete the collection
+        """
+        raise NotImplementedError
+
+    def memory_usage(self) -> int:
+        """
+        Returns: estimated number of bytes of vectors and graph kept in RAM
+        """
+        raise NotImplementedError
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        """
+        Insert or replace points
+        Args:
+            ids: ids of the points
+            vectors: matrix of vectors, one row per point
+            payloads: payload of each point
+        """
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        """
+        Delete points
+        Args:
+            ids: ids of the points
+        """
+        raise NotImplementedError
+
+    def wait_ready(self):
+        """
+        Wait until all the upserted points are indexed and searchable
+        """
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """
+        Returns: number of points in the collection
+        """
+        raise NotImplementedError
+
+    def payload_fields(self) -> List[str]:
+        """
+        Returns: payload fields indexed for filtering
+        """
+        raise NotImplementedError
+
+    def collections(self) -> List[str]:
+        """
+        Returns: names of all the collections of the backend
+        """
+        raise NotImplementedError
+
+    def alias_target(self) -> Optional[str]:
+        """
+        Returns: name of the collection the alias `collection_name` points to, None if it is not an alias
+        """
+        raise NotImplementedError
+
+    def switch_alias(self, target: str):
+        """
+        Atomically point the alias `collection_name` to another collection, readers of the alias
+        see either the previous collection or the new one
+        Args:
+            target: name of the collection
+        """
+        raise NotImplementedError
+
+    def versions(self) -> List[str]:
+        """
+        Returns: names of the versions of the collection served under the alias `collection_name`, oldest first
+        """
+        return sorted(name for name in self.collections() if is_version(self.collection_name, name))
+
+    def search_batch(self,
+                     vectors: np.ndarray,
+                     limits: List[int],
+                     exact: bool = False,
+                     hnsw_ef: Optional[int] = None,
+                     rescore: Optional[bool] = None,
+                     oversampling: Optional[float] = None,
+                     offsets: Optional[List[int]] = None,
+                     filters: Optional[List[Optional[SearchFilter]]] = None,
+                     with_payloads: Optional[List[Union[bool, List[str]]]] = None,
+                     with_vectors: bool = False) -> List[List[Hit]]:
+        """
+        Search the nearest neighbours of several query vectors at once
+        Args:
+            vectors: matrix of query vectors, one row per query
+            limits: number of results of each query
+            exact: use an exact search instead of the ANN index
+            hnsw_ef: size of the beam of the ANN search
+            rescore: rescore the candidates found with quantized vectors using the original vectors
+            oversampling: fetch `oversampling * limit` candidates with quantized vectors before rescoring
+            offsets: number of best results skipped by each query, for pagination
+            filters: metadata filter of each query, applied during the search
+            with_payloads: payload fields returned by each query, True for all fields
+            with_vectors: return the stored vectors of the hits
+
+        Returns: list of hits for each query, best first
+
+        """
+        raise NotImplementedError
+
+    async def search_batch_async(self, vectors: np.ndarray, limits: List[int], **kwargs) -> List[List[Hit]]:
+        """
+        Same as `search_batch`, without blocking the event loop. In-process backends search on the default thread pool.
+        """
+        return await asyncio.to_thread(self.search_batch, vectors, limits, **kwargs)
+
+    def retrieve_vectors(self, ids: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Read the stored vectors of points, instead of computing them again
+        Args:
+            ids: ids of the points
+
+        Returns: mapping between point id and its vector, points which are not in the collection are missing
+        """
+        raise NotImplementedError
+
+    def recommend(self,
+                  positive: List[str],
+                  negative: List[str] = (),
+                  limit: int = 5,
+                  offset: int = 0,
+                  query_filter: Optional[SearchFilter] = None,
+                  with_payload: Union[bool, List[str]] = True,
+                  **kwargs) -> List[Hit]:
+        """
+        Search the points most similar to positive examples and dissimilar to negative ones, the examples are
+        not returned
+        Args:
+            positive: ids of the positive examples
+            negative: ids of the negative examples
+            limit: number of results
+            offset: number of best results skipped, for pagination
+            query_filter: metadata filter, applied during the search
+            with_payload: payload fields returned, True for all fields
+            kwargs: search parameters of `search_batch`
+
+        Returns: list of hits, best first
+        """
+        vectors = self.retrieve_vectors(list(dict.fromkeys([*positive, *negative])))
+        missing = (set(positive) | set(negative)) - set(vectors)
+        if missing:
+            raise PointNotFoundError(missing)
+
+        query = recommend_vector(np.stack([vectors[i] for i in positive]),
+                                 np.stack([vectors[i] for i in negative]) if negative else None)
+        return self.search_batch(query[None], [limit], offsets=[offset],
+                                 filters=[excluding(query_filter, [*positive, *negative])],
+                                 with_payloads=[with_payload], **kwargs)[0]
+
+
+class QdrantIndex(VectorIndex):
+    """
+    Collection stored in a Qdrant server. The clients are shared by all the indexes of the process,
+    and every call is retried with backoff on transient errors.
+    """
+    def __init__(self, collection_name: str = 'images', settings: Optional[QdrantSettings] = None):
+        """
+        Args:
+            collection_name: name of the collection
+            settings: connection settings, read from the QDRANT_* environment variables if None
+        """
+        self.collection_name = collection_name
+        self.settings = settings or QdrantSettings.from_env()
+        self.client = get_client(self.settings)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call a method of the sync client, retrying transient errors
+        """
+        return with_retry(self.settings, fn, *args, **kwargs)
+
+    def exists(self) -> bool:
+        return self.alias_target() is not None or self.collection_name in self.collections()
+
+    def recreate(self,
+                 dim: int,
+                 m: int = 16,
+                 ef_construct: int = 100,
+                 quantization: Optional[str] = None,
+                 on_disk: bool = False):
+        quantization_config = None
+        if quantization == 'scalar':
+            quantization_config = models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True),
+            )
+        elif quantization == 'product':
+            quantization_config = models.ProductQuantization(
+                product=models.ProductQuantizationConfig(compression=models.CompressionRatio.X16, always_ram=True),
+            )
+        elif quantization not in (None, 'none'):
+            raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+
+        self.call(
+            self.client.recreate_collection,
+            collection_name=self.collection_name,
+            vectors_config=VectorParams(size=dim, distance=Distance.COSINE, on_disk=on_disk),
+            hnsw_config=models.HnswConfigDiff(m=m, ef_construct=ef_construct),
+            quantization_config=quantization_config,
+        )
+
+        # Index the metadata, so that filters are applied while traversing the graph
+        for field_name, field_type in PAYLOAD_FIELDS.items():
+            self.call(self.client.create_payload_index, self.collection_name, field_name=field_name,
+                      field_schema=models.PayloadSchemaType(field_type))
+
+    def drop(self):
+        self.call(self.client.delete_collection, self.collection_name)
+
+    def memory_usage(self) -> int:
+        info = self.call(self.client.get_collection, self.collection_name)
+        n = info.points_count or 0
+        params = info.config.params.vectors
+        m = info.config.hnsw_config.m
+        quantization_config = info.config.quantization_config
+
+        # Original float32 vectors unless on disk, quantized copies, and about 2 * m links of 4 bytes per node
+        vectors = 0 if params.on_disk else n * params.size * 4
+        if isinstance(quantization_config, models.ScalarQuantization):
+            vectors += n * params.size
+        elif isinstance(quantization_config, models.ProductQuantization):
+            vectors += n * params.size * 4 // 16
+        return vectors + n * 2 * m * 4
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        self.call(
+            self.client.upsert,
+            collection_name=self.collection_name,
+            points=models.Batch(ids=ids, vectors=vectors.tolist(), payloads=payloads),
+            wait=True,
+        )
+
+    def delete(self, ids: List[str]):
+        self.call(
+            self.client.delete,
+            collection_name=self.collection_name,
+            points_selector=models.PointIdsList(points=ids),
+        )
+
+    def wait_ready(self):
+        wait_for_green(self.client, self.collection_name, timeout=self.settings.index_timeout, settings=self.settings)
+
+    def count(self) -> int:
+        return self.call(self.client.count, self.collection_name).count
+
+    def payload_fields(self) -> List[str]:
+        return list(self.call(self.client.get_collection, self.collection_name).payload_schema)
+
+    def collections(self) -> List[str]:
+        return [c.name for c in self.call(self.client.get_collections).collections]
+
+    def alias_target(self) -> Optional[str]:
+        aliases = self.call(self.client.get_aliases).aliases
+        return next((a.collection_name for a in aliases if a.alias_name == self.collection_name), None)
+
+    def switch_alias(self, target: str):
+        if self.collection_name in self.collections():
+            # An alias can not have the name of a collection, the collection built before versioning is dropped
+            print(f"Dropping collection '{self.collection_name}' to replace it with an alias...")
+            self.drop()
+
+        # Delete and create the alias in one request, which Qdrant applies atomically
+        operations = [models.CreateAliasOperation(
+            create_alias=models.CreateAlias(collection_name=target, alias_name=self.collection_name),
+        )]
+        if self.alias_target() is not None:
+            operations.insert(0, models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=self.collection_name),
+            ))
+        self.call(self.client.update_collection_aliases, change_aliases_operations=operations)
+
+    def search_batch(self,
+                     vectors: np.ndarray,
+                     limits: List[int],
+                     exact: bool = False,
+                     hnsw_ef: Optional[int] = None,
+                     rescore: Optional[bool] = None,
+                     oversampling: Optional[float] = None,
+                     offsets: Optional[List[int]] = None,
+                     filters: Optional[List[Optional[SearchFilter]]] = None,
+                     with_payloads: Optional[List[Union[bool, List[str]]]] = None,
+                     with_vectors: bool = False) -> List[List[Hit]]:
+        requests = self.search_requests(vectors, limits, exact, hnsw_ef, rescore, oversampling, offsets, filters,
+                                        with_payloads, with_vectors)
+        search_results = self.call(self.client.search_batch, collection_name=self.collection_name, requests=requests)
+        return self.to_hits(search_results)
+
+    async def search_batch_async(self, vectors: np.ndarray, limits: List[int], **kwargs) -> List[List[Hit]]:
+        if self.settings.url == ':memory:':
+            # An in-memory async client would hold its own, empty, collections
+            return await super().search_batch_async(vectors, limits, **kwargs)
+        requests = self.search_requests(vectors, limits, **kwargs)
+        search_results = await with_retry_async(self.settings, get_async_client(self.settings).search_batch,
+                                                collection_name=self.collection_name, requests=requests)
+        return self.to_hits(search_results)
+
+    def retrieve_vectors(self, ids: List[str]) -> Dict[str, np.ndarray]:
+        points = self.call(self.client.retrieve, self.collection_name, ids=ids, with_payload=False, with_vectors=True)
+        return {str(point.id): np.asarray(point.vector, dtype=np.float32) for point in points}
+
+    def recommend(self,
+                  positive: List[str],
+                  negative: List[str] = (),
+                  limit: int = 5,
+                  offset: int = 0,
+                  query_filter: Optional[SearchFilter] = None,
+                  with_payload: Union[bool, List[str]] = True,
+                  **kwargs) -> List[Hit]:
+        # The examples are looked up by Qdrant, the query costs a single round trip
+        try:
+            points = self.call(self.client.recommend, collection_name=self.collection_name,
+                               positive=list(positive), negative=list(negative),
+                               query_filter=query_filter.to_qdrant() if query_filter else None,
+                               search_params=self.search_params(**kwargs), limit=limit, offset=offset,
+                               with_payload=with_payload)
+        except Exception:
+            # Tell unknown examples apart from the other errors
+            missing = (set(positive) | set(negative)) - set(self.retrieve_vectors(list({*positive, *negative})))
+            if missing:
+                raise PointNotFoundError(missing)
+            raise
+        return self.to_hits([points])[0]
+
+    @staticmethod
+    def search_params(exact: bool = False,
+                      hnsw_ef: Optional[int] = None,
+                      rescore: Optional[bool] = None,
+                      oversampling: Optional[float] = None) -> Optional[models.SearchParams]:
+        """
+        Build the search parameters, None to use the ones of the collection
+        """
+        if not (exact or hnsw_ef or rescore is not None or oversampling):
+            return None
+        quantization = None
+        if rescore is not None or oversampling:
+            quantization = models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling)
+        return models.SearchParams(exact=exact, hnsw_ef=hnsw_ef, quantization=quantization)
+
+    @staticmethod
+    def search_requests(vectors: np.ndarray,
+                        limits: List[int],
+                        exact: bool = False,
+                        hnsw_ef: Optional[int] = None,
+                        rescore: Optional[bool] = None,
+                        oversampling: Optional[float] = None,
+                        offsets: Optional[List[int]] = None,
+                        filters: Optional[List[Optional[SearchFilter]]] = None,
+                        with_payloads: Optional[List[Union[bool, List[str]]]] = None,
+                        with_vectors: bool = False) -> List[models.SearchRequest]:
+        """
+        Build the requests of a batch search, the arguments are the ones of `search_batch`
+        """
+        offsets = offsets or [0] * len(limits)
+        filters = filters or [None] * len(limits)
+        with_payloads = with_payloads or [True] * len(limits)
+
+        search_params = QdrantIndex.search_params(exact, hnsw_ef, rescore, oversampling)
+        return [
+            models.SearchRequest(vector=vector.tolist(), filter=query_filter.to_qdrant() if query_filter else None,
+                                 with_payload=with_payload, with_vector=with_vectors, limit=k, offset=offset,
+                                 params=search_params)
+            for vector, k, offset, query_filter, with_payload in zip(vectors, limits, offsets, filters, with_payloads)
+        ]
+
+    @staticmethod
+    def to_hits(search_results: List[List[models.ScoredPoint]]) -> List[List[Hit]]:
+        """
+        Convert Qdrant scored points to hits
+        """
+        return [[Hit(id=str(hit.id), score=hit.score, payload=hit.payload or {},
+                     vector=None if hit.vector is None else np.asarray(hit.vector, dtype=np.float32))
+                 for hit in search_result]
+                for search_result in search_results]
+
+
+class NumpyIndex(VectorIndex):
+    """
+    In-process collection doing exact search with a matrix product over memory-mapped, L2-normalized vectors.
+    Upserts and deletes are buffered and written to disk by `wait_ready`. The collection is read once at
+    instantiation, readers pick up changes by instantiating a new index. An alias is a '<alias>.alias' file
+    holding the name of the collection it points to. A collection served through an alias is never written in place,
+    its updates go into a new version the alias is switched to.
+    """
+    def __init__(self, collection_name: str = 'images', dir_path: str = os.path.join('resources', 'index')):
+        """
+        Args:
+            collection_name: name of the collection
+            dir_path: directory where the collections are stored
+        """
+        self.collection_name = collection_name
+        self.dir_path = dir_path
+        self.alias_path = os.path.join(dir_path, collection_name + '.alias')
+        self.path = os.path.join(dir_path, self.alias_target() or collection_name)
+        self.config = {}
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.payloads: List[Dict[str, Any]] = []
+        self.columns: Dict[str, np.ndarray] = {}
+        self.pending: Dict[str, Any] = {}
+        self.deleted = set()
+        if self.exists():
+            self.load()
+
+    def file(self, name: str) -> str:
+        """
+        Path of one of the collection files
+        """
+        return os.path.join(self.path, name)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.file('points.json'))
+
+    def recreate(self,
+                 dim: int,
+                 m: int = 16,
+                 ef_construct: int = 100,
+                 quantization: Optional[str] = None,
+                 on_disk: bool = False):
+        # Vectors are always memory-mapped from disk
+        if quantization not in (None, 'none'):
+            raise ValueError("Quantization is only supported by the qdrant backend")
+        self.config = {'dim': dim, 'm': m, 'ef_construct': ef_construct, 'payload_fields': list(PAYLOAD_FIELDS)}
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.ids, self.payloads = [], []
+        self.pending, self.deleted = {}, set()
+        self.save()
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        for point_id, vector, payload in zip(ids, vectors, payloads):
+            self.pending[point_id] = (np.asarray(vector, dtype=np.float32), payload)
+            self.deleted.discard(point_id)
+
+    def delete(self, ids: List[str]):
+        for point_id in ids:
+            self.pending.pop(point_id, None)
+            self.deleted.add(point_id)
+
+    def wait_ready(self):
+        if not self.pending and not self.deleted:
+            return
+
+        # Merge the buffered changes with the stored points
+        keep = [i for i, point_id in enumerate(self.ids)
+                if point_id not in self.deleted and point_id not in self.pending]
+        ids = [self.ids[i] for i in keep] + list(self.pending)
+        payloads = [self.payloads[i] for i in keep] + [payload for _, payload in self.pending.values()]
+        new_vectors = np.array([vector for vector, _ in self.pending.values()], dtype=np.float32)
+        new_vectors = normalize(new_vectors.reshape(-1, self.config['dim']))
+
+        num_points = len(self.ids)
+        self.vectors = np.concatenate([np.asarray(self.vectors[keep]), new_vectors])
+        self.ids, self.payloads = ids, payloads
+        self.pending, self.deleted = {}, set()
+        self.update_structure(keep, num_points)
+
+        # Readers loading the served version meanwhile would mix old and new files, the merged points
+        # go into a new version instead, which is served once complete
+        served = self.alias_target()
+        if served is not None:
+            self.path = os.path.join(self.dir_path, version_name(self.collection_name))
+        self.save()
+        if served is not None:
+            self.switch_alias(os.path.basename(self.path))
+
+    def build(self):
+        """
+        Build the ANN structure over the stored vectors, nothing to do for the exact search
+        """
+
+    def update_structure(self, keep: List[int], num_points: int):
+        """
+        Update the ANN structure after `wait_ready` merged the buffered changes, nothing to do for the exact search
+        Args:
+            keep: previous positions of the points kept, the other points were deleted or replaced
+            num_points: number of points before the merge, the new points are the rows after the kept ones
+        """
+
+    def save(self):
+        """
+        Write the collection to disk, the points file is written last as it marks the collection as complete
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file('vectors.npy.tmp'), 'wb') as file:
+            np.save(file, np.asarray(self.vectors), allow_pickle=False)
+        os.replace(self.file('vectors.npy.tmp'), self.file('vectors.npy'))
+        self.save_structure()
+        with open(self.file('points.json.tmp'), 'w') as file:
+            json.dump({'config': self.config, 'ids': self.ids, 'payloads': self.payloads}, file)
+        os.replace(self.file('points.json.tmp'), self.file('points.json'))
+        self.load()
+
+    def save_structure(self):
+        """
+        Write the ANN structure to disk, nothing to do for the exact search
+        """
+
+    def load_structure(self):
+        """
+        Read the ANN structure from disk, nothing to do for the exact search
+        """
+
+    def load(self):
+        """
+        Read the collection from disk
+        """
+        with open(self.file('points.json'), 'r') as file:
+            points = json.load(file)
+        self.config, self.ids, self.payloads = points['config'], points['ids'], points['payloads']
+        self.positions = {point_id: i for i, point_id in enumerate(self.ids)}
+        self.columns = self.payload_columns()
+
+        # Vectors are memory-mapped, so only the pages touched by the searches are read
+        self.vectors = np.load(self.file('vectors.npy'), mmap_mode='r')
+        self.load_structure()
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def payload_fields(self) -> List[str]:
+        return self.config.get('payload_fields', [])
+
+    def collections(self) -> List[str]:
+        if not os.path.isdir(self.dir_path):
+            return []
+        return [name for name in os.listdir(self.dir_path)
+                if os.path.isfile(os.path.join(self.dir_path, name, 'points.json'))]
+
+    def alias_target(self) -> Optional[str]:
+        try:
+            with open(self.alias_path, 'r') as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def switch_alias(self, target: str):
+        os.makedirs(self.dir_path, exist_ok=True)
+        with open(self.alias_path + '.tmp', 'w') as file:
+            file.write(target)
+        os.replace(self.alias_path + '.tmp', self.alias_path)
+
+        # The alias file takes precedence, the collection built before versioning is no longer read
+        legacy_path = os.path.join(self.dir_path, self.collection_name)
+        if os.path.isdir(legacy_path):
+            shutil.rmtree(legacy_path, ignore_errors=True)
+
+        self.path = os.path.join(self.dir_path, target)
+        self.load()
+
+    def payload_columns(self) -> Dict[str, np.ndarray]:
+        """
+        Gather the point ids and the indexed payload fields in arrays, so that filters are evaluated for all points
+        at once
+        Returns: mapping between payload field (or 'id') and its values, NaN or '' when a point misses the field
+        """
+        columns = {'id': np.array(self.ids, dtype=object)}
+        for field_name, field_type in PAYLOAD_FIELDS.items():
+            if field_type == 'keyword':
+                columns[field_name] = np.array([p.get(field_name) or '' for p in self.payloads], dtype=object)
+            else:
+                columns[field_name] = np.array([p.get(field_name, np.nan) for p in self.payloads], dtype=np.float64)
+        return columns
+
+    def retrieve_vectors(self, ids: List[str]) -> Dict[str, np.ndarray]:
+        return {point_id: np.asarray(self.vectors[self.positions[point_id]])
+                for point_id in ids if point_id in self.positions}
+
+    def drop(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def memory_usage(self) -> int:
+        # Memory-mapped vectors end up in the page cache once searched
+        return int(np.asarray(self.vectors).nbytes)
+
+    def hits(self,
+             positions: np.ndarray,
+             scores: np.ndarray,
+             with_payload: Union[bool, List[str]] = True,
+             with_vectors: bool = False) -> List[Hit]:
+        """
+        Convert row positions and scores to hits
+        """
+        return [Hit(id=self.ids[i], score=float(s), payload=select_payload(self.payloads[i], with_payload),
+                    vector=np.asarray(self.vectors[i]) if with_vectors else None)
+                for i, s in zip(positions, scores)]
+
+    def exact_search(self,
+                     queries: np.ndarray,
+                     k: int,
+                     block_size: int = 65536,
+                     subset: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k search, scanning the vectors block by block so memory stays bounded
+        Args:
+            queries: matrix of L2-normalized query vectors
+            k: number of results
+            block_size: number of vectors multiplied at once
+            subset: positions of the only vectors searched, all vectors if None
+
+        Returns: tuple of positions and scores matrices, best first
+
+        """
+        if subset is None:
+            blocks = (self.vectors[start:start + block_size] for start in range(0, len(self.vectors), block_size))
+            return exact_top_k(queries, blocks, k)
+
+        blocks = (self.vectors[subset[start:start + block_size]] for start in range(0, len(subset), block_size))
+        positions, scores = exact_top_k(queries, blocks, k)
+        return subset[positions], scores
+
+    def search_batch(self,
+                     vectors: np.ndarray,
+                     limits: List[int],
+                     exact: bool = False,
+                     hnsw_ef: Optional[int] = None,
+                     rescore: Optional[bool] = None,
+                     oversampling: Optional[float] = None,
+                     offsets: Optional[List[int]] = None,
+                     filters: Optional[List[Optional[SearchFilter]]] = None,
+                     with_payloads: Optional[List[Union[bool, List[str]]]] = None,
+                     with_vectors: bool = False) -> List[List[Hit]]:
+        offsets = offsets or [0] * len(limits)
+        filters = filters or [None] * len(limits)
+        with_payloads = with_payloads or [True] * len(limits)
+        if not self.ids:
+            return [[] for _ in limits]
+
+        queries = normalize(vectors)
+
+        # Queries sharing a filter are searched together, over the matching vectors only
+        groups = {}
+        for i, query_filter in enumerate(filters):
+            groups.setdefault(query_filter, []).append(i)
+
+        results = [None] * len(limits)
+        for query_filter, group in groups.items():
+            subset = None if query_filter is None else np.flatnonzero(query_filter.mask(self.columns))
+            positions, scores = self.exact_search(queries[group], max(limits[i] + offsets[i] for i in group),
+                                                  subset=subset)
+            for i, p, s in zip(group, positions, scores):
+                window = slice(offsets[i], offsets[i] + limits[i])
+                results[i] = self.hits(p[window], s[window], with_payloads[i], with_vectors)
+
+        return results
+
+
+class HNSWIndex(NumpyIndex):
+    """
+    In-process collection doing approximate search with an HNSW graph built with the collection `m` and `ef_construct`
+    """
+    def __init__(self, collection_name: str = 'images', dir_path: str = os.path.join('resources', 'index')):
+        self.graph: Optional[HNSWGraph] = None
+        super().__init__(collection_name, dir_path)
+
+    def build(self):
+        print("Building HNSW graph...")
+        self.graph = HNSWGraph(m=self.config['m'], ef_construct=self.config['ef_construct'])
+        self.graph.build(np.asarray(self.vectors))
+
+    def update_structure(self, keep: List[int], num_points: int):
+        # Removing many nodes leaves the others with few edges, the graph is then built again
+        if self.graph is None or num_points - len(keep) > HNSW_REBUILD_FRACTION * max(num_points, 1):
+            self.build()
+            return
+
+        # Only the new points are inserted, in the graph of the kept ones
+        self.graph.retain(keep)
+        vectors = np.asarray(self.vectors)
+        for node in range(len(keep), len(vectors)):
+            self.graph.insert(vectors, node)
+
+    def memory_usage(self) -> int:
+        edges = sum(len(e) for layer in self.graph.layers for e in layer.values()) if self.graph else 0
+        return super().memory_usage() + edges * 8
+
+    def save_structure(self):
+        with open(self.file('hnsw.pkl.tmp'), 'wb') as file:
+            pickle.dump(self.graph, file)
+        os.replace(self.file('hnsw.pkl.tmp'), self.file('hnsw.pkl'))
+
+    def load_structure(self):
+        # A collection written by the exact backend has no graph, searches fall back to the exact search
+        if not os.path.isfile(self.file('hnsw.pkl')):
+            self.graph = None
+            return
+        with open(self.file('hnsw.pkl'), 'rb') as file:
+            self.graph = pickle.load(file)
+
+    def search_batch(self,
+                     vectors: np.ndarray,
+                     limits: List[int],
+                     exact: bool = False,
+                     hnsw_ef: Optional[int] = None,
+                     rescore: Optional[bool] = None,
+                     oversampling: Optional[float] = None,
+                     offsets: Optional[List[int]] = None,
+                     filters: Optional[List[Optional[SearchFilter]]] = None,
+                     with_payloads: Optional[List[Union[bool, List[str]]]] = None,
+                     with_vectors: bool = False) -> List[List[Hit]]:
+        if exact or not self.ids or self.graph is None:
+            return super().search_batch(vectors, limits, exact=True, offsets=offsets, filters=filters,
+                                        with_payloads=with_payloads, with_vectors=with_vectors)
+
+        offsets = offsets or [0] * len(limits)
+        filters = filters or [None] * len(limits)
+        with_payloads = with_payloads or [True] * len(limits)
+        queries = normalize(vectors)
+        ef = hnsw_ef or self.config['ef_construct']
+
+        results = []
+        for query, k, offset, query_filter, with_payload in zip(queries, limits, offsets, filters, with_payloads):
+            allowed = None if query_filter is None else query_filter.mask(self.columns)
+            if allowed is not None and allowed.sum() <= FULL_SCAN_FACTOR * max(ef, k + offset):
+                # Too few matching points to reach them through the graph, scan them instead
+                positions, scores = self.exact_search(query[None], k + offset, subset=np.flatnonzero(allowed))
+                positions, scores = positions[0], scores[0]
+            else:
+                positions, scores = self.graph.search(self.vectors, query, k + offset, ef, allowed=allowed)
+            results.append(self.hits(positions[offset:], scores[offset:], with_payload, with_vectors))
+        return results
+
+
+def get_index(backend: str = 'qdrant',
+              collection_name: str = 'images',
+              docs_path: str = 'resources') -> VectorIndex:
+    """
+    Instantiate a vector index backend
+    Args:
+        backend: one of 'qdrant', 'numpy' (in-process exact search) or 'hnsw' (in-process ANN search)
+        collection_name: name of the collection
+        docs_path: dir path to the resources, in-process collections are stored under its 'index' directory
+
+    Returns: the vector index
+
+    """
+    if backend == 'qdrant':
+        return QdrantIndex(collection_name)
+    if backend == 'numpy':
+        return NumpyIndex(collection_name, os.path.join(docs_path, 'index'))
+    if backend == 'hnsw':
+        return HNSWIndex(collection_name, os.path.join(docs_path, 'index'))
+    raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
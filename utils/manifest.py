@@ -0,0 +1,141 @@
+import os
+import json
+import uuid
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+# Namespace used to derive stable Qdrant point ids from image paths
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'text-to-image-search/images')
+
+
+def point_id(path: str) -> str:
+    """
+    Derive a stable Qdrant point id from an image path
+    Args:
+        path: path of the image
+
+    Returns: UUID string, always the same for the same path
+
+    """
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, os.path.normpath(path)))
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the content hash of a file
+    Args:
+        path: path of the file
+        chunk_size: number of bytes read at once
+
+    Returns: hex digest of the file content
+
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(path: str) -> Dict[str, Dict]:
+    """
+    Read the manifest of indexed images
+    Args:
+        path: path of the manifest json file
+
+    Returns: mapping between image path and its hash, mtime and size, empty if there is no manifest
+
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest: Dict[str, Dict], path: str):
+    """
+    Atomically write the manifest of indexed images
+    Args:
+        manifest: mapping between image path and its hash, mtime and size
+        path: path of the manifest json file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, path)
+
+
+def load_pending_delta(path: str) -> Dict[str, Any]:
+    """
+    Read the delta of the collection left by a run whose update did not complete
+    Args:
+        path: path of the pending delta json file
+
+    Returns: mapping with whether a 'rebuild' is pending and the 'upserted' and 'deleted' image paths,
+        an empty delta if there is no file
+
+    """
+    if not os.path.isfile(path):
+        return {'rebuild': False, 'upserted': [], 'deleted': []}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_pending_delta(delta: Dict[str, Any], path: str):
+    """
+    Atomically write the delta of the collection before it is applied, so that it is not lost if the update fails
+    Args:
+        delta: mapping with whether a 'rebuild' is pending and the 'upserted' and 'deleted' image paths
+        path: path of the pending delta json file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(delta, file)
+    os.replace(tmp_path, path)
+
+
+def scan_manifest(paths: List[str],
+                  old_manifest: Dict[str, Dict],
+                  num_workers: Optional[int] = None) -> Tuple[Dict[str, Dict], Dict[str, List[str]]]:
+    """
+    Build the manifest of the current images and compare it with the previous one.
+    Files whose mtime and size did not change are not read again, the others are hashed on a thread pool.
+    Args:
+        paths: paths of the current images
+        old_manifest: manifest of the last indexing run
+        num_workers: number of hashing threads, defaults to the number of CPUs
+
+    Returns: tuple represented by the new manifest and the 'added', 'changed' and 'removed' image paths
+
+    """
+    manifest = {}
+    changes = {'added': [], 'changed': [], 'removed': []}
+
+    # Reuse the hash when the file was not touched
+    to_hash = []
+    for path in paths:
+        stat = os.stat(path)
+        old_entry = old_manifest.get(path)
+        if old_entry and old_entry['mtime'] == stat.st_mtime and old_entry['size'] == stat.st_size:
+            manifest[path] = old_entry
+        else:
+            to_hash.append((path, stat))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        digests = executor.map(file_digest, [path for path, _ in to_hash])
+        for (path, stat), digest in tqdm(zip(to_hash, digests), total=len(to_hash)):
+            entry = {'hash': digest, 'mtime': stat.st_mtime, 'size': stat.st_size}
+            manifest[path] = entry
+
+            old_entry = old_manifest.get(path)
+            if old_entry is None:
+                changes['added'].append(path)
+            elif old_entry['hash'] != entry['hash']:
+                changes['changed'].append(path)
+
+    changes['removed'] = [path for path in old_manifest if path not in manifest]
+
+    return manifest, changes
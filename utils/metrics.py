@@ -0,0 +1,219 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Samples of a metric family: (suffix, labels, value)
+Samples = List[Tuple[str, Dict[str, str], float]]
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    Format labels in the Prometheus text format
+    """
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    """
+    Base class of the metrics, one value (or histogram) per combination of label values
+    """
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """
+        Args:
+            name: name of the metric
+            documentation: help text of the metric
+            labelnames: names of the labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Samples:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter, its name should end with '_total'
+    """
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Samples:
+        with self.lock:
+            return [('', dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """
+    Histogram with cumulative buckets, a sum and a count
+    """
+    metric_type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        """
+        Args:
+            name: name of the metric
+            documentation: help text of the metric
+            labelnames: names of the labels
+            buckets: upper bounds of the buckets, +Inf is added
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket and +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Observe the duration of a block of code
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Samples:
+        samples = []
+        with self.lock:
+            for key, counts in self.values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, count in zip((*self.buckets, float('inf')), counts[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('_bucket', {**labels, 'le': le}, cumulative))
+                samples.append(('_sum', labels, counts[-1]))
+                samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    Set of metrics rendered in the Prometheus text exposition format. Values computed at scrape time,
+    such as queue depths and cache hit rates, are added with collectors.
+    """
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], List[Tuple[str, str, str, Samples]]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[Tuple[str, str, str, Samples]]]):
+        """
+        Args:
+            collector: function returning (name, type, help, samples) of metric families
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        families = [(m.name, m.metric_type, m.documentation, m.samples()) for m in self.metrics]
+        for collector in self.collectors:
+            families.extend(collector())
+
+        lines = []
+        for name, metric_type, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class StageTimer:
+    """
+    Durations of the stages of one request, each measured stage is also observed in `STAGE_LATENCY`
+    """
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, duration: float, observe: bool = True):
+        """
+        Args:
+            name: name of the stage
+            duration: duration in seconds
+            observe: also observe the duration in the stage histogram
+        """
+        self.durations[name] = self.durations.get(name, 0.0) + duration
+        if observe:
+            STAGE_LATENCY.observe(duration, stage=name)
+
+    def merge(self, durations: Dict[str, float]):
+        """
+        Add stages measured elsewhere, already observed in the stage histogram. Stages shared by several
+        concurrent parts of the request keep their longest duration.
+        Args:
+            durations: mapping between stage name and duration in seconds
+        """
+        for name, duration in durations.items():
+            self.durations[name] = max(self.durations.get(name, 0.0), duration)
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """
+        Returns: value of the Server-Timing header, durations in milliseconds
+        """
+        durations = dict(self.durations)
+        if total is not None:
+            durations['total'] = total
+        return ', '.join(f'{name};dur={duration * 1000:.2f}' for name, duration in durations.items())
+
+
+# Metrics of the search service
+REGISTRY = Registry()
+REQUESTS = REGISTRY.register(Counter('search_http_requests_total', 'HTTP requests by route and status',
+                                     ['route', 'method', 'status']))
+REQUEST_LATENCY = REGISTRY.register(Histogram('search_http_request_seconds', 'Latency of the HTTP requests by route',
+                                              ['route', 'method']))
+STAGE_LATENCY = REGISTRY.register(Histogram('search_stage_seconds', 'Latency of each stage of the search path',
+                                            ['stage']))
+ENCODER_BATCH_SIZE = REGISTRY.register(Histogram('search_encoder_batch_size', 'Number of texts per encoder call',
+                                                 buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)))
+SEARCH_BATCH_SIZE = REGISTRY.register(Histogram('search_index_batch_size', 'Number of queries per index call',
+                                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)))
+INDEX_ERRORS = REGISTRY.register(Counter('search_index_errors_total', 'Errors raised by the vector index calls',
+                                         ['backend', 'error']))
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import importlib.util
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where only the sampled memory is reported
+    resource = None
+
+
+# Profilers which can be attached to a single stage
+PROFILERS = ('cprofile', 'pyinstrument')
+
+# Unit of ru_maxrss, kilobytes on Linux and bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def current_rss() -> Optional[int]:
+    """
+    Resident memory of the process in bytes, read from /proc so that it is cheap enough to be sampled
+    Returns: None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss(who: str = 'self') -> Optional[int]:
+    """
+    Peak resident memory in bytes since the start of the process ('self'), or of its largest finished child ('children')
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss * MAXRSS_UNIT
+
+
+def cpu_seconds() -> float:
+    """
+    CPU time of the process and of its finished children, so that the work of process pools is counted
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class MemorySampler:
+    """
+    Background thread sampling the resident memory, to get the peak of a stage.
+    The peak reported by the OS is the one of the whole process life, it can not be reset between stages.
+    """
+    def __init__(self, interval: float = 0.05):
+        """
+        Args:
+            interval: seconds between two samples
+        """
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak or 0, current_rss() or 0)
+
+    def __enter__(self) -> 'MemorySampler':
+        if self.peak is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.peak is not None:
+            self.peak = max(self.peak, current_rss() or 0)
+
+
+@dataclass
+class StageProfile:
+    """
+    Measures of one stage of the pipeline, `items` is set by the stage to get its throughput
+    """
+    name: str
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    items: Optional[int] = None
+    items_per_second: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+    children_peak_rss_mb: Optional[float] = None
+
+
+class PipelineProfiler:
+    """
+    Records the wall time, CPU time, peak memory and throughput of each stage of the preparation pipeline,
+    and optionally profiles one of the stages with cProfile or pyinstrument
+    """
+    def __init__(self,
+                 enabled: bool = False,
+                 output_path: str = os.path.join('resources', 'profile'),
+                 profile_stage: Optional[str] = None,
+                 profiler: str = 'cprofile'):
+        """
+        Args:
+            enabled: measure the stages, disabled stages are run as is
+            output_path: directory of the JSON reports and of the profiler dumps
+            profile_stage: name of the stage profiled, none if None
+            profiler: 'cprofile' or 'pyinstrument', which has to be installed
+        """
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler '{profiler}', expected one of {PROFILERS}")
+        # Fail before the pipeline runs rather than at the profiled stage
+        if profile_stage is not None and profiler == 'pyinstrument' and not importlib.util.find_spec('pyinstrument'):
+            raise ImportError("pyinstrument is not installed, install it or use cProfile")
+        self.enabled = enabled or profile_stage is not None
+        self.output_path = output_path
+        self.profile_stage = profile_stage
+        self.profiler = profiler
+        self.stages: List[StageProfile] = []
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageProfile]:
+        """
+        Measure a stage of the pipeline
+        Args:
+            name: name of the stage
+
+        Returns: measures of the stage, the stage sets their `items`
+        """
+        stage = StageProfile(name)
+        if not self.enabled:
+            yield stage
+            return
+
+        children_peak = max_rss('children')
+        wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+        with MemorySampler() as sampler, self.profile(name):
+            yield stage
+        stage.wall_seconds = time.perf_counter() - wall_start
+        stage.cpu_seconds = cpu_seconds() - cpu_start
+
+        if stage.items is not None and stage.wall_seconds > 0:
+            stage.items_per_second = stage.items / stage.wall_seconds
+        if sampler.peak is not None:
+            stage.peak_rss_mb = sampler.peak / 2 ** 20
+        # The peak of the children only tells something about this stage if a child of this stage raised it
+        if max_rss('children') != children_peak:
+            stage.children_peak_rss_mb = max_rss('children') / 2 ** 20
+        self.stages.append(stage)
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[None]:
+        """
+        Run the profiler during the profiled stage, its dump is written in the output directory
+        """
+        if name != self.profile_stage:
+            yield
+            return
+
+        os.makedirs(self.output_path, exist_ok=True)
+        dump_path = os.path.join(self.output_path, name)
+        if self.profiler == 'pyinstrument':
+            # Optional dependency, only needed to profile with it
+            from pyinstrument import Profiler
+
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(dump_path + '.html', 'w') as file:
+                    file.write(profiler.output_html())
+                print(f"Stored the pyinstrument profile of '{name}' in {dump_path}.html")
+        else:
+            import pstats
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(dump_path + '.prof')
+                with open(dump_path + '.txt', 'w') as file:
+                    pstats.Stats(profiler, stream=file).sort_stats('cumulative').print_stats(50)
+                print(f"Stored the cProfile profile of '{name}' in {dump_path}.prof")
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns: measures of the run and of its stages
+        """
+        peak = max_rss('self')
+        return {
+            'started_at': self.started_at.isoformat(),
+            'wall_seconds': time.perf_counter() - self.start,
+            'cpu_seconds': sum(stage.cpu_seconds for stage in self.stages),
+            'max_rss_mb': peak / 2 ** 20 if peak is not None else None,
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'stages': [asdict(stage) for stage in self.stages],
+        }
+
+    def save(self) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        Write the report of the run, and append it to the history of the runs
+        Returns: tuple of the report of the run and the report of the previous profiled run, None if there is none
+        """
+        history_path = os.path.join(self.output_path, 'history.jsonl')
+        previous = load_profile_history(history_path)[-1:]
+
+        os.makedirs(self.output_path, exist_ok=True)
+        report = self.report()
+        with open(os.path.join(self.output_path, 'profile.json'), 'w') as file:
+            json.dump(report, file, indent=2)
+        with open(history_path, 'a') as file:
+            file.write(json.dumps(report) + '\n')
+        print(f"Stored the profile of the run in {os.path.join(self.output_path, 'profile.json')}")
+
+        return report, previous[0] if previous else None
+
+
+def load_profile_history(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the reports of the previous profiled runs
+    Args:
+        path: path of the history JSONL file
+
+    Returns: reports, oldest first
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def compare_profiles(report: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Rows of the profile table of the data report, each stage with its change since the previous run
+    Args:
+        report: report of the run
+        previous: report of the previous run, None if there is none
+
+    Returns: measures of each stage, with the wall time of the previous run and its relative change
+    """
+    previous_stages = {stage['name']: stage for stage in previous['stages']} if previous else {}
+    rows = []
+    for stage in report['stages']:
+        row = dict(stage)
+        before = previous_stages.get(stage['name'])
+        row['previous_wall_seconds'] = before['wall_seconds'] if before else None
+        row['wall_change'] = stage['wall_seconds'] / before['wall_seconds'] - 1 \
+            if before and before['wall_seconds'] > 0 else None
+        rows.append(row)
+    return rows
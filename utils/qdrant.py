@@ -0,0 +1,202 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import grpc
+import httpx
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
+from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+
+
+T = TypeVar('T')
+
+# HTTP statuses and gRPC codes worth retrying, the server is overloaded or restarting
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+TRANSIENT_GRPC_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                        grpc.StatusCode.RESOURCE_EXHAUSTED)
+
+
+@dataclass(frozen=True)
+class QdrantSettings:
+    """
+    Connection settings shared by all the Qdrant clients of a process
+    """
+    url: str = "http://localhost:6333"
+    api_key: Optional[str] = None
+    prefer_grpc: bool = True
+    grpc_port: int = 6334
+    timeout: float = 10.0
+    retries: int = 3
+    backoff: float = 0.1
+    max_backoff: float = 5.0
+    max_connections: int = 32
+    index_timeout: float = 600.0
+
+    @classmethod
+    def from_env(cls) -> 'QdrantSettings':
+        """
+        Read the settings from the QDRANT_* environment variables, missing ones keep their default
+        """
+        defaults = cls()
+        return cls(
+            url=os.environ.get('QDRANT_URL', defaults.url),
+            api_key=os.environ.get('QDRANT_API_KEY', defaults.api_key),
+            prefer_grpc=os.environ.get('QDRANT_GRPC', '1' if defaults.prefer_grpc else '0') == '1',
+            grpc_port=int(os.environ.get('QDRANT_GRPC_PORT', defaults.grpc_port)),
+            timeout=float(os.environ.get('QDRANT_TIMEOUT', defaults.timeout)),
+            retries=int(os.environ.get('QDRANT_RETRIES', defaults.retries)),
+            backoff=float(os.environ.get('QDRANT_BACKOFF', defaults.backoff)),
+            max_backoff=float(os.environ.get('QDRANT_MAX_BACKOFF', defaults.max_backoff)),
+            max_connections=int(os.environ.get('QDRANT_MAX_CONNECTIONS', defaults.max_connections)),
+            index_timeout=float(os.environ.get('QDRANT_INDEX_TIMEOUT', defaults.index_timeout)),
+        )
+
+    def client_args(self) -> Dict[str, Any]:
+        """
+        Returns: keyword arguments of the sync and async clients
+        """
+        if self.url == ':memory:':
+            # In-process Qdrant, used by tests and benchmarks
+            return {'location': ':memory:'}
+        return {
+            'url': self.url,
+            'api_key': self.api_key,
+            'prefer_grpc': self.prefer_grpc,
+            'grpc_port': self.grpc_port,
+            'timeout': self.timeout,
+            # Keep connections alive, the client disables keep-alive for localhost by default
+            'limits': httpx.Limits(max_connections=self.max_connections,
+                                   max_keepalive_connections=self.max_connections),
+        }
+
+
+# Clients shared by the indexes of the process, one per settings
+_clients: Dict[QdrantSettings, QdrantClient] = {}
+_async_clients: Dict[QdrantSettings, AsyncQdrantClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(settings: Optional[QdrantSettings] = None) -> QdrantClient:
+    """
+    Get the shared sync client, its connections are pooled and reused by all the callers
+    Args:
+        settings: connection settings, read from the environment if None
+
+    Returns: the client
+    """
+    settings = settings or QdrantSettings.from_env()
+    with _clients_lock:
+        if settings not in _clients:
+            _clients[settings] = QdrantClient(**settings.client_args())
+        return _clients[settings]
+
+
+def get_async_client(settings: Optional[QdrantSettings] = None) -> AsyncQdrantClient:
+    """
+    Get the shared async client, to be used from a single event loop
+    Args:
+        settings: connection settings, read from the environment if None
+
+    Returns: the client
+    """
+    settings = settings or QdrantSettings.from_env()
+    with _clients_lock:
+        if settings not in _async_clients:
+            _async_clients[settings] = AsyncQdrantClient(**settings.client_args())
+        return _async_clients[settings]
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether an error of a Qdrant call can go away by retrying it
+    """
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code in TRANSIENT_STATUSES
+    if isinstance(error, grpc.RpcError):
+        return error.code() in TRANSIENT_GRPC_CODES
+    return isinstance(error, (ResponseHandlingException, httpx.TransportError, TimeoutError, ConnectionError))
+
+
+def backoff_delay(settings: QdrantSettings, attempt: int) -> float:
+    """
+    Exponential backoff with full jitter, so that clients retrying together do not hit the server together
+    """
+    return random.uniform(0, min(settings.max_backoff, settings.backoff * 2 ** attempt))
+
+
+def with_retry(settings: QdrantSettings, fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Call a sync client method, retrying transient errors with backoff
+    Args:
+        settings: settings with the number of retries and the backoff
+        fn: client method
+        args: positional arguments of the method
+        kwargs: keyword arguments of the method
+
+    Returns: result of the method
+    """
+    for attempt in range(settings.retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == settings.retries or not is_transient(e):
+                raise
+            time.sleep(backoff_delay(settings, attempt))
+
+
+async def with_retry_async(settings: QdrantSettings, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+    """
+    Call an async client method with a deadline per attempt, retrying transient errors with backoff
+    Args:
+        settings: settings with the timeout, the number of retries and the backoff
+        fn: client method
+        args: positional arguments of the method
+        kwargs: keyword arguments of the method
+
+    Returns: result of the method
+    """
+    for attempt in range(settings.retries + 1):
+        try:
+            return await asyncio.wait_for(fn(*args, **kwargs), settings.timeout)
+        except Exception as e:
+            if attempt == settings.retries or not is_transient(e):
+                raise
+            await asyncio.sleep(backoff_delay(settings, attempt))
+
+
+def wait_for_green(client: QdrantClient,
+                   collection_name: str,
+                   timeout: float = 600.0,
+                   poll_interval: float = 0.5,
+                   max_poll_interval: float = 5.0,
+                   settings: Optional[QdrantSettings] = None):
+    """
+    Wait until the collection is indexed, polling less and less often
+    Args:
+        client: Qdrant client
+        collection_name: name of the collection
+        timeout: maximum number of seconds to wait
+        poll_interval: first delay between two polls
+        max_poll_interval: maximum delay between two polls
+        settings: settings with the number of retries and the backoff of each poll, read from the environment if None
+    """
+    settings = settings or QdrantSettings.from_env()
+    deadline = time.monotonic() + timeout
+    while True:
+        # A transient error of one poll does not abort the wait
+        collection_info = with_retry(settings, client.get_collection, collection_name=collection_name)
+        if collection_info.status == models.CollectionStatus.GREEN:
+            # Collection status is green, which means the indexing is finished
+            return
+        if collection_info.status == models.CollectionStatus.RED:
+            raise RuntimeError(f"Collection '{collection_name}' failed to index: {collection_info.optimizer_status}")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Collection '{collection_name}' is still {collection_info.status.value} "
+                               f"after {timeout:.0f}s")
+        time.sleep(min(poll_interval, remaining))
+        poll_interval = min(poll_interval * 2, max_poll_interval)
@@ -1,48 +1,642 @@
+import os
+import time
+import asyncio
+import hashlib
 import numpy as np
-from tqdm import tqdm
-from typing import List, Dict, Tuple, Set
-from qdrant_client import QdrantClient, models
-from sentence_transformers import SentenceTransformer
+from contextlib import contextmanager
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, List, Dict, Optional, Sequence, Tuple, Set, Union
+from .cache import TTLCache, read_index_version
+from .encoder import ImageEncoder, get_text_encoder
+from .index import Hit, PointNotFoundError, SearchFilter, excluding, get_index, normalize
+from .manifest import point_id
+from .metrics import ENCODER_BATCH_SIZE, INDEX_ERRORS, SEARCH_BATCH_SIZE, StageTimer
+
+
+# Prompt templates of the query ensembles, '{q}' is replaced by the query text
+PROMPT_TEMPLATES = ('{q}', 'a photo of {q}', 'a picture of {q}', 'an ad for {q}', 'a poster of {q}',
+                    'a close-up photo of {q}', 'a photo of the {q}', 'an illustration of {q}')
+
+# Ways of combining the prompt variants of a query: one averaged vector, or one search per variant
+# merged with reciprocal-rank fusion
+ENSEMBLE_MODES = ('none', 'average', 'rrf')
+
+# Rank offset of the reciprocal-rank fusion, which damps the weight of the first ranks
+RRF_K = 60
+
+# Number of candidates re-ranked by the diversity re-rank, the same for all the pages of a query so that they agree
+MMR_CANDIDATES = 100
+
+
+def reciprocal_rank_fusion(search_results: List[List[Hit]], k: int = RRF_K) -> List[Hit]:
+    """
+    Merge ranked lists of hits, each hit scores the sum of 1 / (k + rank) over the lists it appears in
+    Args:
+        search_results: lists of hits, best first
+        k: rank offset
+
+    Returns: merged list of hits with their fused score, best first
+    """
+    fused: Dict[str, Hit] = {}
+    for hits in search_results:
+        for rank, hit in enumerate(hits, start=1):
+            if hit.id not in fused:
+                fused[hit.id] = Hit(id=hit.id, score=0.0, payload=hit.payload, vector=hit.vector)
+            fused[hit.id].score += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda hit: hit.score, reverse=True)
+
+
+def maximal_marginal_relevance(query: np.ndarray, hits: List[Hit], diversity: float, k: int) -> List[Hit]:
+    """
+    Re-rank hits with maximal marginal relevance: each next hit maximizes its similarity to the query minus
+    `diversity` times its highest similarity to the hits already selected, so that similar images are spread out
+    Args:
+        query: query vector
+        hits: candidate hits with their vectors, best first
+        diversity: weight of the redundancy, between 0 (relevance only) and 1
+        k: number of hits selected
+
+    Returns: selected hits, in selection order
+    """
+    if not hits or any(hit.vector is None for hit in hits):
+        return hits[:k]
+    candidates = normalize(np.stack([hit.vector for hit in hits]))
+    relevance = candidates @ normalize(query)
+    similarities = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarities[selected[0]].copy()
+    available = np.ones(len(hits), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, len(hits)):
+        scores = np.where(available, (1 - diversity) * relevance - diversity * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarities[best])
+    return [hits[i] for i in selected]
+
+
+@dataclass(frozen=True)
+class Query:
+    """
+    One query, with its pagination, metadata filter and payload selection. The query vector comes from a text,
+    an image (uploaded, or stored in the collection and referred to by its point id), or both mixed with
+    `text_weight`. A diversity between 0 and 1 re-ranks the results to spread out similar images
+    """
+    text: Optional[str] = None
+    limit: int = 5
+    offset: int = 0
+    query_filter: Optional[SearchFilter] = None
+    with_payload: Union[bool, Tuple[str, ...]] = True
+    image: Optional[bytes] = None
+    image_id: Optional[str] = None
+    text_weight: float = 0.5
+    diversity: Optional[float] = None
+
+    def __post_init__(self):
+        if self.text is None and self.image is None and self.image_id is None:
+            raise ValueError("A query needs a text, an image or an image id")
+        if self.image is not None and self.image_id is not None:
+            raise ValueError("A query can not have both an uploaded image and an image id")
+        if not 0 <= self.text_weight <= 1:
+            raise ValueError("The text weight must be between 0 and 1")
+        if self.diversity is not None and not 0 <= self.diversity <= 1:
+            raise ValueError("The diversity must be between 0 and 1")
 
 
 class Text2Img:
-    def __init__(self, collection_name: str = 'images'):
+    def __init__(self,
+                 collection_name: str = 'images',
+                 docs_path: str = 'resources',
+                 cache_size: int = 1024,
+                 cache_ttl: float = 600.0,
+                 backend: str = 'qdrant',
+                 rescore: bool = True,
+                 oversampling: Optional[float] = None,
+                 encoder_format: Optional[str] = None,
+                 encoder_path: Optional[str] = None,
+                 encoder_quantized: bool = False,
+                 ensemble: Optional[str] = None,
+                 prompt_templates: Sequence[str] = PROMPT_TEMPLATES,
+                 ensemble_size: Optional[int] = None,
+                 diversity: Optional[float] = None,
+                 mmr_candidates: int = MMR_CANDIDATES):
+        """
+        Args:
+            collection_name: name of the collection with the image embeddings
+            docs_path: dir path to the resources, where the collection version is written by the preparation
+            cache_size: maximum number of entries in the embedding cache and in the result cache
+            cache_ttl: lifetime in seconds of a cache entry
+            backend: vector index backend, one of 'qdrant', 'numpy' or 'hnsw'
+            rescore: rescore the candidates found with quantized vectors using the original vectors
+            oversampling: number of candidates fetched with quantized vectors, as a multiple of the limit
+            encoder_format: text encoder format, one of 'sentence-transformers', 'torchscript' or 'onnx'
+            encoder_path: directory of the exported text encoder, 'resources/encoder' by default
+            encoder_quantized: use the int8-quantized text encoder
+            ensemble: None, 'average' to search the average of the prompt variants of each text, or 'rrf' to search
+                each variant and merge their results with reciprocal-rank fusion
+            prompt_templates: templates of the prompt variants, '{q}' is replaced by the text
+            ensemble_size: number of templates used, all of them if None
+            diversity: default diversity of the queries, between 0 and 1, None or 0 keeps the index ranking
+            mmr_candidates: number of candidates fetched for the diversity re-rank, at least `offset + limit`
+        """
         self.collection_name = collection_name
+        self.docs_path = docs_path
+        self.backend = backend
+        self.rescore = rescore
+        self.oversampling = oversampling
+        self.diversity = diversity
+        self.mmr_candidates = mmr_candidates
 
-        # Initialize encoder models for image and text
-        self.text_encoder = SentenceTransformer("clip-ViT-B-32", device="cpu")
+        # Prompt variants of the text queries
+        if ensemble not in (None, *ENSEMBLE_MODES):
+            raise ValueError(f"Unknown ensemble mode '{ensemble}', expected one of {ENSEMBLE_MODES}")
+        self.ensemble = None if ensemble == 'none' else ensemble
+        self.prompt_templates = tuple(prompt_templates)[:ensemble_size]
+        if not self.prompt_templates or any('{q}' not in template for template in self.prompt_templates):
+            raise ValueError("Prompt templates must contain '{q}'")
 
-        # Initialize Qdrant client
-        self.qdrant_client = QdrantClient("http://localhost:6333")
+        # Initialize the text encoder, the model is only loaded by `warm_up` or by the first query
+        self.text_encoder = get_text_encoder(encoder_format, encoder_path, encoder_quantized)
 
-    def search(self, text: str) -> List[Dict[str, str]]:
+        # Initialize the image encoder, the model is only loaded by the first uploaded image
+        self.image_encoder = ImageEncoder(self.text_encoder)
+
+        # Initialize vector index
+        self.index = get_index(backend, collection_name, docs_path)
+
+        # Initialize caches for query embeddings and search results
+        self.embedding_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.result_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.index_version = read_index_version(self.docs_path)
+        self.version_checked_at = time.monotonic()
+        self.ready = False
+
+    def warm_up(self):
+        """
+        Load the text encoder and run one query end to end, so that the first request does not pay for it
+        """
+        vectors = self.text_encoder.encode(['warm up'])
+        self.index.search_batch(vectors, [1])
+        self.ready = True
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Normalize a query, so that queries differing only by case or spacing share cache entries
+        """
+        return ' '.join(text.lower().split())
+
+    def check_index_version(self, interval: float = 1.0):
+        """
+        Reload the index and drop the cached search results if the collection changed since they were computed
+        Args:
+            interval: minimum number of seconds between two checks
+        """
+        now = time.monotonic()
+        if now - self.version_checked_at < interval:
+            return
+        self.version_checked_at = now
+
+        version = read_index_version(self.docs_path)
+        if version != self.index_version:
+            self.index_version = version
+            # Searches in flight keep using the previous index
+            self.index = get_index(self.backend, self.collection_name, self.docs_path)
+            self.result_cache.clear()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts, going through the embedding cache
+        Args:
+            texts: texts to encode
+
+        Returns: matrix of embeddings, one row per text
+        """
+        keys = [self.normalize(text) for text in texts]
+        return self.cached_encode(keys, keys, self.text_encoder.encode)
+
+    def encode_queries(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode query texts with their prompt variants, the prompts of all the texts are encoded with one call
+        Args:
+            texts: texts to encode
+
+        Returns: array of shape (texts, variants, dim), a single variant (the text itself) without ensemble
+        """
+        if self.ensemble is None:
+            return self.encode(texts)[:, None]
+        prompts = [template.replace('{q}', text) for text in texts for template in self.prompt_templates]
+        return normalize(self.encode(prompts)).reshape(len(texts), len(self.prompt_templates), -1)
+
+    def encode_images(self, images: List[bytes]) -> np.ndarray:
+        """
+        Encode uploaded image files, going through the embedding cache
+        Args:
+            images: contents of the image files
+
+        Returns: matrix of embeddings, one row per image
+        """
+        keys = [('image', hashlib.sha1(data).hexdigest()) for data in images]
+        return self.cached_encode(keys, images, self.image_encoder.encode)
+
+    def cached_encode(self, keys: List[Hashable], inputs: List[Any], encode_fn: Callable) -> np.ndarray:
+        """
+        Look up embeddings in the cache and encode the missing ones with a single call
+        Args:
+            keys: cache key of each input
+            inputs: inputs of the encoder
+            encode_fn: function mapping a list of inputs to their embeddings
+
+        Returns: matrix of embeddings, one row per input
+        """
+        vectors = [self.embedding_cache.get(key) for key in keys]
+
+        # Encode all missing inputs at once
+        missing = {key: value for key, value, vector in zip(keys, inputs, vectors) if vector is None}
+        if missing:
+            ENCODER_BATCH_SIZE.observe(len(missing))
+            encoded = dict(zip(missing, encode_fn(list(missing.values()))))
+            for key, vector in encoded.items():
+                self.embedding_cache.set(key, vector)
+            vectors = [encoded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        return np.stack(vectors)
+
+    def query_vectors(self,
+                      queries: List[Query],
+                      timer: Optional[StageTimer] = None) -> Tuple[np.ndarray, Dict[int, np.ndarray]]:
+        """
+        Compute the vectors of several queries: texts and uploaded images are encoded with one call per encoder,
+        images of the collection are looked up by id with one index call, instead of being encoded again.
+        The index is reloaded first if the collection changed, which blocks, hence it is done on the worker pool.
+        Args:
+            queries: search queries
+            timer: timer receiving the durations of the encoding and lookup stages
+
+        Returns: tuple of the matrix of query vectors, one row per query, and the prompt variants searched
+            separately for the text queries of the 'rrf' ensemble, by query position
+        """
+        timer = timer or StageTimer()
+        self.check_index_version()
+        texts = [i for i, query in enumerate(queries) if query.text is not None]
+        uploads = [i for i, query in enumerate(queries) if query.image is not None]
+        stored = [i for i, query in enumerate(queries) if query.image_id is not None]
+
+        text_variants, image_vectors = {}, {}
+        if texts or uploads:
+            with timer.stage('encode'):
+                if texts:
+                    text_variants = dict(zip(texts, self.encode_queries([queries[i].text for i in texts])))
+                if uploads:
+                    image_vectors = dict(zip(uploads, self.encode_images([queries[i].image for i in uploads])))
+
+        if stored:
+            ids = list(dict.fromkeys(queries[i].image_id for i in stored))
+            with self.count_index_errors(), timer.stage('retrieve'):
+                point_vectors = self.index.retrieve_vectors(ids)
+            if len(point_vectors) < len(ids):
+                raise PointNotFoundError(set(ids) - set(point_vectors))
+            image_vectors.update((i, point_vectors[queries[i].image_id]) for i in stored)
+
+        vectors, variants = [], {}
+        for i, query in enumerate(queries):
+            text_vector = None
+            if i in text_variants:
+                prompts = text_variants[i]
+                text_vector = prompts[0] if len(prompts) == 1 else normalize(prompts.mean(axis=0))
+                if self.ensemble == 'rrf' and len(prompts) > 1 and i not in image_vectors:
+                    variants[i] = prompts
+
+            # Mix the text and image vectors of hybrid queries, both are normalized so that the weight is meaningful
+            if i not in image_vectors:
+                vectors.append(text_vector)
+            elif text_vector is None:
+                vectors.append(image_vectors[i])
+            else:
+                vectors.append(query.text_weight * normalize(text_vector)
+                               + (1 - query.text_weight) * normalize(image_vectors[i]))
+        return np.stack(vectors), variants
+
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns: statistics of the embedding and result caches
+        """
+        return {'embeddings': self.embedding_cache.stats(), 'results': self.result_cache.stats()}
+
+    def search(self,
+               text: str,
+               limit: int = 5,
+               offset: int = 0,
+               query_filter: Optional[SearchFilter] = None,
+               with_payload: Union[bool, Tuple[str, ...]] = True) -> List[Dict[str, Any]]:
         """
         Search function for the vector database
         Args:
             text: text used in the search
+            limit: number of results
+            offset: number of best results skipped, for pagination
+            query_filter: conditions on the image metadata
+            with_payload: True for all payload fields, False for none, or the payload fields to return
 
         Returns:
-            List of payloads (images paths more exactly)
-        """
-        # Convert text query into vector
-        vector = self.text_encoder.encode(text).tolist()
-
-        # Use `vector` to search for closest images in the collection
-        search_result = self.qdrant_client.search(
-            collection_name=self.collection_name,
-            query_vector=vector,
-            query_filter=None,
-            with_payload=True,
-            limit=5,
-        )
-        # Retrieve payload results
-        payloads = [hit.payload for hit in search_result]
+            List of point ids with their payloads (images paths and metadata)
+        """
+        return self.search_batch([text], limit=limit, offset=offset, query_filter=query_filter,
+                                 with_payload=with_payload)[0]
+
+    def search_similar(self,
+                       image_id: Optional[str] = None,
+                       image: Optional[bytes] = None,
+                       text: Optional[str] = None,
+                       text_weight: float = 0.5,
+                       limit: int = 5,
+                       offset: int = 0,
+                       query_filter: Optional[SearchFilter] = None,
+                       with_payload: Union[bool, Tuple[str, ...]] = True) -> List[Dict[str, Any]]:
+        """
+        Search images similar to an image of the collection or to an uploaded one, optionally mixed with a text
+        Args:
+            image_id: point id of an image of the collection, excluded from the results
+            image: content of an uploaded image file
+            text: text mixed with the image
+            text_weight: weight of the text vector, the image vector has weight `1 - text_weight`
+            limit: number of results
+            offset: number of best results skipped, for pagination
+            query_filter: conditions on the image metadata
+            with_payload: True for all payload fields, False for none, or the payload fields to return
+
+        Returns:
+            List of point ids with their payloads
+        """
+        return self.search_queries([Query(text, limit, offset, query_filter, with_payload, image=image,
+                                          image_id=image_id, text_weight=text_weight)])[0]
+
+    def recommend(self,
+                  positive: List[str],
+                  negative: List[str] = (),
+                  limit: int = 5,
+                  offset: int = 0,
+                  query_filter: Optional[SearchFilter] = None,
+                  with_payload: Union[bool, Tuple[str, ...]] = True) -> List[Dict[str, Any]]:
+        """
+        Recommend images similar to positive examples and dissimilar to negative ones, with the recommendation
+        API of the index. The examples are looked up by the index, not encoded.
+        Args:
+            positive: point ids of the positive examples
+            negative: point ids of the negative examples
+            limit: number of results
+            offset: number of best results skipped, for pagination
+            query_filter: conditions on the image metadata
+            with_payload: True for all payload fields, False for none, or the payload fields to return
+
+        Returns:
+            List of point ids with their payloads, without the examples
+        """
+        self.check_index_version()
+        key = ('recommend', tuple(positive), tuple(negative), limit, offset, repr(query_filter), repr(with_payload))
+        payloads = self.result_cache.get(key)
+        if payloads is None:
+            with self.count_index_errors():
+                hits = self.index.recommend(list(positive), list(negative), limit=limit, offset=offset,
+                                            query_filter=query_filter,
+                                            with_payload=with_payload if isinstance(with_payload, bool)
+                                            else list(with_payload),
+                                            rescore=self.rescore, oversampling=self.oversampling)
+            payloads = self.to_payloads(hits)
+            self.result_cache.set(key, payloads)
+        return payloads
+
+    def search_batch(self,
+                     texts: List[str],
+                     limit: Union[int, List[int]] = 5,
+                     offset: int = 0,
+                     query_filter: Optional[SearchFilter] = None,
+                     with_payload: Union[bool, Tuple[str, ...]] = True) -> List[List[Dict[str, Any]]]:
+        """
+        Search function for several queries at once, with one encoder call and one database round trip
+        Args:
+            texts: texts used in the search
+            limit: number of results, either the same for all queries or one per query
+            offset: number of best results skipped, for pagination
+            query_filter: conditions on the image metadata
+            with_payload: True for all payload fields, False for none, or the payload fields to return
+
+        Returns:
+            List of point ids with their payloads for each query, in the same order as `texts`
+        """
+        limits = [limit] * len(texts) if isinstance(limit, int) else limit
+        return self.search_queries([Query(text, k, offset, query_filter, with_payload)
+                                    for text, k in zip(texts, limits)])
+
+    def search_queries(self, queries: List[Query], timer: Optional[StageTimer] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Search function for several queries with their own limit, offset, filter and payload selection.
+        Filters are applied by the index during the search, not on its results. Images searched by id are excluded
+        from their own results.
+        Args:
+            queries: search queries
+            timer: timer receiving the durations of the encoding, lookup and index search stages
+
+        Returns:
+            List of point ids with their payloads for each query, in the same order as `queries`
+        """
+        if not queries:
+            return []
+        timer = timer or StageTimer()
+
+        # Convert all queries into vectors at once
+        vectors, variants = self.query_vectors(queries, timer)
+
+        # Look up the results of already seen queries
+        keys, payloads, missing = self.cached_results(queries, vectors)
+        if not missing:
+            return payloads
+
+        # Use `vectors` to search for closest images in the collection
+        rows, params, spans = self.search_params(queries, missing, vectors, variants)
+        SEARCH_BATCH_SIZE.observe(len(rows))
+        with self.count_index_errors(), timer.stage('index_search'):
+            search_results = self.index.search_batch(rows, **params)
+
+        search_results = self.fuse(queries, missing, spans, search_results, vectors)
+        return self.store_results(keys, payloads, missing, search_results)
+
+    async def search_queries_async(self,
+                                   queries: List[Query],
+                                   timer: Optional[StageTimer] = None,
+                                   executor: Optional[Executor] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Same as `search_queries` from the event loop: the index reload and the query vectors are computed on
+        `executor`, the index search is awaited, so that no thread of the pool is held while waiting for Qdrant.
+        The micro-batcher slot of the batch is still held, which bounds the number of concurrent Qdrant searches.
+        Args:
+            queries: search queries
+            timer: timer receiving the durations of the encoding, lookup and index search stages
+            executor: executor computing the query vectors, the loop default executor if None
+
+        Returns:
+            List of point ids with their payloads for each query, in the same order as `queries`
+        """
+        if not queries:
+            return []
+        timer = timer or StageTimer()
+
+        # Convert all queries into vectors at once
+        vectors, variants = await asyncio.get_running_loop().run_in_executor(executor, self.query_vectors, queries,
+                                                                             timer)
+
+        # Look up the results of already seen queries
+        keys, payloads, missing = self.cached_results(queries, vectors)
+        if not missing:
+            return payloads
+
+        # Use `vectors` to search for closest images in the collection
+        rows, params, spans = self.search_params(queries, missing, vectors, variants)
+        SEARCH_BATCH_SIZE.observe(len(rows))
+        with self.count_index_errors(), timer.stage('index_search'):
+            search_results = await self.index.search_batch_async(rows, **params)
+
+        search_results = self.fuse(queries, missing, spans, search_results, vectors)
+        return self.store_results(keys, payloads, missing, search_results)
+
+    def cached_results(self, queries: List[Query], vectors: np.ndarray) -> Tuple[List[Tuple], List, List[int]]:
+        """
+        Look up the results of the queries in the result cache, `query_vectors` checked the index version
+        Returns: tuple of cache keys, cached payloads (None when missing) and positions of the missing queries
+        """
+        keys = [(vector.tobytes(), query.limit, query.offset, repr(self.query_filter(query)), repr(query.with_payload),
+                 self.query_diversity(query))
+                for vector, query in zip(vectors, queries)]
+        payloads = [self.result_cache.get(key) for key in keys]
+        missing = [i for i, payload in enumerate(payloads) if payload is None]
+        return keys, payloads, missing
+
+    def search_params(self,
+                      queries: List[Query],
+                      missing: List[int],
+                      vectors: np.ndarray,
+                      variants: Dict[int, np.ndarray]) -> Tuple[np.ndarray, Dict[str, Any], List[Tuple[int, int]]]:
+        """
+        Arguments of the index search for the missing queries. The prompt variants of a query are searched for
+        its `offset + limit` best results, which are fused afterwards, all in the same index call. Diverse queries
+        fetch more candidates, with their vectors, for the re-rank.
+        Returns: tuple of the query vectors, the other arguments of the index search and the rows of each query
+        """
+        rows, spans = [], []
+        limits, offsets, filters, with_payloads = [], [], [], []
+        for i in missing:
+            query = queries[i]
+            query_rows = variants[i] if i in variants else vectors[i:i + 1]
+            diverse = bool(self.query_diversity(query))
+            spans.append((len(rows), len(rows) + len(query_rows)))
+            rows.extend(query_rows)
+
+            n = len(query_rows)
+            top = query.offset + query.limit
+            if diverse:
+                limits += [max(top, self.mmr_candidates)] * n
+            else:
+                limits += [top if i in variants else query.limit] * n
+            offsets += [0 if i in variants or diverse else query.offset] * n
+            filters += [self.query_filter(query)] * n
+            with_payloads += [query.with_payload if isinstance(query.with_payload, bool)
+                              else list(query.with_payload)] * n
+
+        params = {
+            'limits': limits,
+            'rescore': self.rescore,
+            'oversampling': self.oversampling,
+            'offsets': offsets,
+            'filters': filters,
+            'with_payloads': with_payloads,
+            'with_vectors': any(self.query_diversity(queries[i]) for i in missing),
+        }
+        return np.stack(rows), params, spans
+
+    def fuse(self,
+             queries: List[Query],
+             missing: List[int],
+             spans: List[Tuple[int, int]],
+             search_results: List[List[Hit]],
+             vectors: np.ndarray) -> List[List[Hit]]:
+        """
+        Merge the results of the prompt variants of each query with reciprocal-rank fusion, re-rank the results
+        of diverse queries, then apply their offset
+        Returns: list of hits of each missing query
+        """
+        results = []
+        for i, (start, end) in zip(missing, spans):
+            query = queries[i]
+            diversity = self.query_diversity(query)
+            if end - start == 1 and not diversity:
+                results.append(search_results[start])
+                continue
+
+            hits = search_results[start] if end - start == 1 else reciprocal_rank_fusion(search_results[start:end])
+            top = query.offset + query.limit
+            if diversity:
+                hits = maximal_marginal_relevance(vectors[i], hits, diversity, top)
+            results.append(hits[query.offset:top])
+        return results
+
+    def query_diversity(self, query: Query) -> float:
+        """
+        Diversity of a query, the default one of the searches if the query does not set it
+        """
+        return (self.diversity if query.diversity is None else query.diversity) or 0.0
+
+    @staticmethod
+    def query_filter(query: Query) -> Optional[SearchFilter]:
+        """
+        Filter applied to a query, an image searched by id is excluded from its own results
+        """
+        if query.image_id is None:
+            return query.query_filter
+        return excluding(query.query_filter, [query.image_id])
+
+    @staticmethod
+    def to_payloads(hits: List[Hit]) -> List[Dict[str, Any]]:
+        """
+        Results returned to the callers: the point id, so that images can be searched by id, its score and the payload
+        """
+        return [{'id': hit.id, 'score': hit.score, **hit.payload} for hit in hits]
+
+    @contextmanager
+    def count_index_errors(self):
+        """
+        Count the errors raised by the index calls, unknown point ids are errors of the caller
+        """
+        try:
+            yield
+        except PointNotFoundError:
+            raise
+        except Exception as e:
+            INDEX_ERRORS.inc(backend=self.backend, error=type(e).__name__)
+            raise
+
+    def store_results(self,
+                      keys: List[Tuple],
+                      payloads: List,
+                      missing: List[int],
+                      search_results: List[List[Hit]]) -> List[List[Dict[str, Any]]]:
+        """
+        Fill the missing payloads with the search results and cache them
+        Returns: payloads of all the queries
+        """
+        for i, search_result in zip(missing, search_results):
+            payloads[i] = self.to_payloads(search_result)
+            self.result_cache.set(keys[i], payloads[i])
 
         return payloads
 
     def avg_precision_at_k(self, test_dataset: List[str], k: int = 5) -> Tuple[float, Dict[str, Set[str]]]:
         """
-        Computes precition@k metric for a custom set of queries
+        Computes precition@k metric for a custom set of queries.
+        All queries are encoded at once, the exact kNN is computed locally with one matrix product
+        against the stored embeddings and the ANN results come from a single batch search.
         Args:
             test_dataset: dataset of text queries
             k: parameter of the metric
@@ -50,47 +644,30 @@ class Text2Img:
         Returns: tuple represented by the result of the metric precision@k
                 and a mapping between one search query and a list of common images in both ANN and full kNN
         """
-        # Initialize precision and common indexes mapping
-        precisions = []
-        common_images_mapping = {}
+        # Only needed for the evaluation, pyarrow and pandas are kept out of the service
+        from .embeddings import EMBEDDINGS_FILE, exact_ground_truth
+        from .dedup import DUPLICATES_FILE, load_duplicates
 
         print("Evaluating custom dataset...")
-        for item in tqdm(test_dataset):
-            # Convert text query into vector
-            vector = self.text_encoder.encode(item).tolist()
-
-            # Get approximate results
-            ann_result = self.qdrant_client.search(
-                collection_name=self.collection_name,
-                query_vector=vector,
-                limit=k,
-            )
-
-            # Get full results
-            knn_result = self.qdrant_client.search(
-                collection_name=self.collection_name,
-                query_vector=vector,
-                limit=k,
-                search_params=models.SearchParams(
-                    exact=True,  # Turns on the exact search mode
-                ),
-            )
-
-            # Get ids of the search results
-            ann_ids = set(item.id for item in ann_result)
-            knn_ids = set(item.id for item in knn_result)
-
-            # Get common indexes
-            common_indexes = ann_ids.intersection(knn_ids)
-
-            # Get common images path
-            mask = np.isin(list(common_indexes), list(knn_ids))
-            common_results = np.array(knn_result)[mask]
-            common_images = [res.payload['path'] for res in common_results]
-            common_images_mapping[item] = set(common_images)
-
-            # Compute precision
-            precision = len(common_indexes) / k
-            precisions.append(precision)
+
+        # Convert all text queries into vectors at once
+        vectors = self.encode(test_dataset)
+
+        # Get full results, among the images of the collection: near-duplicates have no point
+        duplicates = load_duplicates(os.path.join(self.docs_path, DUPLICATES_FILE))
+        hidden = {p for paths in duplicates.values() for p in paths}
+        knn_paths = exact_ground_truth(os.path.join(self.docs_path, EMBEDDINGS_FILE), vectors, k, hidden=hidden)
+
+        # Get approximate results
+        ann_results = self.index.search_batch(vectors, [k] * len(test_dataset))
+
+        # Compute precision and common images for each query
+        precisions = []
+        common_images_mapping = {}
+        for item, knn, ann in zip(test_dataset, knn_paths, ann_results):
+            ann_ids = set(hit.id for hit in ann)
+            common_images = set(path for path in knn if point_id(path) in ann_ids)
+            common_images_mapping[item] = common_images
+            precisions.append(len(common_images) / k)
 
         return sum(precisions) / len(precisions), common_images_mapping
@@ -0,0 +1,101 @@
+import os
+from PIL import Image
+from typing import Iterable, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+
+# Formats of the thumbnails, with the PIL encoder and its options
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+
+
+def thumbnail_name(im_path: str, thumbnail_format: str = 'webp') -> str:
+    """
+    Name of the thumbnail of an image, the full image name is kept so that 'a.jpg' and 'a.png' do not collide
+    Args:
+        im_path: path of the image
+        thumbnail_format: 'webp' or 'jpeg'
+
+    Returns: file name of the thumbnail
+    """
+    return f"{os.path.basename(im_path)}.{thumbnail_format}"
+
+
+def make_thumbnail(im_path: str,
+                   thumbnails_path: str,
+                   size: int = 384,
+                   thumbnail_format: str = 'webp',
+                   force: bool = False) -> Optional[str]:
+    """
+    Writes a resized copy of an image, unless an up-to-date one already exists
+    Args:
+        im_path: path of the image
+        thumbnails_path: directory of the thumbnails
+        size: maximum width and height of the thumbnail
+        thumbnail_format: 'webp' or 'jpeg'
+        force: write the thumbnail even if it is newer than the image
+
+    Returns: path of the thumbnail, None for unreadable images
+    """
+    path = os.path.join(thumbnails_path, thumbnail_name(im_path, thumbnail_format))
+    if not force and os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(im_path):
+        return path
+
+    pil_format, options = THUMBNAIL_FORMATS[thumbnail_format]
+    try:
+        with Image.open(im_path) as im:
+            # Let the JPEG decoder downscale while decoding
+            im.draft('RGB', (size, size))
+            im = im.convert('RGB')
+            im.thumbnail((size, size), Image.BICUBIC)
+
+            # Write next to the final file, so that the service never sends a partial thumbnail
+            tmp_path = path + '.tmp'
+            im.save(tmp_path, format=pil_format, **options)
+    except Exception:
+        return None
+
+    os.replace(tmp_path, path)
+    return path
+
+
+def build_thumbnails(im_paths: List[str],
+                     thumbnails_path: str,
+                     size: int = 384,
+                     thumbnail_format: str = 'webp',
+                     stale_paths: Iterable[str] = (),
+                     num_workers: Optional[int] = None) -> int:
+    """
+    Writes the thumbnails of the images on a process pool and removes the thumbnails of deleted images
+    Args:
+        im_paths: paths of all the images
+        thumbnails_path: directory of the thumbnails
+        size: maximum width and height of the thumbnails
+        thumbnail_format: 'webp' or 'jpeg'
+        stale_paths: images whose content changed, their thumbnails are always written again
+        num_workers: number of processes, defaults to the number of CPUs
+
+    Returns: number of images without a thumbnail
+    """
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise ValueError(f"Unknown thumbnail format '{thumbnail_format}', expected one of {list(THUMBNAIL_FORMATS)}")
+    os.makedirs(thumbnails_path, exist_ok=True)
+
+    # Remove the thumbnails of images which are gone
+    expected = set(thumbnail_name(p, thumbnail_format) for p in im_paths)
+    for name in os.listdir(thumbnails_path):
+        if name not in expected:
+            os.remove(os.path.join(thumbnails_path, name))
+
+    stale_paths = set(stale_paths)
+    forces = [p in stale_paths for p in im_paths]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = list(tqdm(executor.map(make_thumbnail, im_paths, [thumbnails_path] * len(im_paths),
+                                         [size] * len(im_paths), [thumbnail_format] * len(im_paths), forces,
+                                         chunksize=64),
+                            total=len(im_paths)))
+
+    return sum(result is None for result in results)
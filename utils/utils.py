@@ -1,23 +1,21 @@
-import io
 import os
-import zipfile
-import requests
-import shutil
+import time
+import random
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from typing import Optional
 from tqdm import tqdm
-from typing import List, Dict
-from fastapi import Response
+from typing import Dict, List, Iterable, Iterator, Tuple
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
-from qdrant_client.models import VectorParams, Distance
-from qdrant_client import QdrantClient, models
 from sentence_transformers import SentenceTransformer
-from zipfile import ZipFile
-
-
-tqdm.pandas()
+from .manifest import point_id
+from .index import PAYLOAD_FIELDS, VectorIndex, get_index, version_name
+from .cache import write_index_version
+from .embeddings import (EMBEDDINGS_FILE, EMBEDDING_DIM, EmbeddingsWriter, iter_embeddings, read_paths,
+                         count_embeddings, stored_columns)
 
 
 def read_txt(path: str) -> List[str]:
@@ -37,22 +35,6 @@ def read_txt(path: str) -> List[str]:
     return data
 
 
-def download_and_extract(url: str, extract_to: str = '.'):
-    """
-    Download a zip file from the specified URL and extract it to the given directory.
-    Args:
-        url: url of the data
-        extract_to: path where to extract data
-    """
-    local_filename = url.split('/')[-1]
-    with requests.get(url, stream=True) as r:
-        with open(local_filename, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-    with ZipFile(local_filename, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
-    os.remove(local_filename)
-
-
 def specs(x, **kwargs):
     """
     Helper to add mean and median on the plot
@@ -64,166 +46,364 @@ def specs(x, **kwargs):
     plt.axvline(x.median(), c='orange', ls='--', lw=1.5, label='median')
 
 
-def zip_files(filenames: List[Dict[str, str]]) -> Response:
+def load_image(image_path: str, size: int = 224) -> Optional[Image.Image]:
     """
-    Function that prepares an archive with all the matched images
+    Decode and downscale an image so that its shortest side is `size` pixels
     Args:
-        filenames: response from Qdrant vector similarity search
+        image_path: path for the image to be decoded
+        size: target length of the shortest side (CLIP input resolution)
 
-    Returns: fastAPI response
+    Returns:
+        None or the decoded RGB image
 
     """
-    # Define archive name
-    zip_filename = "images.zip"
-
-    s = io.BytesIO()
-    zf = zipfile.ZipFile(s, "w")
-
-    for entry in filenames:
-        fpath = entry['path']
-
-        # Calculate path for file in zip
-        fdir, fname = os.path.split(fpath)
-
-        # Add file, at correct path
-        zf.write(fpath, fname)
-
-    # Must close zip for all contents to be written
-    zf.close()
-
-    # Grab ZIP file from in-memory, make response with correct MIME-type
-    resp = Response(s.getvalue(), media_type="application/x-zip-compressed", headers={
-        'Content-Disposition': f'attachment;filename={zip_filename}'
-    })
+    try:
+        with Image.open(image_path) as image:
+            # Let the JPEG decoder skip DCT scales we do not need
+            image.draft('RGB', (size, size))
+            image = image.convert('RGB')
+
+        # Resize only if the image is bigger than needed, the model does the final crop
+        w, h = image.size
+        scale = size / min(w, h)
+        if scale < 1:
+            image = image.resize((max(size, round(w * scale)), max(size, round(h * scale))), Image.BICUBIC)
+        return image
 
-    return resp
+    except Exception:
+        return None
 
 
-def calculate_embedding(model, image_path: str) -> Optional[List[float]]:
+def decode_batches(paths: List[str],
+                   executor: Executor,
+                   batch_size: int = 32,
+                   prefetch: int = 2) -> Iterator[Tuple[List[str], List[Optional[Image.Image]]]]:
     """
-    Compute embeddings for an image
+    Decode images in batches on a worker pool, keeping at most `prefetch` batches in flight
     Args:
-        model: Image embedding model instance
-        image_path:  path for the image to be embedded
+        paths: paths of the images to decode
+        executor: thread or process pool used for decoding
+        batch_size: number of images in a batch
+        prefetch: number of batches decoded ahead of the consumer
 
-    Returns:
-        None or the embedding
+    Returns: iterator over (paths, images) batches, unreadable images are None
 
     """
-    try:
-        image = Image.open(image_path)
-        encoded_im = model.encode(image).tolist()
-        image.close()
-        return encoded_im
-    
-    except Exception:
-        print(f"Error when embedding image {image_path}")
-        return None
-
-
-def build_image_embeddings(df: pd.DataFrame, save_path: str = 'resources'):
+    batches = (paths[i:i + batch_size] for i in range(0, len(paths), batch_size))
+    pending = deque()
+
+    for batch in batches:
+        pending.append((batch, [executor.submit(load_image, p) for p in batch]))
+        if len(pending) > prefetch:
+            batch_paths, futures = pending.popleft()
+            yield batch_paths, [f.result() for f in futures]
+
+    while pending:
+        batch_paths, futures = pending.popleft()
+        yield batch_paths, [f.result() for f in futures]
+
+
+def build_image_embeddings(df: pd.DataFrame,
+                           save_path: str = 'resources',
+                           batch_size: int = 32,
+                           num_workers: Optional[int] = None,
+                           use_processes: bool = False,
+                           stale_paths: Iterable[str] = (),
+                           row_group_size: int = 4096) -> Tuple[List[str], List[str]]:
     """
-    Builds and save image embeddings
+    Builds and save image embeddings.
+    Images are decoded and resized on a worker pool while the model encodes the previous batch.
+    Only images without an embedding (or listed in `stale_paths`) are embedded, embeddings of
+    images that are no longer in `df` are dropped. Embeddings are streamed to the parquet file
+    in row groups while they are produced. A file written before some payload field existed is rewritten
+    with the metadata of `df`, and its images are upserted again.
     Args:
         df: DataFrame with all images information
         save_path: path to save the embeddings
+        batch_size: number of images encoded by the model at once
+        num_workers: number of decoding workers, defaults to the number of CPUs
+        use_processes: decode images in a process pool instead of a thread pool
+        stale_paths: paths of images whose content changed since their embedding was computed
+        row_group_size: number of rows in a parquet row group
 
-    Returns: DataFrame with embeddings added
+    Returns: tuple represented by the paths to upsert (embedded in this run, or whose metadata was refreshed)
+        and the paths whose embeddings were removed
 
     """
 
     # Check existence of directory and files
-    embeddings_file = "images_embeddings.parquet"
-    embeddings_path = os.path.join(save_path, embeddings_file)
+    embeddings_path = os.path.join(save_path, EMBEDDINGS_FILE)
+    skipped_path = os.path.join(save_path, "skipped_images.txt")
 
     if not os.path.exists(save_path):
         os.makedirs(save_path)
-    else:
-        # Check for existence of embeddings
-        if os.path.isfile(embeddings_path):
-            print("Embeddings were already created")
-            return
-
-    print("Building image embeddings...")
 
-    # Set model for embedding the images
-    image_model = SentenceTransformer("clip-ViT-B-32")
+    # Reuse the embeddings of unchanged images, only their paths are loaded here
+    stale_paths = set(stale_paths)
+    all_paths = set(df["path"])
+    old_paths = set(read_paths(embeddings_path)) if os.path.isfile(embeddings_path) else set()
+    old_skipped = set(read_txt(skipped_path)) if os.path.isfile(skipped_path) else set()
+
+    kept_paths = (old_paths & all_paths) - stale_paths
+    done_paths = kept_paths | ((old_skipped & all_paths) - stale_paths)
+    new_df = df[~df["path"].isin(done_paths)]
+
+    # The metadata of the kept embeddings is taken from `df`, rewriting the file adds the missing columns
+    stale_meta = bool(old_paths) and not set(PAYLOAD_FIELDS).issubset(stored_columns(embeddings_path))
+    if stale_meta:
+        print("Embeddings miss some metadata columns, they are rewritten")
+
+    if new_df.empty and kept_paths == old_paths and not stale_meta:
+        print("Embeddings are up to date")
+        return [], []
+
+    print(f"Building image embeddings for {len(new_df)} images...")
+
+    paths = new_df["path"].tolist()
+    embedded_paths = []
+    skipped = sorted((old_skipped & all_paths) - stale_paths)
+
+    with EmbeddingsWriter(embeddings_path, df, row_group_size=row_group_size) as writer:
+        # Copy the kept embeddings from the previous file, row group by row group
+        if kept_paths:
+            for meta, vectors in iter_embeddings(embeddings_path, columns=[], paths=kept_paths):
+                writer.write(meta.column('path').to_pylist(), vectors)
+
+        if paths:
+            # Set model for embedding the images
+            image_model = SentenceTransformer("clip-ViT-B-32")
+
+            # Check for torch and CUDA availability
+            try:
+                import torch
+
+                if torch.cuda.is_available():
+                    image_model = image_model.to('cuda')
+                else:
+                    print("CUDA is not available. Using CPU instead. This may take some time...")
+            except ModuleNotFoundError:
+                print("Torch is not installed")
+
+            num_workers = num_workers or os.cpu_count()
+            executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+            # Compute embeddings batch by batch and stream them to the file
+            start = time.perf_counter()
+            with executor_cls(max_workers=num_workers) as executor, tqdm(total=len(paths)) as pbar:
+                for batch_paths, images in decode_batches(paths, executor, batch_size=batch_size, prefetch=2):
+                    valid = [(p, im) for p, im in zip(batch_paths, images) if im is not None]
+                    skipped.extend(p for p, im in zip(batch_paths, images) if im is None)
+
+                    if valid:
+                        vectors = image_model.encode([im for _, im in valid], batch_size=batch_size,
+                                                     convert_to_numpy=True)
+                        writer.write([p for p, _ in valid], vectors)
+                        embedded_paths.extend(p for p, _ in valid)
+                    pbar.update(len(batch_paths))
+            elapsed = time.perf_counter() - start
+
+            print(f"Embedded {len(embedded_paths)} images in {elapsed:.1f}s "
+                  f"({len(embedded_paths) / max(elapsed, 1e-9):.1f} images/s)")
+
+    # Log unreadable images
+    with open(skipped_path, 'w') as file:
+        file.writelines(p + '\n' for p in skipped)
+    if skipped:
+        print(f"Skipped {len(skipped)} unreadable images, listed in {skipped_path}")
+
+    removed_paths = sorted(old_paths - kept_paths - set(embedded_paths))
+
+    # Points uploaded from the old file miss the new payload fields
+    if stale_meta:
+        embedded_paths = sorted(kept_paths) + embedded_paths
 
-    # Check for torch and CUDA availability
-    try:
-        import torch
-
-        if torch.cuda.is_available():
-            image_model = image_model.to('cuda')
-        else:
-            print("CUDA is not available. Using CPU instead. This may take some time...")
-    except ModuleNotFoundError:
-        print("Torch is not installed")
+    print("Finished")
 
-    # Compute embeddings
-    df["embedding"] = df["path"].progress_apply(lambda x: calculate_embedding(image_model, x))
-    df["embedding"] = df["embedding"].replace({None: np.nan})
-    df = df.dropna(subset=["embedding"])
+    return embedded_paths, removed_paths
 
-    # Save to parquet file
-    df.to_parquet(embeddings_path)
 
-    print("Finished")
+def upload_embeddings(index: VectorIndex,
+                      embeddings_path: str,
+                      paths: Optional[List[str]] = None,
+                      batch_size: int = 256,
+                      duplicates: Optional[Dict[str, List[str]]] = None):
+    """
+    Stream the embeddings file into upsert batches, only one batch is held in memory,
+    and wait to have all data indexed. The image metadata stored next to the embeddings goes in the payload.
+    Args:
+        index: vector index receiving the points
+        embeddings_path: path of the embeddings parquet file
+        paths: paths of the images to upload, all images if None
+        batch_size: number of points sent in one upsert request
+        duplicates: mapping between representative and duplicates paths, duplicates are left out
+            and listed in the payload of their representative
+    """
+    duplicates = duplicates or {}
+    hidden = {p for dup_paths in duplicates.values() for p in dup_paths}
+    num_points = count_embeddings(embeddings_path) if paths is None else len(paths)
+    columns = [c for c in PAYLOAD_FIELDS if c in stored_columns(embeddings_path)]
+    batches = iter_embeddings(embeddings_path, batch_size=batch_size, columns=columns, paths=paths)
+    for meta, vectors in tqdm(batches, total=-(-num_points // batch_size)):
+        payloads = meta.to_pylist()
+        if hidden:
+            keep = [i for i, p in enumerate(payloads) if p['path'] not in hidden]
+            payloads, vectors = [payloads[i] for i in keep], vectors[keep]
+            if not payloads:
+                continue
+        for payload in payloads:
+            if payload['path'] in duplicates:
+                payload['duplicates'] = duplicates[payload['path']]
+        index.upsert([point_id(p['path']) for p in payloads], vectors, payloads)
+
+    index.wait_ready()
+
+
+def smoke_check(index: VectorIndex,
+                embeddings_path: str,
+                num_queries: int = 32,
+                k: int = 10,
+                min_recall: float = 0.9,
+                duplicates: Optional[Dict[str, List[str]]] = None) -> bool:
+    """
+    Check a freshly built collection before it is served: it holds all the embeddings, and embeddings
+    sampled from the file find their own image among the top `k` results
+    Args:
+        index: vector index of the new collection
+        embeddings_path: path of the embeddings parquet file
+        num_queries: number of sampled embeddings searched
+        k: number of results of each query
+        min_recall: minimum fraction of queries finding their own image
+        duplicates: mapping between representative and duplicates paths, duplicates have no point
+
+    Returns: whether the collection can be served
+    """
+    hidden = {p for dup_paths in (duplicates or {}).values() for p in dup_paths}
+    paths = [p for p in read_paths(embeddings_path) if p not in hidden]
+    num_points, count = len(paths), index.count()
+    if count != num_points:
+        print(f"Smoke check failed: the collection has {count} points instead of {num_points}")
+        return False
+
+    if not paths:
+        return True
+
+    # Same sample at every build, so that versions are compared on the same queries
+    sample = random.Random(0).sample(paths, min(num_queries, len(paths)))
+    ids, vectors = [], []
+    for meta, batch in iter_embeddings(embeddings_path, columns=[], paths=sample):
+        ids.extend(point_id(p) for p in meta.column('path').to_pylist())
+        vectors.append(batch)
+    results = index.search_batch(np.concatenate(vectors), [k] * len(ids), with_payloads=[False] * len(ids))
+
+    recall = np.mean([pid in {hit.id for hit in hits} for pid, hits in zip(ids, results)])
+    if recall < min_recall:
+        print(f"Smoke check failed: {recall:.0%} of the sampled images are found in their top {k} results")
+        return False
+
+    print(f"Smoke check passed: {count} points, {recall:.0%} of the sampled images found in their top {k} results")
+    return True
+
+
+def drop_old_versions(index: VectorIndex, backend: str, vectors_dir_path: str, keep_versions: int = 2):
+    """
+    Drop the versions of the collection which are neither served nor among the most recent ones
+    Args:
+        index: vector index of the alias
+        backend: vector index backend
+        vectors_dir_path: paths to the directory containing the embeddings file
+        keep_versions: number of versions kept, including the served one, so that it can be rolled back
+    """
+    served = index.alias_target()
+    others = [name for name in index.versions() if name != served]
+    for name in others[:max(len(others) - keep_versions + 1, 0)]:
+        print(f"Dropping old collection '{name}'...")
+        get_index(backend, name, vectors_dir_path).drop()
 
 
 def update_db_collection(collection_name: str = 'images',
                          vectors_dir_path: str = 'resources',
                          m: int = 16,
-                         ef_construct: int = 100):
+                         ef_construct: int = 100,
+                         upsert_paths: Optional[List[str]] = None,
+                         delete_paths: Iterable[str] = (),
+                         batch_size: int = 256,
+                         backend: str = 'qdrant',
+                         quantization: Optional[str] = None,
+                         on_disk: bool = False,
+                         keep_versions: int = 2,
+                         duplicates: Optional[Dict[str, List[str]]] = None) -> int:
     """
-    Create a Qdrant collection
+    Create a vector collection, or apply a delta of upserted and deleted images to an existing one.
+    A rebuild goes into a new version of the collection while the current one is still served. Once indexed
+    and smoke-checked, the alias `collection_name` is switched to it and the old versions are dropped.
     Args:
         collection_name: name of the collection to store the vector db points
         vectors_dir_path: paths to the directory containing the embeddings file
         m:number of edges per node
         ef_construct: number of neighbours to consider during the index building
+        upsert_paths: paths of the images to upsert, None (re-)creates the collection with all images
+        delete_paths: paths of the images whose points are deleted
+        batch_size: number of points sent in one upsert request
+        backend: vector index backend, one of 'qdrant', 'numpy' or 'hnsw'
+        quantization: None, 'scalar' or 'product' quantization of the vectors, applied when the collection is created
+        on_disk: keep the original vectors on disk, applied when the collection is created
+        keep_versions: number of versions of the collection kept after a rebuild, including the served one
+        duplicates: mapping between representative and duplicates paths, only representatives get a point
+
+    Returns: number of embeddings uploaded
     """
 
-    embeddings_path = os.path.join(vectors_dir_path, "images_embeddings.parquet")
+    embeddings_path = os.path.join(vectors_dir_path, EMBEDDINGS_FILE)
     if not os.path.isfile(embeddings_path):
         print("Embeddings are not in the directory you specified or were not created!")
-        return
-
-    # Initialize Qdrant client
-    qdrant_client = QdrantClient("http://localhost:6333")
-
-    # Load all vectors into memory
-    im_df = pd.read_parquet(embeddings_path)
-    print(f"There are {len(im_df)} images.")
-
-    # Create payloads and vectors
-    paths = im_df['path'].values
-    payloads = iter([{'path': p} for p in paths])
-    vectors = iter(list(map(list, im_df["embedding"].tolist())))
-
-    print("Populating Qdrant collection with the embeddings...")
-
-    # (Re-)create collection
-    qdrant_client.recreate_collection(
-        collection_name=collection_name,
-        vectors_config=VectorParams(size=512, distance=Distance.COSINE),
-    )
-
-    # Update data to collection
-    qdrant_client.upload_collection(
-        collection_name=collection_name,
-        vectors=vectors,
-        payload=payloads,
-        ids=None,
-        batch_size=256
-    )
-
-    # Wait to have all data indexed
-    while True:
-        collection_info = qdrant_client.get_collection(collection_name=collection_name)
-        if collection_info.status == models.CollectionStatus.GREEN:
-            # Collection status is green, which means the indexing is finished
-            break
-
-    print(f"There are {qdrant_client.count(collection_name)} points created "
-          f"in the Qdrant collection named '{collection_name}'")
+        return 0
+
+    # Initialize vector index, the services search the collection through this alias
+    index = get_index(backend, collection_name, vectors_dir_path)
+
+    # An incremental update needs an existing collection, with the metadata indexed for filtering
+    rebuild = upsert_paths is None or not index.exists()
+    if not rebuild and not set(PAYLOAD_FIELDS).issubset(index.payload_fields()):
+        print(f"Collection '{collection_name}' has no metadata indexes, it is re-created.")
+        rebuild = True
+
+    if not rebuild and not upsert_paths and not delete_paths:
+        print(f"Collection '{collection_name}' is up to date.")
+        return 0
+
+    num_points = count_embeddings(embeddings_path) if rebuild else len(upsert_paths)
+    print(f"There are {num_points} images to upload.")
+
+    if rebuild:
+        # Build a new version next to the served one
+        version = get_index(backend, version_name(collection_name), vectors_dir_path)
+        print(f"Populating {backend} collection '{version.collection_name}' with the embeddings...")
+        version.recreate(EMBEDDING_DIM, m=m, ef_construct=ef_construct, quantization=quantization, on_disk=on_disk)
+        upload_embeddings(version, embeddings_path, batch_size=batch_size, duplicates=duplicates)
+
+        if not smoke_check(version, embeddings_path, duplicates=duplicates):
+            version.drop()
+            raise RuntimeError(f"Collection '{version.collection_name}' failed the smoke check, "
+                               f"'{collection_name}' still serves the previous version")
+
+        # Serve the new version, then drop the old ones
+        index.switch_alias(version.collection_name)
+        drop_old_versions(index, backend, vectors_dir_path, keep_versions)
+    else:
+        print(f"Populating {backend} collection '{collection_name}' with the embeddings...")
+        if delete_paths:
+            # Delete points of removed images
+            index.delete([point_id(p) for p in delete_paths])
+
+        # Upload the embeddings and wait to have all data indexed
+        upload_embeddings(index, embeddings_path, paths=upsert_paths, batch_size=batch_size, duplicates=duplicates)
+
+        # In-process collections write each update into a new version, the old ones are dropped as after a rebuild
+        drop_old_versions(index, backend, vectors_dir_path, keep_versions)
+
+    # Let the services know that their cached results are stale
+    write_index_version(vectors_dir_path)
+
+    print(f"There are {index.count()} points created "
+          f"in the collection named '{collection_name}'")
+    return num_points